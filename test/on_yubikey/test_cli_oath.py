@@ -102,6 +102,14 @@ def additional_tests(ykman_cli):
             creds = ykman_cli("oath", "code", "query-me")
             self.assertIn("query-me", creds)
 
+        def test_oath_list_cached(self):
+            ykman_cli("oath", "add", "cache-me", "abba")
+            creds = ykman_cli("oath", "list", "--cached")
+            self.assertIn("cache-me", creds)
+            ykman_cli("oath", "delete", "cache-me", "-f")
+            creds = ykman_cli("oath", "list", "--cached")
+            self.assertNotIn("cache-me", creds)
+
         def test_oath_reset(self):
             output = ykman_cli("oath", "reset", "-f")
             self.assertIn(
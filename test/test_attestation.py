@@ -0,0 +1,287 @@
+#  vim: set fileencoding=utf-8 :
+
+from ykman import attestation as attestation_module
+from ykman.attestation import (
+    AttestationVerifier,
+    InvalidAttestation,
+    parse_attestation,
+    OID_PIV_FIRMWARE,
+    OID_PIV_SERIAL,
+    OID_PIV_POLICY,
+    OID_PIV_FORM_FACTOR,
+    OID_OPGP_FIRMWARE,
+    OID_OPGP_SERIAL,
+    OID_OPGP_TOUCH,
+    OID_OPGP_SOURCE,
+)
+from ykman.opgp import TOUCH_MODE
+from yubikit.core import Tlv, FORM_FACTOR
+from yubikit.piv import PIN_POLICY, TOUCH_POLICY
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.x509.oid import NameOID
+from unittest import mock
+import datetime
+import tempfile
+import unittest
+import os
+
+
+def _key():
+    return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+def _name(cn):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+
+
+def _cert(
+    subject, key, issuer, issuer_key, extensions=(), key_ids=True, ca=False, path=None
+):
+    now = datetime.datetime.utcnow()
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(_name(subject))
+        .issuer_name(_name(issuer))
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+    )
+    if key_ids:
+        builder = builder.add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(key.public_key()), False
+        ).add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()),
+            False,
+        )
+    if ca:
+        builder = builder.add_extension(x509.BasicConstraints(True, path), True)
+    for oid, value in extensions:
+        builder = builder.add_extension(x509.UnrecognizedExtension(oid, value), False)
+    return builder.sign(issuer_key, hashes.SHA256(), default_backend())
+
+
+def _der(cert):
+    return cert.public_bytes(Encoding.DER)
+
+
+PIV_EXTENSIONS = [
+    (OID_PIV_FIRMWARE, bytes([5, 2, 7])),
+    (OID_PIV_SERIAL, Tlv(0x02, (12345678).to_bytes(4, "big"))),
+    (OID_PIV_POLICY, bytes([PIN_POLICY.ALWAYS, TOUCH_POLICY.CACHED])),
+    (OID_PIV_FORM_FACTOR, b"\x83"),
+]
+
+
+class TestAttestation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root_key = _key()
+        cls.root = _cert("Root CA", cls.root_key, "Root CA", cls.root_key, ca=True)
+        cls.ca_key = _key()
+        cls.ca = _cert("Attestation CA", cls.ca_key, "Root CA", cls.root_key, ca=True)
+
+        # Like on a YubiKey, the F9 and attestation certificates have no key IDs
+        cls.f9_key = _key()
+        cls.f9 = _cert(
+            "PIV Attestation", cls.f9_key, "Attestation CA", cls.ca_key, ca=True
+        )
+        cls.key = _key()
+        cls.attestation = _cert(
+            "PIV Attestation 9a",
+            cls.key,
+            "PIV Attestation",
+            cls.f9_key,
+            PIV_EXTENSIONS,
+            key_ids=False,
+        )
+
+        fd, cls.roots_path = tempfile.mkstemp(suffix=".pem")
+        with os.fdopen(fd, "wb") as f:
+            f.write(cls.root.public_bytes(Encoding.PEM))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.roots_path)
+
+    def test_parse_piv(self):
+        result = parse_attestation(self.attestation)
+        self.assertEqual(
+            result.public_key,
+            self.key.public_key().public_bytes(
+                Encoding.DER, PublicFormat.SubjectPublicKeyInfo
+            ),
+        )
+        self.assertEqual(12345678, result.serial)
+        self.assertEqual((5, 2, 7), result.version)
+        self.assertEqual(FORM_FACTOR.USB_C_KEYCHAIN, result.form_factor)
+        self.assertEqual(PIN_POLICY.ALWAYS, result.pin_policy)
+        self.assertEqual(TOUCH_POLICY.CACHED, result.touch_policy)
+        self.assertTrue(result.generated)
+
+    def test_parse_openpgp(self):
+        key = _key()
+        cert = _cert(
+            "OpenPGP Attestation",
+            key,
+            "PIV Attestation",
+            self.f9_key,
+            [
+                (OID_OPGP_FIRMWARE, bytes([5, 2, 7])),
+                (OID_OPGP_SERIAL, (7654321).to_bytes(4, "big")),
+                (OID_OPGP_TOUCH, bytes([TOUCH_MODE.FIXED, 0x20])),
+                (OID_OPGP_SOURCE, b"\0"),
+            ],
+            key_ids=False,
+        )
+        result = parse_attestation(cert)
+        self.assertEqual(7654321, result.serial)
+        self.assertEqual((5, 2, 7), result.version)
+        self.assertIsNone(result.pin_policy)
+        self.assertEqual(TOUCH_MODE.FIXED, result.touch_policy)
+        self.assertFalse(result.generated)
+
+    def test_verify(self):
+        verifier = AttestationVerifier.from_file(self.roots_path)
+        result = verifier.verify(_der(self.attestation), [_der(self.f9), self.ca])
+        self.assertEqual(12345678, result.serial)
+
+        # Intermediates are cached
+        result = verifier.verify(self.attestation)
+        self.assertEqual(12345678, result.serial)
+
+    def test_verify_untrusted(self):
+        verifier = AttestationVerifier.from_file(self.roots_path)
+        # Missing intermediate
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(self.attestation, [self.f9])
+
+        # Signed by a different key, with the same name
+        other_key = _key()
+        attestation = _cert(
+            "PIV Attestation 9a",
+            self.key,
+            "PIV Attestation",
+            other_key,
+            PIV_EXTENSIONS,
+            key_ids=False,
+        )
+        verifier.verify(self.attestation, [self.f9, self.ca])
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(attestation)
+
+        # Intermediate issued by an untrusted root, with the same name
+        other_root = _cert("Root CA", other_key, "Root CA", other_key, ca=True)
+        verifier = AttestationVerifier([_der(other_root)])
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(self.attestation, [self.f9, self.ca])
+
+    def test_verify_signed_by_leaf(self):
+        verifier = AttestationVerifier([self.root])
+        # An attestation signed with the key of a genuine attestation
+        forged = _cert(
+            "Forged Attestation",
+            _key(),
+            "PIV Attestation 9a",
+            self.key,
+            PIV_EXTENSIONS,
+            key_ids=False,
+        )
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(forged, [self.attestation, self.f9, self.ca])
+        # The attestation was not trusted as an issuer
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(forged)
+        self.assertEqual(12345678, verifier.verify(self.attestation).serial)
+
+    def test_verify_path_length(self):
+        verifier = AttestationVerifier([self.root])
+        # One CA more than root, Yubico intermediate and F9 certificate
+        key = _key()
+        sub_ca = _cert("Sub CA", key, "PIV Attestation", self.f9_key, ca=True)
+        attestation = _cert(
+            "PIV Attestation 9a", self.key, "Sub CA", key, PIV_EXTENSIONS
+        )
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(attestation, [sub_ca, self.f9, self.ca])
+
+        # Path length constraint of the intermediate
+        ca = _cert(
+            "Attestation CA", self.ca_key, "Root CA", self.root_key, ca=True, path=0
+        )
+        verifier = AttestationVerifier([self.root])
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(self.attestation, [self.f9, ca])
+
+    def _other_f9(self):
+        # Another YubiKey, with an F9 certificate of the same name
+        f9_key = _key()
+        f9 = _cert("PIV Attestation", f9_key, "Attestation CA", self.ca_key, ca=True)
+        attestation = _cert(
+            "PIV Attestation 9a",
+            _key(),
+            "PIV Attestation",
+            f9_key,
+            PIV_EXTENSIONS,
+            key_ids=False,
+        )
+        return f9, attestation
+
+    def test_verify_given_issuer_first(self):
+        verifier = AttestationVerifier([self.root])
+        for _ in range(5):
+            f9, attestation = self._other_f9()
+            verifier.verify(attestation, [f9, self.ca])
+        verifier.verify(self.attestation, [self.f9, self.ca])
+
+        with mock.patch.object(
+            attestation_module, "_is_signed_by", wraps=attestation_module._is_signed_by
+        ) as is_signed_by:
+            verifier.verify(self.attestation, [self.f9, self.ca])
+        # Only the given F9 certificate is checked, not all cached ones
+        is_signed_by.assert_called_once_with(self.attestation, self.f9)
+
+    def test_cache_size(self):
+        verifier = AttestationVerifier([self.root], cache_size=3)
+        verifier.verify(self.attestation, [self.f9, self.ca])
+        for _ in range(3):
+            f9, attestation = self._other_f9()
+            verifier.verify(attestation, [f9, self.ca])
+        # The least recently used F9 certificate was evicted, the CA is still in use
+        with self.assertRaises(InvalidAttestation):
+            verifier.verify(self.attestation)
+        self.assertEqual(12345678, verifier.verify(self.attestation, [self.f9]).serial)
+
+    def test_root_not_ca(self):
+        root = _cert("Root CA", self.root_key, "Root CA", self.root_key)
+        with self.assertRaises(ValueError):
+            AttestationVerifier([root])
+
+    def test_verify_many(self):
+        verifier = AttestationVerifier([self.root])
+        items = [(_der(self.attestation), [_der(self.f9), _der(self.ca)])] * 10
+        other_key = _key()
+        other_f9 = _cert("Other Attestation", other_key, "Other CA", other_key, ca=True)
+        attestation = _cert(
+            "PIV Attestation 9a",
+            self.key,
+            "Other Attestation",
+            other_key,
+            PIV_EXTENSIONS,
+            key_ids=False,
+        )
+        items.insert(3, (_der(attestation), [_der(other_f9), _der(self.ca)]))
+        items.insert(5, (b"invalid", []))
+        results = verifier.verify_many(items, max_workers=2, chunksize=2)
+
+        self.assertEqual(12, len(results))
+        self.assertIsInstance(results[3], InvalidAttestation)
+        self.assertIsInstance(results[5], InvalidAttestation)
+        for i, result in enumerate(results):
+            if i not in (3, 5):
+                self.assertEqual(12345678, result.serial)
+                self.assertEqual(PIN_POLICY.ALWAYS, result.pin_policy)
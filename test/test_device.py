@@ -0,0 +1,31 @@
+#  vim: set fileencoding=utf-8 :
+
+from ykman.device import get_connection_types
+from yubikit.core import USB_INTERFACE
+from yubikit.core.otp import OtpConnection
+from yubikit.core.fido import FidoConnection
+from yubikit.core.smartcard import SmartCardConnection
+import unittest
+
+
+class TestConnectionTypes(unittest.TestCase):
+    def test_get_connection_types(self):
+        self.assertEqual(
+            [SmartCardConnection, OtpConnection, FidoConnection],
+            get_connection_types(USB_INTERFACE(sum(USB_INTERFACE))),
+        )
+        self.assertEqual(
+            [OtpConnection], get_connection_types(USB_INTERFACE.OTP),
+        )
+
+    def test_preferred(self):
+        interfaces = USB_INTERFACE.OTP | USB_INTERFACE.CCID
+        self.assertEqual(
+            [OtpConnection, SmartCardConnection],
+            get_connection_types(interfaces, [USB_INTERFACE.OTP]),
+        )
+        # Preferred interfaces which can't be used are ignored
+        self.assertEqual(
+            [OtpConnection],
+            get_connection_types(USB_INTERFACE.OTP, [USB_INTERFACE.CCID]),
+        )
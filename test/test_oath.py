@@ -1,13 +1,46 @@
 #  vim: set fileencoding=utf-8 :
 
+from ykman import oath
+from ykman.cli import oath as oath_cli
+from ykman.cli.util import YkmanContextObject
+from ykman.settings import Settings
+from yubikit.core import TRANSPORT, Tlv, ConnectionLostError
+from yubikit.core.smartcard import SmartCardConnection, ApduError, SW
 from yubikit.oath import (
+    OathSession,
     CredentialData,
     OATH_TYPE,
     HASH_ALGORITHM,
+    TAG_NAME,
+    TAG_NAME_LIST,
+    TAG_KEY,
+    TAG_CHALLENGE,
+    TAG_RESPONSE,
+    TAG_TRUNCATED,
+    TAG_HOTP,
+    TAG_TOUCH,
+    TAG_VERSION,
+    INS_LIST,
+    INS_PUT,
+    INS_DELETE,
+    INS_RESET,
+    INS_CALCULATE,
+    INS_CALCULATE_ALL,
     _derive_key,
     _parse_cred_id,
     _format_cred_id,
 )
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, hmac
+from click.testing import CliRunner
+from unittest import mock
+from base64 import b64encode
+from types import SimpleNamespace
+from urllib.parse import quote
+import struct
+import os
+import shutil
+import tempfile
 import unittest
 
 
@@ -106,3 +139,481 @@ class TestOathFunctions(unittest.TestCase):
         self.assertEqual(7, data.digits)
         self.assertEqual(20, data.period)
         self.assertEqual(5, data.counter)
+
+
+class FakeOathConnection(SmartCardConnection):
+    """Minimal OATH applet emulator, recording each APDU sent."""
+
+    def __init__(self):
+        self.credentials = {}  # cred_id -> (oath_type, hash_algorithm, digits, key)
+        self.touch = set()
+        self.apdus = []
+        self.salt = b"saltsalt"
+        self.put_errors = {}  # cred_id -> SW returned by PUT
+        self.version = b"\5\4\3"
+
+    @property
+    def transport(self):
+        return TRANSPORT.USB
+
+    def add(self, cred_id, secret, oath_type=OATH_TYPE.TOTP, digits=6, touch=False):
+        self.credentials[cred_id] = (oath_type, HASH_ALGORITHM.SHA1, digits, secret)
+        if touch:
+            self.touch.add(cred_id)
+
+    def _hmac(self, cred_id, challenge):
+        _, algo, digits, key = self.credentials[cred_id]
+        h = hmac.HMAC(key, getattr(hashes, algo.name)(), default_backend())
+        h.update(challenge)
+        return digits, h.finalize()
+
+    def _calculate_all(self, p2, challenge):
+        resp = b""
+        for cred_id, (oath_type, _, digits, _) in self.credentials.items():
+            resp += Tlv(TAG_NAME, cred_id)
+            if oath_type == OATH_TYPE.HOTP:
+                resp += Tlv(TAG_HOTP, bytes([digits]))
+            elif cred_id in self.touch:
+                resp += Tlv(TAG_TOUCH, bytes([digits]))
+            else:
+                digits, h = self._hmac(cred_id, challenge)
+                if p2:
+                    offset = h[-1] & 0x0F
+                    h = h[offset : offset + 4]
+                resp += Tlv(TAG_TRUNCATED if p2 else TAG_RESPONSE, bytes([digits]) + h)
+        return resp
+
+    def send_and_receive(self, apdu):
+        self.apdus.append(apdu)
+        ins, p2, data = apdu[1], apdu[3], apdu[5:]
+        if ins == 0xA4 and apdu[2] == 0x04:  # SELECT
+            return Tlv(TAG_VERSION, self.version) + Tlv(TAG_NAME, self.salt), SW.OK
+        if ins == INS_CALCULATE_ALL:
+            return self._calculate_all(p2, Tlv.unwrap(TAG_CHALLENGE, data)), SW.OK
+        if ins == INS_CALCULATE:
+            tlvs = Tlv.parse_dict(data)
+            digits, h = self._hmac(tlvs[TAG_NAME], tlvs[TAG_CHALLENGE])
+            if p2:
+                offset = h[-1] & 0x0F
+                return (
+                    Tlv(TAG_TRUNCATED, bytes([digits]) + h[offset : offset + 4]),
+                    SW.OK,
+                )
+            return Tlv(TAG_RESPONSE, bytes([digits]) + h), SW.OK
+        if ins == INS_PUT:
+            tlvs = Tlv.parse_dict(data)
+            if tlvs[TAG_NAME] in self.put_errors:
+                return b"", self.put_errors[tlvs[TAG_NAME]]
+            key = tlvs[TAG_KEY]
+            self.credentials[tlvs[TAG_NAME]] = (
+                OATH_TYPE(key[0] & 0xF0),
+                HASH_ALGORITHM(key[0] & 0x0F),
+                key[1],
+                key[2:],
+            )
+            return b"", SW.OK
+        if ins == INS_DELETE:
+            del self.credentials[Tlv.unwrap(TAG_NAME, data)]
+            return b"", SW.OK
+        if ins == INS_RESET:
+            self.credentials.clear()
+            self.salt = os.urandom(8)
+            return b"", SW.OK
+        if ins == INS_LIST:
+            return (
+                b"".join(
+                    Tlv(TAG_NAME_LIST, bytes([oath_type | algo]) + cred_id)
+                    for cred_id, (oath_type, algo, _, _) in self.credentials.items()
+                ),
+                SW.OK,
+            )
+        return b"", SW.INVALID_INSTRUCTION
+
+
+def _totp(secret, timestamp, period=30, digits=6):
+    h = hmac.HMAC(secret, hashes.SHA1(), default_backend())
+    h.update(struct.pack(">q", timestamp // period))
+    h = h.finalize()
+    offset = h[-1] & 0x0F
+    code = struct.unpack(">I", h[offset : offset + 4])[0] & 0x7FFFFFFF
+    return str(code % 10 ** digits).rjust(digits, "0")
+
+
+class TestOathSession(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeOathConnection()
+        self.session = OathSession(self.conn)
+        self.conn.apdus.clear()
+
+    def _codes(self, entries):
+        return {cred.id: code.value if code else None for cred, code in entries.items()}
+
+    def test_calculate_all_default_period(self):
+        self.conn.add(b"foo", b"secret1")
+        self.conn.add(b"Issuer:bar", b"secret2", digits=8)
+        codes = self._codes(self.session.calculate_all(1234567890))
+        self.assertEqual(1, len(self.conn.apdus))
+        self.assertEqual(_totp(b"secret1", 1234567890), codes[b"foo"])
+        self.assertEqual(_totp(b"secret2", 1234567890, digits=8), codes[b"Issuer:bar"])
+
+    def test_calculate_all_one_apdu_per_period(self):
+        self.conn.add(b"default", b"secret0")
+        self.conn.add(b"60/a", b"secret1")
+        self.conn.add(b"60/b", b"secret2")
+        self.conn.add(b"15/c", b"secret3")
+        self.conn.add(b"15/d", b"secret4", touch=True)
+        self.conn.add(b"hotp", b"secret5", oath_type=OATH_TYPE.HOTP)
+
+        ts = 1234567890
+        codes = self._codes(self.session.calculate_all(ts))
+        self.assertEqual(3, len(self.conn.apdus))
+        self.assertTrue(all(apdu[1] == INS_CALCULATE_ALL for apdu in self.conn.apdus))
+        self.assertEqual(_totp(b"secret0", ts), codes[b"default"])
+        self.assertEqual(_totp(b"secret1", ts, 60), codes[b"60/a"])
+        self.assertEqual(_totp(b"secret2", ts, 60), codes[b"60/b"])
+        self.assertEqual(_totp(b"secret3", ts, 15), codes[b"15/c"])
+        self.assertIsNone(codes[b"15/d"])
+        self.assertIsNone(codes[b"hotp"])
+
+    def test_calculate_all_valid_period(self):
+        self.conn.add(b"60/a", b"secret1")
+        entries = self.session.calculate_all(1234567890)
+        code = next(iter(entries.values()))
+        self.assertEqual(1234567860, code.valid_from)
+        self.assertEqual(1234567920, code.valid_to)
+
+    def test_calculate_all_responses_full(self):
+        self.conn.add(b"foo", b"secret1")
+        self.conn.add(b"60/bar", b"secret2")
+        responses = self.session.calculate_all_responses(1234567890, truncate=False)
+        self.assertEqual(2, len(self.conn.apdus))
+        self.assertTrue(all(apdu[3] == 0 for apdu in self.conn.apdus))
+        for response in responses.values():
+            self.assertEqual(6, response[0])
+            self.assertEqual(20, len(response[1:]))
+
+    def test_calculate_all_steam(self):
+        self.conn.add(b"Steam:user", b"secret1", digits=6)
+        self.conn.add(b"Issuer:bar", b"secret2")
+        ts = 1234567890
+        codes = self._codes(oath.calculate_all(self.session, ts))
+        self.assertEqual(1, len(self.conn.apdus))
+        self.assertEqual(_totp(b"secret2", ts), codes[b"Issuer:bar"])
+
+        steam = codes[b"Steam:user"]
+        self.assertEqual(5, len(steam))
+        self.assertTrue(all(c in oath.STEAM_CHAR_TABLE for c in steam))
+
+        cred = next(c for c in self.session.list_credentials() if oath.is_steam(c))
+        self.assertEqual(steam, oath.calculate_steam(self.session, cred, ts))
+
+    def test_put_credentials(self):
+        self.conn.add(b"Issuer:existing", b"secret1")
+        datas = [
+            CredentialData("existing", OATH_TYPE.TOTP, HASH_ALGORITHM.SHA1, b"a" * 10),
+            CredentialData("new", OATH_TYPE.TOTP, HASH_ALGORITHM.SHA1, b"b" * 10),
+            CredentialData("new", OATH_TYPE.TOTP, HASH_ALGORITHM.SHA1, b"c" * 10),
+        ]
+        datas[0].issuer = "Issuer"
+        results = list(self.session.put_credentials(datas))
+        self.assertEqual([INS_LIST, INS_PUT], [apdu[1] for apdu in self.conn.apdus])
+        self.assertIsNone(results[0][1])
+        self.assertEqual(b"new", results[1][1].id)
+        self.assertIsNone(results[2][1])
+        self.assertEqual(b"secret1", self.conn.credentials[b"Issuer:existing"][3])
+
+        self.conn.apdus.clear()
+        results = list(self.session.put_credentials(datas, overwrite=True))
+        self.assertEqual(4, len(self.conn.apdus))
+        self.assertTrue(all(cred for _, cred in results))
+        self.assertEqual(b"c" * 10 + b"\0" * 4, self.conn.credentials[b"new"][3])
+
+    def test_put_credentials_failure(self):
+        datas = [
+            CredentialData(n, OATH_TYPE.TOTP, HASH_ALGORITHM.SHA1, b"a" * 10)
+            for n in ("a", "b", "c")
+        ]
+        self.conn.put_errors[b"b"] = SW.NO_SPACE
+        results = self.session.put_credentials(datas, existing_ids=[])
+        self.assertEqual(b"a", next(results)[1].id)
+        with self.assertRaises(ApduError) as cm:
+            next(results)
+        self.assertEqual(SW.NO_SPACE, cm.exception.sw)
+        self.assertEqual([INS_PUT] * 2, [apdu[1] for apdu in self.conn.apdus])
+
+
+class TestParseCredentials(unittest.TestCase):
+    def test_parse_uri_list(self):
+        creds = oath.parse_credentials(
+            "otpauth://totp/Test:account?secret=abba\n\n"
+            "otpauth://hotp/other?secret=abbaabba&counter=3\n"
+        )
+        self.assertEqual(2, len(creds))
+        self.assertEqual(b"Test:account", creds[0].get_id())
+        self.assertEqual(OATH_TYPE.HOTP, creds[1].oath_type)
+        self.assertEqual(3, creds[1].counter)
+
+    def test_parse_json(self):
+        creds = oath.parse_credentials(
+            '["otpauth://totp/Test:account?secret=abba", '
+            '{"name": "Issuer:name", "secret": "abba", "period": 60, '
+            '"algorithm": "sha256", "digits": 8}]'
+        )
+        self.assertEqual(2, len(creds))
+        self.assertEqual("Issuer", creds[1].issuer)
+        self.assertEqual("name", creds[1].name)
+        self.assertEqual(60, creds[1].period)
+        self.assertEqual(HASH_ALGORITHM.SHA256, creds[1].hash_algorithm)
+        self.assertEqual(8, creds[1].digits)
+
+    def test_parse_csv(self):
+        creds = oath.parse_credentials(
+            "name,secret,issuer,type,counter\n"
+            "account,abba,Test,,\n"
+            "other,abbaabba,,hotp,5\n"
+        )
+        self.assertEqual(2, len(creds))
+        self.assertEqual(b"Test:account", creds[0].get_id())
+        self.assertEqual(OATH_TYPE.TOTP, creds[0].oath_type)
+        self.assertIsNone(creds[1].issuer)
+        self.assertEqual(OATH_TYPE.HOTP, creds[1].oath_type)
+        self.assertEqual(5, creds[1].counter)
+
+    def test_parse_invalid(self):
+        with self.assertRaises(ValueError):
+            oath.parse_credentials("name,secret\naccount,\n")
+        with self.assertRaises(ValueError):
+            oath.parse_credentials('[{"name": "account"}]')
+
+    def test_parse_migration_uri(self):
+        def field(num, value):
+            if isinstance(value, int):
+                return bytes([num << 3, value])
+            return bytes([num << 3 | 2, len(value)]) + value
+
+        otp1 = field(1, b"secret1") + field(2, b"Issuer:account") + field(6, 2)
+        otp2 = (
+            field(1, b"secret2")
+            + field(2, b"other")
+            + field(3, b"Other")
+            + field(4, 2)
+            + field(5, 2)
+            + field(6, 1)
+            + field(7, 7)
+        )
+        data = field(1, otp1) + field(1, otp2) + field(2, 1)
+        uri = "otpauth-migration://offline?data=" + quote(b64encode(data))
+        creds = oath.parse_credentials(uri)
+        self.assertEqual(2, len(creds))
+        self.assertEqual(b"Issuer:account", creds[0].get_id())
+        self.assertEqual(b"secret1", creds[0].secret)
+        self.assertEqual(OATH_TYPE.TOTP, creds[0].oath_type)
+        self.assertEqual(b"Other:other", creds[1].get_id())
+        self.assertEqual(OATH_TYPE.HOTP, creds[1].oath_type)
+        self.assertEqual(HASH_ALGORITHM.SHA256, creds[1].hash_algorithm)
+        self.assertEqual(8, creds[1].digits)
+        self.assertEqual(7, creds[1].counter)
+
+
+def _invoke(conn, *args, serial=123456, input=None):
+    obj = YkmanContextObject()
+    obj.add_resolver("conn", lambda: conn)
+    obj.add_resolver("info", lambda: SimpleNamespace(serial=serial))
+    return CliRunner().invoke(oath_cli.oath, list(args), obj=obj, input=input)
+
+
+class CliTestCase(unittest.TestCase):
+    def setUp(self):
+        # Settings are read from ./.ykman when it exists
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        os.mkdir(".ykman")
+        self.conn = FakeOathConnection()
+        self.conn.add(b"Issuer:foo", b"secret1")
+        self.conn.add(b"bar", b"secret2")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def invoke(self, *args, **kwargs):
+        result = _invoke(self.conn, *args, **kwargs)
+        if result.exception and not isinstance(result.exception, SystemExit):
+            raise result.exception
+        return result
+
+    def cache(self):
+        return Settings(oath_cli.CACHE_NAME)
+
+
+class TestCredentialCache(CliTestCase):
+    def cached_ids(self):
+        return {k: [c["id"] for c in e["credentials"]] for k, e in self.cache().items()}
+
+    def test_list_updates_cache(self):
+        self.invoke("list")
+        device_id = OathSession(self.conn).info.device_id
+        self.assertEqual({device_id: ["Issuer:foo", "bar"]}, self.cached_ids())
+
+        self.conn.apdus.clear()
+        result = self.invoke("list", "--cached")
+        self.assertEqual("bar\nIssuer:foo\n", result.output)
+        self.assertEqual([], self.conn.apdus)
+
+    def test_delete_updates_cache(self):
+        self.invoke("list")
+        self.invoke("delete", "bar", "-f")
+        self.assertEqual([["Issuer:foo"]], list(self.cached_ids().values()))
+
+    def test_reset_forgets_cache(self):
+        self.invoke("list")
+        self.invoke("reset", "-f")
+        self.assertEqual({}, self.cached_ids())
+
+    def test_salt_change_invalidates_cache(self):
+        self.invoke("list")
+        # Reset by another program, which changes the salt
+        self.conn.send_and_receive(bytes([0, INS_RESET, 0xDE, 0xAD]))
+        self.conn.add(b"new", b"secret3")
+
+        self.invoke("info")  # Only connects
+        self.assertEqual({}, self.cached_ids())
+
+        self.invoke("list")
+        self.assertEqual([["new"]], list(self.cached_ids().values()))
+        result = self.invoke("list", "--cached")
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual("new\n", result.output)
+
+    def test_changes_by_other_programs(self):
+        self.invoke("list")
+        # Added by another program, only seen once the credentials are read again
+        self.conn.add(b"new", b"secret3")
+        self.assertEqual("bar\nIssuer:foo\n", self.invoke("list", "--cached").output)
+        self.invoke("code")
+        self.assertEqual(
+            "bar\nIssuer:foo\nnew\n", self.invoke("list", "--cached").output
+        )
+
+    def test_update_replaces_entries_for_serial(self):
+        cache = self.cache()
+        cache["old-id"] = {"serial": 123456, "credentials": []}
+        cache["other-id"] = {"serial": 654321, "credentials": []}
+        cache.write()
+        self.invoke("list")
+        device_id = OathSession(self.conn).info.device_id
+        self.assertEqual({device_id, "other-id"}, set(self.cache()))
+
+
+class RemovableOathConnection(FakeOathConnection):
+    def __init__(self):
+        super(RemovableOathConnection, self).__init__()
+        self.removed = False
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def send_and_receive(self, apdu):
+        if self.removed:
+            raise ConnectionLostError("Card was removed")
+        return super(RemovableOathConnection, self).send_and_receive(apdu)
+
+
+class TestWatchCodes(CliTestCase):
+    def setUp(self):
+        super(TestWatchCodes, self).setUp()
+        old_conn = self.conn
+        self.conn = RemovableOathConnection()
+        self.conn.credentials = old_conn.credentials
+        self.new_conn = RemovableOathConnection()
+        self.new_conn.credentials = old_conn.credentials
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if len(self.sleeps) == 1:
+            self.conn.removed = True
+        elif len(self.sleeps) == 4:
+            raise KeyboardInterrupt()
+
+    def test_reconnect(self):
+        connects = [ValueError("Not found"), self.new_conn]
+
+        def connect(serial, connection_types):
+            self.assertEqual(123456, serial)
+            result = connects.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result, None, None
+
+        with mock.patch.object(oath_cli, "sleep", self.sleep), mock.patch.object(
+            oath_cli, "connect_to_device", connect
+        ):
+            result = self.invoke("code", "--watch")
+
+        self.assertEqual(0, result.exit_code)
+        self.assertEqual(2, result.output.count("Issuer:foo"))
+        self.assertIn("Waiting for YubiKey...", result.output)
+        self.assertLessEqual(self.sleeps[0], 30)
+        self.assertEqual([0.5, 0.5], self.sleeps[1:3])
+        self.assertTrue(self.conn.closed)
+        self.assertTrue(self.new_conn.closed)
+        self.assertTrue(
+            any(apdu[1] == INS_CALCULATE_ALL for apdu in self.new_conn.apdus)
+        )
+
+    def test_other_errors_not_retried(self):
+        with mock.patch.object(
+            oath_cli, "calculate_all", side_effect=RuntimeError("Bug")
+        ), mock.patch.object(oath_cli, "sleep", self.sleep):
+            with self.assertRaises(RuntimeError):
+                self.invoke("code", "--watch")
+        self.assertEqual([], self.sleeps)
+        self.assertTrue(self.conn.closed)
+
+
+class TestImportCredentials(CliTestCase):
+    def test_import_continues_after_failure(self):
+        self.conn.put_errors[b"b"] = SW.INCORRECT_PARAMETERS
+        self.conn.apdus.clear()
+        uris = "".join(
+            "otpauth://totp/{}?secret=abba\n".format(n) for n in ("a", "b", "c")
+        )
+        result = _invoke(self.conn, "import", "-", input=uris)
+        self.assertEqual(1, result.exit_code)
+        self.assertIn("Failed b: The YubiKey returned an error (6a80).", result.output)
+        self.assertIn("Added 2 of 3 credentials.", result.output)
+        self.assertIn(b"c", self.conn.credentials)
+        self.assertEqual(1, [apdu[1] for apdu in self.conn.apdus].count(INS_LIST))
+
+        cached = [c["id"] for e in self.cache().values() for c in e["credentials"]]
+        self.assertEqual(["Issuer:foo", "a", "bar", "c"], cached)
+
+    def test_import_stops_when_full(self):
+        self.conn.put_errors[b"b"] = SW.NO_SPACE
+        self.conn.apdus.clear()
+        uris = "".join(
+            "otpauth://totp/{}?secret=abba\n".format(n) for n in ("a", "b", "c")
+        )
+        result = _invoke(self.conn, "import", "-", input=uris)
+        self.assertEqual(1, result.exit_code)
+        self.assertIn("Failed b: No space left", result.output)
+        self.assertIn("Failed c: No space left", result.output)
+        self.assertIn("Added 1 of 3 credentials.", result.output)
+        # Nothing more is sent once the YubiKey is full
+        self.assertEqual(2, [apdu[1] for apdu in self.conn.apdus].count(INS_PUT))
+
+    def test_import_old_firmware_lists_once(self):
+        self.conn.version = b"\4\3\1"
+        self.conn.apdus.clear()
+        result = _invoke(
+            self.conn,
+            "import",
+            "-",
+            input="otpauth://totp/ba?secret=abba\notpauth://totp/new?secret=abba\n",
+        )
+        self.assertIn("Failed ba: Name is a subset", result.output)
+        self.assertIn("Added 1 of 2 credentials.", result.output)
+        self.assertEqual(1, [apdu[1] for apdu in self.conn.apdus].count(INS_LIST))
@@ -0,0 +1,585 @@
+#  vim: set fileencoding=utf-8 :
+
+from ykman.cli import opgp as opgp_cli
+from ykman.cli.util import YkmanContextObject
+from ykman.opgp import (
+    OpgpController,
+    ApplicationData,
+    Kdf,
+    KdfAlgorithm,
+    HashAlgorithm,
+    KEY_SLOT,
+    TOUCH_MODE,
+    PIN_POLICY,
+    INS,
+    DO,
+    PW1,
+    PW1_EXTENDED,
+    PW3,
+    OID,
+    calculate_fingerprint,
+    format_public_key_packet,
+    _get_key_attributes,
+)
+from yubikit.core import TRANSPORT, Tlv
+from yubikit.core.smartcard import (
+    SmartCardConnection,
+    SmartCardProtocol,
+    ApduError,
+    SW,
+)
+from cryptography.utils import int_to_bytes, int_from_bytes
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    PublicFormat,
+    load_pem_private_key,
+)
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519, x25519, padding
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    Prehashed,
+    decode_dss_signature,
+)
+from click.testing import CliRunner
+from .util import open_file
+import hashlib
+import struct
+import unittest
+
+
+def _kdf_data(iteration_count, hash_algorithm=HashAlgorithm.SHA256):
+    return (
+        Tlv(0x81, KdfAlgorithm.KDF_ITERSALTED_S2K)
+        + Tlv(0x82, hash_algorithm)
+        + Tlv(0x83, struct.pack(">I", iteration_count))
+        + Tlv(0x84, b"pw1-salt")
+        + Tlv(0x85, b"pw2-salt")
+        + Tlv(0x86, b"pw3-salt")
+        + Tlv(0x87, b"")
+        + Tlv(0x88, b"")
+    )
+
+
+def _s2k(name, salt, pin, iteration_count):
+    # Straightforward implementation, as described in RFC 4880
+    data = salt + pin
+    repeated = data * (iteration_count // len(data) + 1)
+    return hashlib.new(name, repeated[:iteration_count]).digest()
+
+
+class FakeOpgpConnection(SmartCardConnection):
+    """Minimal OpenPGP applet emulator, recording each APDU sent."""
+
+    def __init__(self, kdf=None):
+        self.kdf = kdf
+        self.version = b"\x05\x02\x07"
+        self.pins = {PW1: b"123456", PW3: b"12345678"}
+        if kdf is not None:
+            self.pins = {pw: Kdf(kdf).process(pw, pin) for pw, pin in self.pins.items()}
+        self.retries = {PW1: 3, PW3: 3}
+        self.verified = set()
+        self.pin_policy = PIN_POLICY.ONCE
+        self.keys = {}
+        self.objects = {
+            DO.AID: bytes.fromhex("d2760001240103040006123456780000"),
+            DO.NAME: b"Doe<<John",
+            DO.FINGERPRINTS: b"\0" * 60,
+            DO.GENERATION_TIMES: b"\0" * 12,
+        }
+        for key_slot in KEY_SLOT:
+            self.objects[key_slot.uif] = bytes([TOUCH_MODE.OFF, 0x20])
+        self.apdus = []
+
+    @property
+    def transport(self):
+        return TRANSPORT.USB
+
+    def count(self, ins, p2=None):
+        return sum(
+            1 for apdu in self.apdus if apdu[1] == ins and (p2 is None or apdu[3] == p2)
+        )
+
+    def add_key(self, key_slot, key):
+        self.keys[key_slot] = key
+        self.objects[key_slot.key_id] = _get_key_attributes(key, key_slot)
+
+    def send_and_receive(self, apdu):
+        self.apdus.append(apdu)
+        ins, p1, p2 = apdu[1:4]
+        data = apdu[7:] if len(apdu) > 5 and apdu[4] == 0 else apdu[5:]
+        if ins == 0xA4:  # SELECT
+            return b"", SW.OK
+        if ins == INS.GET_VERSION:
+            return self.version, SW.OK
+        if ins == INS.GET_DATA:
+            return self._get_data(p1 << 8 | p2)
+        if ins == INS.VERIFY:
+            pw = PW1 if p2 == PW1_EXTENDED else p2
+            if self.pins[pw] == data:
+                self.verified.add(p2)
+                self.retries[pw] = 3
+                return b"", SW.OK
+            self.retries[pw] -= 1
+            return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+        if ins == INS.PSO and (p1, p2) == (0x9E, 0x9A):
+            if PW1 not in self.verified:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            if self.pin_policy == PIN_POLICY.ALWAYS:
+                self.verified.discard(PW1)
+            return self._sign(self.keys[KEY_SLOT.SIG], data), SW.OK
+        if ins == INS.INTERNAL_AUTHENTICATE:
+            if PW1_EXTENDED not in self.verified:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            return self._sign(self.keys[KEY_SLOT.AUT], data), SW.OK
+        if ins == INS.GENERATE_ASYM and p1 == 0x80:
+            if PW3 not in self.verified:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            key_slot = next(k for k in KEY_SLOT if k.crt == data)
+            return self._generate(key_slot), SW.OK
+        if ins == INS.PSO and (p1, p2) == (0x80, 0x86):
+            if PW1_EXTENDED not in self.verified:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            return self._decipher(self.keys[KEY_SLOT.ENC], data), SW.OK
+        if ins == INS.PUT_DATA:
+            if PW3 not in self.verified:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            do = p1 << 8 | p2
+            if do == DO.KDF:
+                self.kdf = data
+            else:
+                self.objects[do] = data
+            for key_slot in (KEY_SLOT.SIG, KEY_SLOT.ENC, KEY_SLOT.AUT):
+                if do == key_slot.fingerprint:
+                    self._update_list(DO.FINGERPRINTS, key_slot, data)
+                elif do == key_slot.gen_time:
+                    self._update_list(DO.GENERATION_TIMES, key_slot, data)
+            return b"", SW.OK
+        return b"", SW.INS_NOT_SUPPORTED
+
+    def _get_data(self, do):
+        if do == DO.KDF:
+            if self.kdf is None:
+                return b"", SW.FILE_NOT_FOUND
+            return self.kdf, SW.OK
+        if do == DO.PW_STATUS:
+            return self._pw_status(), SW.OK
+        if do == DO.APPLICATION_DATA:
+            discretionary = Tlv(DO.PW_STATUS, self._pw_status())
+            for tag in (DO.FINGERPRINTS, DO.GENERATION_TIMES) + tuple(
+                key_slot.uif for key_slot in KEY_SLOT
+            ):
+                discretionary += Tlv(tag, self.objects[tag])
+            for key_slot in self.keys:
+                discretionary += Tlv(key_slot.key_id, self.objects[key_slot.key_id])
+            data = (
+                Tlv(DO.AID, self.objects[DO.AID])
+                + Tlv(0x5F52, b"\x00\x73\x00\x00\xe0\x05\x90\x00")
+                + Tlv(0x7F74, Tlv(0x81, b"\x20"))
+                + Tlv(0x73, discretionary)
+            )
+            return Tlv(DO.APPLICATION_DATA, data), SW.OK
+        if do == DO.CARDHOLDER_DATA:
+            data = (
+                Tlv(DO.NAME, self.objects[DO.NAME])
+                + Tlv(DO.LANGUAGE, b"en")
+                + Tlv(DO.SEX, b"9")
+            )
+            return Tlv(DO.CARDHOLDER_DATA, data), SW.OK
+        if do in self.objects:
+            return self.objects[do], SW.OK
+        return b"", SW.FILE_NOT_FOUND
+
+    def _update_list(self, do, key_slot, data):
+        # The fingerprints and generation times are also read as lists of all keys
+        offset = (key_slot.index - 1) * len(data)
+        value = self.objects[do]
+        self.objects[do] = value[:offset] + data + value[offset + len(data) :]
+
+    def _pw_status(self):
+        retries = bytes([self.retries[PW1], 3, self.retries[PW3]])
+        return bytes([self.pin_policy]) + b"\x7f\x7f\x7f" + retries
+
+    def _generate(self, key_slot):
+        attributes = self.objects[key_slot.key_id]
+        if attributes[0] == 0x01:
+            key_size = struct.unpack(">H", attributes[1:3])[0]
+            key = rsa.generate_private_key(65537, key_size, default_backend())
+            numbers = key.public_key().public_numbers()
+            data = Tlv(0x81, int_to_bytes(numbers.n)) + Tlv(
+                0x82, int_to_bytes(numbers.e)
+            )
+        else:
+            curve_name = OID(attributes[1:]).name.lower()
+            if curve_name == "ed25519":
+                key = ed25519.Ed25519PrivateKey.generate()
+            elif curve_name == "x25519":
+                key = x25519.X25519PrivateKey.generate()
+            else:
+                curve = getattr(ec, curve_name.upper())()
+                key = ec.generate_private_key(curve, default_backend())
+            if isinstance(key, ec.EllipticCurvePrivateKey):
+                point = key.public_key().public_bytes(
+                    Encoding.X962, PublicFormat.UncompressedPoint
+                )
+            else:
+                point = key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+            data = Tlv(0x86, point)
+        self.add_key(key_slot, key)
+        return Tlv(0x7F49, data)
+
+    def _sign(self, key, data):
+        if isinstance(key, rsa.RSAPrivateKey):
+            # EMSA-PKCS1-v1_5 padding of the DigestInfo, then a raw RSA operation
+            ln = key.key_size // 8
+            padded = b"\0\1" + b"\xff" * (ln - len(data) - 3) + b"\0" + data
+            numbers = key.private_numbers()
+            return int_to_bytes(
+                pow(
+                    int_from_bytes(padded, "big"),
+                    numbers.d,
+                    key.public_key().public_numbers().n,
+                ),
+                ln,
+            )
+        if isinstance(key, ec.EllipticCurvePrivateKey):
+            hash_algorithm = {32: hashes.SHA256, 48: hashes.SHA384}[len(data)]()
+            r, s = decode_dss_signature(
+                key.sign(data, ec.ECDSA(Prehashed(hash_algorithm)))
+            )
+            ln = key.key_size // 8
+            return int_to_bytes(r, ln) + int_to_bytes(s, ln)
+        return key.sign(data)
+
+    def _decipher(self, key, data):
+        if isinstance(key, rsa.RSAPrivateKey):
+            assert data[0] == 0  # Padding indicator
+            return key.decrypt(data[1:], padding.PKCS1v15())
+        point = Tlv.unwrap(0x86, Tlv.unwrap(0x7F49, Tlv.unwrap(0xA6, data)))
+        if isinstance(key, ec.EllipticCurvePrivateKey):
+            peer = ec.EllipticCurvePublicKey.from_encoded_point(key.curve, point)
+            return key.exchange(ec.ECDH(), peer)
+        return key.exchange(x25519.X25519PublicKey.from_public_bytes(point))
+
+
+class TestKdf(unittest.TestCase):
+    def test_itersalted_s2k(self):
+        for name, hash_algorithm in (
+            ("sha256", HashAlgorithm.SHA256),
+            ("sha512", HashAlgorithm.SHA512),
+        ):
+            for count in (1, 13, 0x10000, 0x10003, 0x20000 + 5):
+                kdf = Kdf(_kdf_data(count, hash_algorithm))
+                for pin in (b"123456", b"12345678", b"a" * 127):
+                    self.assertEqual(
+                        _s2k(name, b"pw1-salt", pin, count), kdf.process(PW1, pin)
+                    )
+                    self.assertEqual(
+                        _s2k(name, b"pw3-salt", pin, count), kdf.process(PW3, pin)
+                    )
+
+    def test_itersalted_s2k_default_count(self):
+        kdf = Kdf(_kdf_data(0x02000000))
+        self.assertEqual(
+            _s2k("sha256", b"pw1-salt", b"123456", 0x02000000),
+            kdf.process(PW1, b"123456"),
+        )
+
+
+class TestOpgpController(unittest.TestCase):
+    def test_verify_without_kdf(self):
+        conn = FakeOpgpConnection()
+        controller = OpgpController(SmartCardProtocol(conn))
+        controller.verify_pin("123456")
+        controller.verify_admin("12345678")
+        self.assertEqual({PW1, PW3}, conn.verified)
+        self.assertEqual(1, conn.count(INS.GET_DATA, DO.KDF))
+
+    def test_kdf_read_once(self):
+        conn = FakeOpgpConnection(_kdf_data(0x10000))
+        controller = OpgpController(SmartCardProtocol(conn))
+        controller.verify_pin("123456")
+        controller.verify_admin("12345678")
+        controller.verify_pin("123456")
+        self.assertEqual({PW1, PW3}, conn.verified)
+        self.assertEqual(1, conn.count(INS.GET_DATA, DO.KDF))
+
+        with self.assertRaises(ValueError):
+            controller.verify_pin("654321")
+        self.assertEqual(2, conn.retries[PW1])
+
+    def test_kdf_changed(self):
+        conn = FakeOpgpConnection()
+        controller = OpgpController(SmartCardProtocol(conn))
+        controller.verify_admin("12345678")
+
+        kdf = _kdf_data(0x10000)
+        controller._put_data(DO.KDF, kdf)
+        conn.pins = {pw: Kdf(kdf).process(pw, pin) for pw, pin in conn.pins.items()}
+        conn.verified.clear()
+
+        controller.verify_pin("123456")
+        self.assertEqual({PW1}, conn.verified)
+        self.assertEqual(2, conn.count(INS.GET_DATA, DO.KDF))
+
+
+class TestApplicationData(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeOpgpConnection()
+        self.controller = OpgpController(SmartCardProtocol(self.conn))
+
+    def test_read_once(self):
+        self.assertEqual((3, 4), self.controller.get_openpgp_version())
+        self.assertEqual((3, 3, 3), self.controller.get_remaining_pin_tries())
+        for key_slot in KEY_SLOT:
+            self.assertEqual(TOUCH_MODE.OFF, self.controller.get_touch(key_slot))
+        self.assertEqual(b"\0" * 20, self.controller.get_fingerprint(KEY_SLOT.ENC))
+        self.assertEqual(0, self.controller.get_generation_time(KEY_SLOT.AUT))
+
+        data = self.controller.get_application_data()
+        self.assertEqual(b"Doe<<John", data.name)
+        self.assertEqual(b"en", data.language)
+        self.assertEqual(1, self.conn.count(INS.GET_DATA, DO.APPLICATION_DATA))
+        self.assertEqual(1, self.conn.count(INS.GET_DATA, DO.CARDHOLDER_DATA))
+        self.assertEqual(2, self.conn.count(INS.GET_DATA))
+        self.assertIs(data, self.controller.get_application_data())
+
+    def test_invalidated(self):
+        with self.assertRaises(ValueError):
+            self.controller.verify_admin("00000000")
+        self.assertEqual((3, 3, 2), self.controller.get_remaining_pin_tries())
+
+        self.controller.verify_admin("12345678")
+        self.assertEqual((3, 3, 3), self.controller.get_remaining_pin_tries())
+        self.controller.set_touch(KEY_SLOT.SIG, TOUCH_MODE.FIXED)
+        self.assertEqual(TOUCH_MODE.FIXED, self.controller.get_touch(KEY_SLOT.SIG))
+
+    def test_immutable(self):
+        data = self.controller.get_application_data()
+        with self.assertRaises(AttributeError):
+            data.foo = 1
+        with self.assertRaises(TypeError):
+            data._objects[DO.NAME] = b"Other"
+
+    def test_without_touch(self):
+        # Older YubiKeys don't include UIF in the application related data
+        data = ApplicationData(
+            Tlv(
+                DO.APPLICATION_DATA,
+                Tlv(DO.AID, bytes(16)) + Tlv(0x73, Tlv(DO.PW_STATUS, bytes(7))),
+            )
+        )
+        self.assertIsNone(data.get_touch(KEY_SLOT.SIG))
+        self.assertIsNone(data.get_fingerprint(KEY_SLOT.SIG))
+        self.assertIsNone(data.get_generation_time(KEY_SLOT.SIG))
+        self.assertIsNone(data.name)
+
+
+def _digests(n, hash_algorithm=hashes.SHA256):
+    digests = []
+    for i in range(n):
+        h = hashes.Hash(hash_algorithm(), default_backend())
+        h.update(struct.pack(">I", i))
+        digests.append(h.finalize())
+    return digests
+
+
+class TestKeyOperations(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeOpgpConnection()
+        self.controller = OpgpController(SmartCardProtocol(self.conn))
+
+    def test_sign_rsa(self):
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        self.conn.add_key(KEY_SLOT.SIG, key)
+        self.controller.verify_pin("123456")
+        signature = self.controller.sign(b"message", hashes.SHA384())
+        key.public_key().verify(
+            signature, b"message", padding.PKCS1v15(), hashes.SHA384()
+        )
+
+    def test_sign_ec(self):
+        key = ec.generate_private_key(ec.SECP384R1(), default_backend())
+        self.conn.add_key(KEY_SLOT.SIG, key)
+        self.controller.verify_pin("123456")
+        signature = self.controller.sign(b"message", hashes.SHA384())
+        key.public_key().verify(signature, b"message", ec.ECDSA(hashes.SHA384()))
+
+    def test_sign_requires_pin(self):
+        self.conn.add_key(KEY_SLOT.SIG, ed25519.Ed25519PrivateKey.generate())
+        with self.assertRaises(ApduError):
+            self.controller.sign(b"message")
+
+    def test_sign_many_pin_once(self):
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.conn.add_key(KEY_SLOT.SIG, key)
+        digests = _digests(5)
+        signatures = list(
+            self.controller.sign_many(digests, hashes.SHA256(), pin="123456")
+        )
+        for digest, signature in zip(digests, signatures):
+            key.public_key().verify(
+                signature, digest, ec.ECDSA(Prehashed(hashes.SHA256()))
+            )
+        self.assertEqual(1, self.conn.count(INS.VERIFY))
+        self.assertEqual(5, self.conn.count(INS.PSO))
+        self.assertEqual(1, self.conn.count(INS.GET_DATA, DO.APPLICATION_DATA))
+
+    def test_sign_many_pin_always(self):
+        key = ed25519.Ed25519PrivateKey.generate()
+        self.conn.add_key(KEY_SLOT.SIG, key)
+        self.conn.pin_policy = PIN_POLICY.ALWAYS
+        digests = _digests(5)
+        signatures = list(
+            self.controller.sign_many(digests, hashes.SHA256(), pin="123456")
+        )
+        for digest, signature in zip(digests, signatures):
+            key.public_key().verify(signature, digest)
+        self.assertEqual(5, self.conn.count(INS.VERIFY))
+        self.assertEqual(1, self.conn.count(INS.GET_DATA, DO.APPLICATION_DATA))
+
+    def test_sign_many_lazy(self):
+        self.conn.add_key(KEY_SLOT.SIG, ed25519.Ed25519PrivateKey.generate())
+        signatures = self.controller.sign_many(_digests(3), hashes.SHA256(), "123456")
+        self.assertEqual(0, self.conn.count(INS.PSO))
+        next(signatures)
+        self.assertEqual(1, self.conn.count(INS.PSO))
+
+    def test_authenticate(self):
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        self.conn.add_key(KEY_SLOT.AUT, key)
+        with self.assertRaises(ApduError):
+            self.controller.authenticate(b"challenge")
+        self.controller.verify_pin("123456", extended=True)
+        signature = self.controller.authenticate(b"challenge")
+        key.public_key().verify(
+            signature, b"challenge", padding.PKCS1v15(), hashes.SHA256()
+        )
+
+    def test_decrypt(self):
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        self.conn.add_key(KEY_SLOT.ENC, key)
+        cipher_text = key.public_key().encrypt(b"secret", padding.PKCS1v15())
+        self.controller.verify_pin("123456", extended=True)
+        self.assertEqual(b"secret", self.controller.decrypt(cipher_text))
+
+    def test_calculate_secret(self):
+        for key, peer in (
+            (
+                ec.generate_private_key(ec.SECP256R1(), default_backend()),
+                ec.generate_private_key(ec.SECP256R1(), default_backend()),
+            ),
+            (x25519.X25519PrivateKey.generate(), x25519.X25519PrivateKey.generate()),
+        ):
+            self.conn.add_key(KEY_SLOT.ENC, key)
+            self.controller._application_data = None
+            self.controller.verify_pin("123456", extended=True)
+            secret = self.controller.calculate_secret(peer.public_key())
+            if isinstance(peer, ec.EllipticCurvePrivateKey):
+                expected = peer.exchange(ec.ECDH(), key.public_key())
+            else:
+                expected = peer.exchange(key.public_key())
+            self.assertEqual(expected, secret)
+
+            with self.assertRaises(ValueError):
+                self.controller.decrypt(b"\0" * 256)
+
+
+class TestSignCommand(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeOpgpConnection()
+        self.key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.conn.add_key(KEY_SLOT.SIG, self.key)
+
+    def invoke(self, *args, input=None):
+        obj = YkmanContextObject()
+        obj.add_resolver("conn", lambda: self.conn)
+        return CliRunner().invoke(
+            opgp_cli.openpgp,
+            ["sign", "-P", "123456"] + list(args),
+            obj=obj,
+            input=input,
+        )
+
+    def test_sign_batch(self):
+        digests = _digests(3)
+        result = self.invoke(
+            "--batch", "-", "-", input="".join(d.hex() + "\n" for d in digests)
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn("Signed 3 digest(s)", result.output)
+        self.assertEqual(3, self.conn.count(INS.PSO))
+
+    def test_sign_without_touch_policies(self):
+        # Touch policies are only available on YubiKey 4.2 and later
+        self.conn.version = b"\x04\x01\x00"
+        result = self.invoke("-", "-", input="message")
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertNotIn("Touch your YubiKey", result.output)
+        signature = bytes.fromhex(result.output.strip())
+        self.key.public_key().verify(signature, b"message", ec.ECDSA(hashes.SHA256()))
+
+    def test_sign_invalid_digest(self):
+        result = self.invoke("--batch", "-", "-", input="00\n")
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIn("Invalid digest length on line 1", result.output)
+        self.assertEqual(0, self.conn.count(INS.PSO))
+
+
+class TestKeyGeneration(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeOpgpConnection()
+        self.controller = OpgpController(SmartCardProtocol(self.conn))
+
+    def test_fingerprint(self):
+        # Reference values calculated by GnuPG
+        key = ed25519.Ed25519PrivateKey.from_private_bytes(bytes(range(32)))
+        self.assertEqual(
+            bytes.fromhex("58207696FAFB7527B1F73ED4DF5480913743332E"),
+            calculate_fingerprint(KEY_SLOT.SIG, key.public_key(), 1600000000),
+        )
+        with open_file("rsa_2048_key.pem") as f:
+            key = load_pem_private_key(f.read(), None, default_backend())
+        self.assertEqual(
+            bytes.fromhex("B18797DFDAC2084A39DEA07F6CEDAFC513C73FD6"),
+            calculate_fingerprint(KEY_SLOT.SIG, key.public_key(), 1600000000),
+        )
+
+    def test_generate_writes_fingerprint(self):
+        self.controller.verify_admin("12345678")
+        public_key = self.controller.generate_ec_key(
+            KEY_SLOT.AUT, "secp256r1", 1600000000
+        )
+        self.assertEqual(
+            calculate_fingerprint(KEY_SLOT.AUT, public_key, 1600000000),
+            self.controller.get_fingerprint(KEY_SLOT.AUT),
+        )
+        self.assertEqual(1600000000, self.controller.get_generation_time(KEY_SLOT.AUT))
+
+    def test_generate_all(self):
+        packets = self.controller.generate_all(
+            2048, "x25519", "ed25519", admin_pin="12345678", timestamp=1600000000
+        )
+        self.assertEqual([KEY_SLOT.SIG, KEY_SLOT.ENC, KEY_SLOT.AUT], list(packets))
+        self.assertEqual(1, self.conn.count(INS.VERIFY))
+        self.assertEqual(3, self.conn.count(INS.GENERATE_ASYM))
+
+        for key_slot, packet in packets.items():
+            public_key = self.conn.keys[key_slot].public_key()
+            self.assertEqual(
+                format_public_key_packet(key_slot, public_key, 1600000000), packet
+            )
+            self.assertEqual(
+                calculate_fingerprint(key_slot, public_key, 1600000000),
+                self.controller.get_fingerprint(key_slot),
+            )
+            self.assertEqual(1600000000, self.controller.get_generation_time(key_slot))
+        self.assertEqual(0x99, packets[KEY_SLOT.SIG][0])  # Public key packet
+        self.assertEqual(0xB9, packets[KEY_SLOT.ENC][0])  # Public subkey packet
+
+    def test_generate_all_invalid_curve(self):
+        with self.assertRaises(ValueError):
+            self.controller.generate_all(
+                "secp256r1", "curve42", "secp256r1", admin_pin="12345678"
+            )
+        self.assertEqual(0, self.conn.count(INS.GENERATE_ASYM))
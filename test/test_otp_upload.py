@@ -0,0 +1,180 @@
+#  vim: set fileencoding=utf-8 :
+
+from ykman.otp import (
+    UploadClient,
+    PrepareUploadError,
+    PrepareUploadFailed,
+    format_upload_data,
+)
+from ykman.util import modhex_encode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from time import sleep
+import json
+import socket
+import struct
+import unittest
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if server.reset_idle and getattr(self, "served", False):
+            # Reset a kept-alive connection, as a server timing it out would
+            self.connection.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+            )
+            self.connection.close()
+            self.close_connection = True
+            return
+        self.served = True
+        with server.lock:
+            server.requests.append((self.path, self.headers["User-Agent"], body))
+            server.connections.add(self.client_address)
+            server.active += 1
+            server.max_active = max(server.active, server.max_active)
+            drop = server.drop > 0
+            server.drop -= 1
+            fail = not drop and server.failures > 0
+            server.failures -= not drop
+        try:
+            sleep(server.delay)
+            if drop:
+                self.close_connection = True
+                return
+            if fail:
+                self.respond(503, {})
+            elif body["public_id"] == "vvcccccccccc":
+                self.respond(400, {"errors": ["PUBLIC_ID_OCCUPIED"]})
+            else:
+                self.respond(200, {"finish_url": "/finish/" + body["public_id"]})
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestUploadClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), UploadHandler)
+        self.server.daemon_threads = True
+        self.server.lock = Lock()
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.active = self.server.max_active = 0
+        self.server.failures = self.server.drop = 0
+        self.server.reset_idle = False
+        self.server.delay = 0
+        Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.client = UploadClient(self.base_url, user_agent="test", backoff=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def credential(self, i):
+        return (bytes(16), b"\xff\0\0\0\0" + bytes([i]), bytes(6), i)
+
+    def test_prepare(self):
+        url = self.client.prepare(*self.credential(1))
+        self.assertEqual("/finish/vvcccccccccb", url)
+        self.assertEqual(
+            [("/prepare", "test", format_upload_data(*self.credential(1)))],
+            self.server.requests,
+        )
+
+    def test_base_url_path(self):
+        client = UploadClient(self.base_url + "/api/", backoff=0)
+        client.prepare(*self.credential(1))
+        client.close()
+        self.assertEqual("/api/prepare", self.server.requests[0][0])
+
+    def test_unsupported_url(self):
+        with self.assertRaises(ValueError):
+            UploadClient("ftp://upload.example")
+
+    def test_persistent_connection(self):
+        for i in range(5):
+            self.client.prepare(*self.credential(i + 1))
+        self.assertEqual(5, len(self.server.requests))
+        self.assertEqual(1, len(self.server.connections))
+
+    def test_retry_service_unavailable(self):
+        self.server.failures = 2
+        self.assertEqual(
+            "/finish/vvcccccccccb", self.client.prepare(*self.credential(1))
+        )
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_retries_exhausted(self):
+        self.server.failures = 10
+        client = UploadClient(self.base_url, retries=2, backoff=0)
+        with self.assertRaises(PrepareUploadFailed) as cm:
+            client.prepare(*self.credential(1))
+        client.close()
+        self.assertEqual([PrepareUploadError.SERVICE_UNAVAILABLE], cm.exception.errors)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_retry_dropped_connection(self):
+        self.server.drop = 1
+        self.assertEqual(
+            "/finish/vvcccccccccb", self.client.prepare(*self.credential(1))
+        )
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_retry_reset_idle_connection(self):
+        self.server.reset_idle = True
+        for i in range(3):
+            self.assertEqual(
+                "/finish/" + modhex_encode(self.credential(i + 1)[1]),
+                self.client.prepare(*self.credential(i + 1)),
+            )
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(3, len(self.server.connections))
+
+    def test_no_retry_on_error(self):
+        with self.assertRaises(PrepareUploadFailed) as cm:
+            self.client.prepare(*self.credential(0))
+        self.assertEqual(400, cm.exception.status)
+        self.assertEqual([PrepareUploadError.PUBLIC_ID_OCCUPIED], cm.exception.errors)
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_connection_failed(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        client = UploadClient("http://127.0.0.1:{}".format(port), backoff=0)
+        with self.assertRaises(PrepareUploadFailed) as cm:
+            client.prepare(*self.credential(1))
+        self.assertEqual([PrepareUploadError.CONNECTION_FAILED], cm.exception.errors)
+
+    def test_prepare_many(self):
+        self.server.delay = 0.01
+        client = UploadClient(self.base_url, max_connections=3, backoff=0)
+        results = client.prepare_many([self.credential(i) for i in range(20)])
+        client.close()
+        self.assertIsInstance(results[0], PrepareUploadFailed)
+        self.assertEqual(
+            ["/finish/" + modhex_encode(self.credential(i)[1]) for i in range(1, 20)],
+            results[1:],
+        )
+        self.assertEqual(20, len(self.server.requests))
+        self.assertLessEqual(self.server.max_active, 3)
+        self.assertGreater(self.server.max_active, 1)
+        self.assertLessEqual(len(self.server.connections), 3)
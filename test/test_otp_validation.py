@@ -0,0 +1,153 @@
+#  vim: set fileencoding=utf-8 :
+
+from ykman.otp import format_upload_data
+from ykman.otp.validation import (
+    KeyStore,
+    ReplayIndex,
+    OtpValidator,
+    ValidationStatus,
+    TICKET_ACT_HIDRPT,
+    generate_otp,
+)
+from .util import benchmark
+from time import monotonic
+import io
+import json
+import unittest
+
+
+PUBLIC_ID = b"\xff\0\0\0\0\1"
+PRIVATE_ID = bytes(range(6))
+KEY = bytes(range(16))
+
+
+class TestOtpValidation(unittest.TestCase):
+    def setUp(self):
+        self.store = KeyStore()
+        self.store.add(PUBLIC_ID, PRIVATE_ID, KEY)
+        self.validator = OtpValidator(self.store)
+
+    def otp(self, counter=1, session_use=0, **kwargs):
+        return generate_otp(PUBLIC_ID, PRIVATE_ID, KEY, counter, session_use, **kwargs)
+
+    def test_validate(self):
+        result = self.validator.validate(self.otp(3, 7, timestamp=0x123456))
+        self.assertTrue(result.is_valid)
+        self.assertEqual(PUBLIC_ID, result.public_id)
+        self.assertEqual(3, result.counter)
+        self.assertEqual(7, result.session_use)
+        self.assertEqual(0x123456, result.timestamp)
+
+    def test_bad_otp(self):
+        otp = self.otp()
+        for bad in (otp[:-1], otp[:-1] + "a", ""):
+            self.assertEqual(
+                ValidationStatus.BAD_OTP, self.validator.validate(bad).status
+            )
+
+    def test_unknown_key(self):
+        otp = generate_otp(b"\xff\0\0\0\0\2", PRIVATE_ID, KEY, 1, 0)
+        self.assertEqual(
+            ValidationStatus.UNKNOWN_KEY, self.validator.validate(otp).status
+        )
+
+    def test_corrupt_otp(self):
+        otp = self.otp()
+        tampered = otp[:-1] + ("c" if otp[-1] != "c" else "b")
+        self.assertEqual(
+            ValidationStatus.CORRUPT_OTP, self.validator.validate(tampered).status
+        )
+        other_key = generate_otp(PUBLIC_ID, PRIVATE_ID, b"\1" * 16, 1, 0)
+        self.assertEqual(
+            ValidationStatus.CORRUPT_OTP, self.validator.validate(other_key).status
+        )
+        other_id = generate_otp(PUBLIC_ID, b"\1" * 6, KEY, 1, 0)
+        self.assertEqual(
+            ValidationStatus.CORRUPT_OTP, self.validator.validate(other_id).status
+        )
+
+    def test_replay(self):
+        otp = self.otp(2, 1)
+        self.assertTrue(self.validator.validate(otp).is_valid)
+        self.assertEqual(
+            ValidationStatus.REPLAYED_OTP, self.validator.validate(otp).status
+        )
+        # Older counter values
+        for counter, session_use in ((2, 0), (1, 5)):
+            self.assertEqual(
+                ValidationStatus.REPLAYED_OTP,
+                self.validator.validate(self.otp(counter, session_use)).status,
+            )
+        for counter, session_use in ((2, 2), (3, 0)):
+            self.assertTrue(
+                self.validator.validate(self.otp(counter, session_use)).is_valid
+            )
+
+    def test_hid_triggered(self):
+        result = self.validator.validate(self.otp(TICKET_ACT_HIDRPT | 3, 0))
+        self.assertTrue(result.is_valid)
+        self.assertEqual(3, result.counter)
+        self.assertTrue(result.hid_triggered)
+        # The flag is not part of the counter
+        result = self.validator.validate(self.otp(3, 1))
+        self.assertTrue(result.is_valid)
+        self.assertFalse(result.hid_triggered)
+        self.assertEqual(
+            ValidationStatus.REPLAYED_OTP,
+            self.validator.validate(self.otp(TICKET_ACT_HIDRPT | 2, 5)).status,
+        )
+
+    def test_validate_many(self):
+        otps = [self.otp(1, i) for i in range(3)]
+        results = self.validator.validate_many(otps + otps[1:2])
+        self.assertEqual(
+            [ValidationStatus.OK] * 3 + [ValidationStatus.REPLAYED_OTP],
+            [r.status for r in results],
+        )
+
+    def test_key_store_load(self):
+        record = format_upload_data(KEY, PUBLIC_ID, PRIVATE_ID, 123456)
+        store = KeyStore.load(io.StringIO(json.dumps(record) + "\n\n"))
+        self.assertEqual(1, len(store))
+        self.assertTrue(OtpValidator(store).validate(self.otp()).is_valid)
+        with self.assertRaises(ValueError):
+            KeyStore.load(io.StringIO('{"public_id": "vvcccccccccb"}\n'))
+
+    def test_replay_index_dump_load(self):
+        self.validator.validate(self.otp(5, 3))
+        f = io.StringIO()
+        self.validator.replay_index.dump(f)
+        f.seek(0)
+        index = ReplayIndex.load(f)
+        self.assertEqual((5, 3), index.get(PUBLIC_ID))
+        validator = OtpValidator(self.store, index)
+        self.assertEqual(
+            ValidationStatus.REPLAYED_OTP, validator.validate(self.otp(5, 3)).status
+        )
+
+    def _many_otps(self, count):
+        store = KeyStore()
+        otps = []
+        for i in range(count):
+            public_id = b"\xff\0" + i.to_bytes(4, "big")
+            key = i.to_bytes(16, "big")
+            store.add(public_id, PRIVATE_ID, key)
+            otps.append(generate_otp(public_id, PRIVATE_ID, key, 1, i % 256))
+        return OtpValidator(store), otps
+
+    def test_validate_many_credentials(self):
+        validator, otps = self._many_otps(300)
+        results = validator.validate_many(otps)
+        self.assertEqual(300, len(results))
+        self.assertTrue(all(r.is_valid for r in results))
+
+    @benchmark
+    def test_throughput(self):
+        # Benchmark of validating a batch of OTPs from many credentials
+        count = 5000
+        validator, otps = self._many_otps(count)
+        start = monotonic()
+        results = validator.validate_many(otps)
+        rate = count / (monotonic() - start)
+        self.assertTrue(all(r.is_valid for r in results))
+        self.assertGreater(rate, 2000, "OTPs validated per second")
@@ -2,8 +2,48 @@
 
 import ykman.piv as piv
 import unittest
+from unittest import mock
 
-from yubikit.piv import KEY_TYPE
+from yubikit.core.smartcard import ApduError, SW
+from yubikit.piv import (
+    KEY_TYPE,
+    SLOT,
+    PIN_POLICY,
+    OBJECT_ID,
+    TAG_CERT_INFO,
+    CERT_INFO_GZIP,
+    CERT_INFO_UNCOMPRESSED,
+    PivSession,
+    InvalidPinError,
+    INS_VERIFY,
+    INS_AUTHENTICATE,
+    INS_GET_DATA,
+    INS_PUT_DATA,
+    INS_GET_METADATA,
+    INS_GET_VERSION,
+    INS_GENERATE_ASYMMETRIC,
+    INS_SET_MGMKEY,
+    INS_CHANGE_REFERENCE,
+    DEFAULT_MANAGEMENT_KEY,
+    _pad_message,
+)
+from yubikit.core import TRANSPORT, Tlv, NotSupportedError
+from yubikit.core.smartcard import SmartCardConnection
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
+from cryptography.utils import int_to_bytes, int_from_bytes
+from cryptography.x509.oid import NameOID
+from contextlib import contextmanager
+import datetime
+import json
+import io
+import struct
+import os
 
 
 class FakeController(object):
@@ -15,6 +55,799 @@ class FakeController(object):
         return piv.PivController.is_fips.fget(self)
 
 
+class FakePivApp(object):
+    """Signs using a software key, the way the YubiKey would."""
+
+    version = (5, 3, 0)
+
+    def __init__(self, private_key):
+        self.private_key = private_key
+        self.signed = []
+
+    def get_object(self, object_id):
+        raise ApduError(b"", SW.FILE_NOT_FOUND)
+
+    def sign(self, slot, key_type, message, hash_algorithm, padding):
+        self.signed.append(message)
+        if key_type.algorithm == piv.ALGORITHM.EC:
+            return self.private_key.sign(message, ec.ECDSA(hash_algorithm))
+        padded = _pad_message(key_type, message, hash_algorithm, padding)
+        numbers = self.private_key.private_numbers()
+        return int_to_bytes(
+            pow(int_from_bytes(padded, "big"), numbers.d, numbers.public_numbers.n),
+            key_type.bit_len // 8,
+        )
+
+
+def _cert_builder(public_key):
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "test")])
+    now = datetime.datetime.utcnow()
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(public_key)
+        .serial_number(1234)
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), True)
+    )
+
+
+def _csr_builder():
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "test")])
+    return x509.CertificateSigningRequestBuilder().subject_name(name)
+
+
+class TestSignBuilder(unittest.TestCase):
+    def _check(self, private_key, key_type):
+        public_key = private_key.public_key()
+        app = FakePivApp(private_key)
+        controller = piv.PivController(app)
+
+        # No throwaway RSA keys should be generated on the host
+        with mock.patch.object(rsa, "generate_private_key") as generate:
+            cert = controller.sign_cert_builder(
+                SLOT.AUTHENTICATION, key_type, _cert_builder(public_key)
+            )
+            csr = controller.sign_csr_builder(
+                SLOT.AUTHENTICATION, public_key, _csr_builder()
+            )
+            generate.assert_not_called()
+
+        self.assertEqual(
+            app.signed, [cert.tbs_certificate_bytes, csr.tbs_certrequest_bytes]
+        )
+        self.assertEqual(
+            cert.public_key().public_numbers(), public_key.public_numbers()
+        )
+        self.assertEqual(csr.public_key().public_numbers(), public_key.public_numbers())
+        self.assertEqual(cert.serial_number, 1234)
+        self.assertFalse(
+            cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+        )
+        self.assertTrue(csr.is_signature_valid)
+
+        if key_type.algorithm == piv.ALGORITHM.RSA:
+            verify_args = (padding.PKCS1v15(), cert.signature_hash_algorithm)
+        else:
+            verify_args = (ec.ECDSA(cert.signature_hash_algorithm),)
+        public_key.verify(cert.signature, cert.tbs_certificate_bytes, *verify_args)
+
+    def test_sign_rsa(self):
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        self._check(key, KEY_TYPE.RSA2048)
+
+    def test_sign_ec(self):
+        key = ec.generate_private_key(ec.SECP384R1(), default_backend())
+        self._check(key, KEY_TYPE.ECCP384)
+
+    def test_pad_message_pkcs1v15(self):
+        key = rsa.generate_private_key(65537, 1024, default_backend())
+        message = b"hello world"
+        for hash_algorithm in (hashes.SHA1(), hashes.SHA256(), hashes.SHA512()):
+            padded = _pad_message(
+                KEY_TYPE.RSA1024, message, hash_algorithm, padding.PKCS1v15()
+            )
+            numbers = key.private_numbers()
+            signature = int_to_bytes(
+                pow(int_from_bytes(padded, "big"), numbers.d, numbers.public_numbers.n),
+                128,
+            )
+            key.public_key().verify(
+                signature, message, padding.PKCS1v15(), hash_algorithm
+            )
+
+
+class TestCertificateCompression(unittest.TestCase):
+    def setUp(self):
+        # Session without a connection, storing objects in a dict
+        self.objects = {}
+        self.session = PivSession.__new__(PivSession)
+        self.session.put_object = self.objects.__setitem__
+        self.session.get_object = self.objects.__getitem__
+        self.key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+    def _cert(self, n_names):
+        builder = _cert_builder(self.key.public_key())
+        if n_names:
+            names = [x509.DNSName("host%d.example.com" % i) for i in range(n_names)]
+            builder = builder.add_extension(x509.SubjectAlternativeName(names), False)
+        return builder.sign(self.key, hashes.SHA256(), default_backend())
+
+    def _stored(self):
+        data = Tlv.parse_dict(self.objects[OBJECT_ID.AUTHENTICATION])
+        return data[TAG_CERT_INFO][0]
+
+    def test_small_uncompressed(self):
+        cert = self._cert(0)
+        self.session.put_certificate(SLOT.AUTHENTICATION, cert)
+        self.assertEqual(self._stored(), CERT_INFO_UNCOMPRESSED)
+        self.assertEqual(self.session.get_certificate(SLOT.AUTHENTICATION), cert)
+
+    def test_large_compressed(self):
+        cert = self._cert(100)
+        self.session.put_certificate(SLOT.AUTHENTICATION, cert)
+        self.assertEqual(self._stored(), CERT_INFO_GZIP)
+        self.assertEqual(self.session.get_certificate(SLOT.AUTHENTICATION), cert)
+
+    def test_explicit_compression(self):
+        cert = self._cert(0)
+        self.session.put_certificate(SLOT.AUTHENTICATION, cert, compress=True)
+        self.assertEqual(self._stored(), CERT_INFO_GZIP)
+        self.assertEqual(self.session.get_certificate(SLOT.AUTHENTICATION), cert)
+
+        cert = self._cert(100)
+        self.session.put_certificate(SLOT.AUTHENTICATION, cert, compress=False)
+        self.assertEqual(self._stored(), CERT_INFO_UNCOMPRESSED)
+        self.assertEqual(self.session.get_certificate(SLOT.AUTHENTICATION), cert)
+
+
+class FakePivConnection(SmartCardConnection):
+    """Minimal PIV applet emulator, recording each APDU sent."""
+
+    def __init__(self, version=(5, 3, 0)):
+        self.version = version
+        self.pin = b"123456"
+        self.pin_retries = 3
+        self.pin_verified = False
+        self.keys = {}  # slot -> (key_type, private_key, pin_policy)
+        self.objects = {}  # object_id -> data
+        self.management_key = DEFAULT_MANAGEMENT_KEY
+        self.authenticated = False
+        self._witness = None
+        self.apdus = []
+        self.transactions = 0
+        self._remaining = b""
+
+    @property
+    def transport(self):
+        return TRANSPORT.USB
+
+    @contextmanager
+    def transaction(self):
+        self.transactions += 1
+        yield
+
+    def add_key(self, slot, private_key, pin_policy=PIN_POLICY.ONCE):
+        key_type = KEY_TYPE.from_public_key(private_key.public_key())
+        self.keys[slot] = (key_type, private_key, pin_policy)
+
+    def _respond(self, data):
+        # Short APDU responses, remaining data is read using GET RESPONSE
+        if len(data) > 256:
+            self._remaining = data[256:]
+            return data[:256], 0x6100 | min(len(self._remaining), 0xFF)
+        return data, SW.OK
+
+    def _verify(self, data):
+        if self.pin_retries == 0:
+            return SW.AUTH_METHOD_BLOCKED
+        if not data:
+            return SW.OK if self.pin_verified else 0x63C0 | self.pin_retries
+        if data.rstrip(b"\xff") == self.pin:
+            self.pin_verified = True
+            self.pin_retries = 3
+            return SW.OK
+        self.pin_verified = False
+        self.pin_retries -= 1
+        return 0x63C0 | self.pin_retries
+
+    def _tdes(self, data, decrypt=False):
+        cipher = Cipher(
+            algorithms.TripleDES(self.management_key), modes.ECB(), default_backend()
+        )
+        ctx = cipher.decryptor() if decrypt else cipher.encryptor()
+        return ctx.update(data) + ctx.finalize()
+
+    def _authenticate(self, data):
+        tlvs = Tlv.parse_dict(Tlv.unwrap(0x7C, data))
+        if 0x81 not in tlvs:  # Step 1, send witness
+            self.authenticated = False
+            self._witness = os.urandom(8)
+            return Tlv(0x7C, Tlv(0x80, self._tdes(self._witness))), SW.OK
+        if tlvs[0x80] != self._witness:
+            return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+        self.authenticated = True
+        return Tlv(0x7C, Tlv(0x82, self._tdes(tlvs[0x81]))), SW.OK
+
+    def _sign(self, key_type, slot, data):
+        if slot not in self.keys or self.keys[slot][0] != key_type:
+            return b"", SW.INCORRECT_PARAMETERS
+        _, private_key, pin_policy = self.keys[slot]
+        if pin_policy != PIN_POLICY.NEVER:
+            if not self.pin_verified:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            if pin_policy == PIN_POLICY.ALWAYS:
+                self.pin_verified = False
+        tlvs = Tlv.parse_dict(Tlv.unwrap(0x7C, data))
+        if 0x85 in tlvs:  # ECDH
+            peer = ec.EllipticCurvePublicKey.from_encoded_point(
+                private_key.curve, tlvs[0x85]
+            )
+            return Tlv(0x7C, Tlv(0x82, private_key.exchange(ec.ECDH(), peer))), SW.OK
+        message = tlvs[0x81]
+        if key_type.algorithm == piv.ALGORITHM.RSA:
+            numbers = private_key.private_numbers()
+            n = numbers.public_numbers.n
+            sig = int_to_bytes(pow(int_from_bytes(message, "big"), numbers.d, n))
+            sig = sig.rjust(key_type.bit_len // 8, b"\0")
+        else:
+            hash_algorithm = {32: hashes.SHA256(), 48: hashes.SHA384()}[len(message)]
+            sig = private_key.sign(message, ec.ECDSA(Prehashed(hash_algorithm)))
+        return Tlv(0x7C, Tlv(0x82, sig)), SW.OK
+
+    def _metadata(self, slot):
+        if slot == 0x80:  # PIN
+            return Tlv(0x05, b"\0") + Tlv(0x06, bytes([3, self.pin_retries])), SW.OK
+        if slot not in self.keys:
+            return b"", SW.FILE_NOT_FOUND
+        key_type, private_key, pin_policy = self.keys[slot]
+        return (
+            Tlv(0x01, bytes([key_type]))
+            + Tlv(0x02, bytes([pin_policy, 1]))
+            + Tlv(0x03, b"\1")
+            + Tlv(0x04, self._encode_public_key(key_type, private_key.public_key())),
+            SW.OK,
+        )
+
+    def _encode_public_key(self, key_type, public_key):
+        if key_type.algorithm == piv.ALGORITHM.RSA:
+            numbers = public_key.public_numbers()
+            return Tlv(0x81, int_to_bytes(numbers.n)) + Tlv(
+                0x82, int_to_bytes(numbers.e)
+            )
+        return Tlv(
+            0x86, public_key.public_bytes(Encoding.X962, PublicFormat.UncompressedPoint)
+        )
+
+    def _generate(self, slot, data):
+        if not self.authenticated:
+            return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+        params = Tlv.parse_dict(Tlv.unwrap(0xAC, data))
+        key_type = KEY_TYPE(params[0x80][0])
+        if key_type.algorithm == piv.ALGORITHM.RSA:
+            private_key = rsa.generate_private_key(
+                65537, key_type.bit_len, default_backend()
+            )
+        else:
+            curve = ec.SECP256R1() if key_type == KEY_TYPE.ECCP256 else ec.SECP384R1()
+            private_key = ec.generate_private_key(curve, default_backend())
+        pin_policy = PIN_POLICY(params.get(0xAA, b"\2")[0])
+        self.keys[slot] = (key_type, private_key, pin_policy)
+        return self._respond(
+            Tlv(0x7F49, self._encode_public_key(key_type, private_key.public_key()))
+        )
+
+    def send_and_receive(self, apdu):
+        self.apdus.append(apdu)
+        ins, p1, p2 = apdu[1:4]
+        if len(apdu) > 5 and apdu[4] == 0:
+            data = apdu[7:]  # Extended length
+        else:
+            data = apdu[5:]
+        if ins == 0xA4:  # SELECT
+            return b"", SW.OK
+        if ins == 0xC0:  # GET RESPONSE
+            data, self._remaining = self._remaining, b""
+            return self._respond(data)
+        if ins == INS_GET_VERSION:
+            return bytes(self.version), SW.OK
+        if ins == INS_VERIFY:
+            return b"", self._verify(data)
+        if ins == INS_AUTHENTICATE and p2 == SLOT.CARD_MANAGEMENT:
+            return self._authenticate(data)
+        if ins == INS_AUTHENTICATE:
+            return self._sign(KEY_TYPE(p1), p2, data)
+        if ins == INS_SET_MGMKEY:
+            if not self.authenticated:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            self.management_key = data[3:]
+            return b"", SW.OK
+        if ins == INS_CHANGE_REFERENCE:
+            sw = self._verify(data[:8])
+            if sw == SW.OK:
+                self.pin = data[8:].rstrip(b"\xff")
+                self.pin_verified = False
+            return b"", sw
+        if ins == INS_GET_METADATA:
+            return self._metadata(p2)
+        if ins == INS_GENERATE_ASYMMETRIC:
+            return self._generate(p2, data)
+        if ins == INS_GET_DATA:
+            object_id = int_from_bytes(Tlv.unwrap(0x5C, data), "big")
+            if object_id == OBJECT_ID.PRINTED and not self.pin_verified:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            if object_id not in self.objects:
+                return b"", SW.FILE_NOT_FOUND
+            return self._respond(Tlv(0x53, self.objects[object_id]))
+        if ins == INS_PUT_DATA:
+            if not self.authenticated:
+                return b"", SW.SECURITY_CONDITION_NOT_SATISFIED
+            tlvs = Tlv.parse_dict(data)
+            object_id = int_from_bytes(tlvs[0x5C], "big")
+            if tlvs[0x53]:
+                self.objects[object_id] = tlvs[0x53]
+            else:
+                self.objects.pop(object_id, None)
+            return b"", SW.OK
+        return b"", SW.INVALID_INSTRUCTION
+
+    def count(self, ins):
+        return sum(1 for apdu in self.apdus if apdu[1] == ins)
+
+
+def _digests(n, hash_algorithm=hashes.SHA256()):
+    result = []
+    for i in range(n):
+        h = hashes.Hash(hash_algorithm, default_backend())
+        h.update(struct.pack(">I", i))
+        result.append(h.finalize())
+    return result
+
+
+class TestSignMany(unittest.TestCase):
+    def _verify_all(self, public_key, digests, signatures, hash_algorithm):
+        self.assertEqual(len(signatures), len(digests))
+        for digest, signature in zip(digests, signatures):
+            if isinstance(public_key, rsa.RSAPublicKey):
+                args = (padding.PKCS1v15(), Prehashed(hash_algorithm))
+            else:
+                args = (ec.ECDSA(Prehashed(hash_algorithm)),)
+            public_key.verify(signature, digest, *args)
+
+    def test_sign_many_rsa(self):
+        conn = FakePivConnection()
+        key = rsa.generate_private_key(65537, 2048, default_backend())
+        conn.add_key(SLOT.SIGNATURE, key)
+        session = PivSession(conn)
+        digests = _digests(10)
+
+        with mock.patch.object(rsa, "generate_private_key") as generate:
+            signatures = list(
+                session.sign_many(
+                    SLOT.SIGNATURE,
+                    KEY_TYPE.RSA2048,
+                    digests,
+                    hashes.SHA256(),
+                    padding.PKCS1v15(),
+                    pin="123456",
+                )
+            )
+            generate.assert_not_called()
+        self._verify_all(key.public_key(), digests, signatures, hashes.SHA256())
+        self.assertEqual(conn.count(INS_VERIFY), 1)
+        self.assertEqual(conn.count(INS_AUTHENTICATE), 10)
+
+    def test_sign_many_ec_pin_always(self):
+        conn = FakePivConnection()
+        key = ec.generate_private_key(ec.SECP384R1(), default_backend())
+        conn.add_key(SLOT.SIGNATURE, key, PIN_POLICY.ALWAYS)
+        session = PivSession(conn)
+        digests = _digests(5, hashes.SHA384())
+
+        signatures = list(
+            session.sign_many(
+                SLOT.SIGNATURE, KEY_TYPE.ECCP384, digests, hashes.SHA384(), pin="123456"
+            )
+        )
+        self._verify_all(key.public_key(), digests, signatures, hashes.SHA384())
+        self.assertEqual(conn.count(INS_VERIFY), 5)
+        self.assertEqual(conn.count(INS_AUTHENTICATE), 5)
+
+    def test_sign_many_pin_always_without_metadata(self):
+        conn = FakePivConnection(version=(4, 3, 5))
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        conn.add_key(SLOT.SIGNATURE, key, PIN_POLICY.ALWAYS)
+        session = PivSession(conn)
+        digests = _digests(3)
+
+        signatures = list(
+            session.sign_many(
+                SLOT.SIGNATURE, KEY_TYPE.ECCP256, digests, hashes.SHA256(), pin="123456"
+            )
+        )
+        self._verify_all(key.public_key(), digests, signatures, hashes.SHA256())
+        self.assertEqual(conn.count(INS_VERIFY), 3)
+
+    def test_sign_many_wrong_pin(self):
+        conn = FakePivConnection()
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        conn.add_key(SLOT.SIGNATURE, key)
+        session = PivSession(conn)
+        signatures = session.sign_many(
+            SLOT.SIGNATURE, KEY_TYPE.ECCP256, _digests(3), hashes.SHA256(), pin="654321"
+        )
+        with self.assertRaises(InvalidPinError):
+            next(signatures)
+        self.assertEqual(conn.count(INS_AUTHENTICATE), 0)
+
+
+class TestPivControllerState(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakePivConnection()
+        self.controller = piv.PivController(PivSession(self.conn))
+        self.conn.apdus = []
+
+    def _protect_key(self, derived):
+        pivman = piv.PivmanData()
+        if derived:
+            pivman.salt = os.urandom(16)
+            self.conn.management_key = piv._derive_key("123456", pivman.salt)
+        else:
+            pivman.mgm_key_protected = True
+            protected = piv.PivmanProtectedData()
+            protected.key = os.urandom(24)
+            self.conn.management_key = protected.key
+            self.conn.objects[OBJECT_ID.PRINTED] = protected.get_bytes()
+        self.conn.objects[piv.OBJECT_ID_PIVMAN_DATA] = pivman.get_bytes()
+
+    def _ins(self):
+        return [apdu[1] for apdu in self.conn.apdus]
+
+    def test_pivman_data_read_lazily(self):
+        with self.assertRaises(ApduError):
+            self.controller.read_certificate(SLOT.AUTHENTICATION)
+        self.assertEqual(self._ins(), [INS_GET_DATA])
+
+        self.assertFalse(self.controller.has_protected_key)
+        self.assertFalse(self.controller.puk_blocked)
+        self.assertEqual(self._ins(), [INS_GET_DATA] * 2)
+
+    def test_verify_stored_key(self):
+        self._protect_key(derived=False)
+        self.controller.verify("123456")
+        self.assertEqual(
+            self._ins(),
+            [INS_VERIFY, INS_GET_DATA, INS_GET_DATA]
+            + [INS_AUTHENTICATE] * 2
+            + [INS_VERIFY],
+        )
+
+        # Protected data is already read, CCC and CHUID are missing
+        self.conn.apdus = []
+        self.controller.set_mgm_key(None, store_on_device=True)
+        self.assertEqual(
+            self._ins(),
+            [INS_SET_MGMKEY, INS_PUT_DATA, INS_PUT_DATA]
+            + [INS_GET_DATA, INS_PUT_DATA] * 2,
+        )
+        self.assertEqual(
+            self.controller._pivman_protected_data.key, self.conn.management_key
+        )
+
+        # CCC and CHUID now known to exist
+        self.conn.apdus = []
+        self.controller.set_mgm_key(None, store_on_device=True)
+        self.assertEqual(self._ins(), [INS_SET_MGMKEY, INS_PUT_DATA, INS_PUT_DATA])
+
+    def test_verify_derived_key(self):
+        self._protect_key(derived=True)
+        with mock.patch.object(piv, "_derive_key", wraps=piv._derive_key) as derive:
+            self.controller.verify("123456")
+            self.controller.verify("123456")
+            self.assertEqual(derive.call_count, 1)
+        self.assertEqual(
+            self._ins(),
+            [INS_VERIFY, INS_GET_DATA]
+            + [INS_AUTHENTICATE] * 2
+            + [INS_VERIFY, INS_VERIFY],
+        )
+
+    def test_change_pin_derived_key(self):
+        self._protect_key(derived=True)
+        self.controller.change_pin("123456", "654321")
+        self.assertEqual(
+            self._ins(),
+            [INS_CHANGE_REFERENCE, INS_GET_DATA]
+            + [INS_AUTHENTICATE] * 2
+            + [INS_VERIFY, INS_SET_MGMKEY, INS_PUT_DATA],
+        )
+        pivman = piv.PivmanData(self.conn.objects[piv.OBJECT_ID_PIVMAN_DATA])
+        self.assertEqual(
+            self.conn.management_key, piv._derive_key("654321", pivman.salt)
+        )
+
+        # A new controller can authenticate using the new PIN
+        controller = piv.PivController(PivSession(self.conn))
+        controller.verify("654321")
+        self.assertTrue(self.conn.authenticated)
+
+
+class TestDeferredUpdates(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakePivConnection()
+        self.controller = piv.PivController(PivSession(self.conn))
+        self.controller.authenticate(DEFAULT_MANAGEMENT_KEY)
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.cert = _cert_builder(key.public_key()).sign(
+            key, hashes.SHA256(), default_backend()
+        )
+        self.conn.apdus = []
+
+    def _puts(self, object_id):
+        puts = []
+        for apdu in self.conn.apdus:
+            if apdu[1] == INS_PUT_DATA:
+                data = apdu[7:] if apdu[4] == 0 else apdu[5:]
+                if Tlv.parse_dict(data)[0x5C] == int_to_bytes(object_id):
+                    puts.append(apdu)
+        return puts
+
+    def test_import_certificates(self):
+        slots = [SLOT.AUTHENTICATION, SLOT.SIGNATURE, SLOT.KEY_MANAGEMENT]
+        with self.controller.deferred_updates():
+            for slot in slots:
+                self.controller.import_certificate(slot, self.cert)
+            self.controller.set_mgm_key(DEFAULT_MANAGEMENT_KEY)
+            self.assertEqual(self._puts(OBJECT_ID.CHUID), [])
+            self.assertEqual(self._puts(OBJECT_ID.CAPABILITY), [])
+
+        self.assertEqual(len(self._puts(OBJECT_ID.CHUID)), 1)
+        self.assertEqual(len(self._puts(OBJECT_ID.CAPABILITY)), 1)
+        self.assertIn(OBJECT_ID.CHUID, self.conn.objects)
+        self.assertIn(OBJECT_ID.CAPABILITY, self.conn.objects)
+        for slot in slots:
+            self.assertEqual(self.controller.read_certificate(slot), self.cert)
+
+    def test_written_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.controller.deferred_updates():
+                with self.controller.deferred_updates():
+                    self.controller.import_certificate(SLOT.SIGNATURE, self.cert)
+                self.assertEqual(self._puts(OBJECT_ID.CHUID), [])
+                raise ValueError()
+        self.assertEqual(len(self._puts(OBJECT_ID.CHUID)), 1)
+        self.assertEqual(self._puts(OBJECT_ID.CAPABILITY), [])
+
+        # Not deferred outside the block
+        self.controller.update_chuid()
+        self.assertEqual(len(self._puts(OBJECT_ID.CHUID)), 2)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakePivConnection()
+        self.key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.conn.add_key(SLOT.AUTHENTICATION, self.key, PIN_POLICY.ALWAYS)
+        self.cert = _cert_builder(self.key.public_key()).sign(
+            self.key, hashes.SHA256(), default_backend()
+        )
+        self.conn.objects[OBJECT_ID.AUTHENTICATION] = Tlv(
+            0x70, self.cert.public_bytes(Encoding.DER)
+        ) + Tlv(TAG_CERT_INFO, b"\0")
+        self.conn.objects[OBJECT_ID.SIGNATURE] = Tlv(0x70, b"invalid") + Tlv(
+            TAG_CERT_INFO, b"\0"
+        )
+        self.conn.objects[piv.OBJECT_ID_PIVMAN_DATA] = piv.PivmanData().get_bytes()
+
+    def _snapshot(self, metadata=True):
+        controller = piv.PivController(PivSession(self.conn))
+        self.conn.apdus = []
+        return controller.snapshot(metadata)
+
+    def test_snapshot(self):
+        snapshot = self._snapshot()
+        self.assertEqual(self.conn.transactions, 1)
+        self.assertEqual(self.conn.count(INS_VERIFY), 0)
+        self.assertEqual(snapshot.pin_tries, 3)
+        self.assertNotIn(OBJECT_ID.CHUID, snapshot.objects)
+        self.assertEqual(
+            [SLOT.AUTHENTICATION, SLOT.SIGNATURE], snapshot.certificate_slots
+        )
+        self.assertEqual(
+            snapshot.get_certificate_der(SLOT.AUTHENTICATION),
+            self.cert.public_bytes(Encoding.DER),
+        )
+        self.assertEqual(
+            {SLOT.AUTHENTICATION: self.cert, SLOT.SIGNATURE: None},
+            snapshot.list_certificates(),
+        )
+        self.assertEqual([SLOT.AUTHENTICATION], list(snapshot.metadata))
+        metadata = snapshot.metadata[SLOT.AUTHENTICATION]
+        self.assertEqual(PIN_POLICY.ALWAYS, metadata.pin_policy)
+        self.assertFalse(snapshot.pivman_data.puk_blocked)
+
+    def test_metadata_not_requested(self):
+        snapshot = self._snapshot(metadata=False)
+        # Only the PIN metadata, for the number of retries
+        self.assertEqual(self.conn.count(INS_GET_METADATA), 1)
+        self.assertIsNone(snapshot.metadata)
+
+    def test_unsupported_certificate_encoding(self):
+        self.conn.objects[OBJECT_ID.SIGNATURE] = Tlv(0x70, b"data") + Tlv(
+            TAG_CERT_INFO, b"\x02"
+        )
+        snapshot = self._snapshot(metadata=False)
+        with self.assertRaises(NotSupportedError):
+            snapshot.get_certificate(SLOT.SIGNATURE)
+        self.assertEqual(
+            {SLOT.AUTHENTICATION: self.cert, SLOT.SIGNATURE: None},
+            snapshot.list_certificates(),
+        )
+
+    def test_no_metadata(self):
+        self.conn.version = (4, 3, 5)
+        snapshot = self._snapshot()
+        self.assertEqual(self.conn.count(INS_GET_METADATA), 0)
+        self.assertIsNone(snapshot.metadata)
+        self.assertEqual(snapshot.pin_tries, 3)
+
+    def test_json(self):
+        snapshot = self._snapshot()
+        data = json.loads(json.dumps(snapshot.to_dict()))
+        restored = piv.PivSnapshot.from_dict(data)
+        self.assertEqual(snapshot.to_dict(), restored.to_dict())
+        self.assertEqual(restored.version, (5, 3, 0))
+        self.assertEqual(restored.objects, snapshot.objects)
+        self.assertEqual(
+            restored.get_certificate(SLOT.AUTHENTICATION), self.cert,
+        )
+        self.assertEqual(
+            restored.metadata[SLOT.AUTHENTICATION].public_key.public_numbers(),
+            self.key.public_key().public_numbers(),
+        )
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.objects = {
+            OBJECT_ID.CHUID: os.urandom(60),
+            OBJECT_ID.CAPABILITY: os.urandom(40),
+            OBJECT_ID.AUTHENTICATION: os.urandom(600),
+            OBJECT_ID.PRINTED: b"printed",
+            OBJECT_ID.ATTESTATION: b"attestation",
+        }
+        self.conn = FakePivConnection()
+        self.conn.objects.update(self.objects)
+        self.controller = piv.PivController(PivSession(self.conn))
+
+    def _backup(self):
+        f = io.StringIO()
+        n = piv.write_backup(f, self.controller.read_objects(piv.BACKUP_OBJECTS))
+        self.assertEqual(n, 3)
+        return f.getvalue()
+
+    def test_read_objects(self):
+        object_ids = [OBJECT_ID.PRINTED, OBJECT_ID.SIGNATURE, OBJECT_ID.CHUID]
+        self.assertEqual(
+            [(OBJECT_ID.CHUID, self.objects[OBJECT_ID.CHUID])],
+            list(self.controller.read_objects(object_ids)),
+        )
+
+    def test_backup_round_trip(self):
+        objects = piv.read_backup(io.StringIO(self._backup()))
+        self.assertEqual(
+            [OBJECT_ID.CAPABILITY, OBJECT_ID.CHUID, OBJECT_ID.AUTHENTICATION],
+            list(objects),
+        )
+        for object_id, data in objects.items():
+            self.assertEqual(self.objects[object_id], data)
+
+    def test_backup_corrupted(self):
+        lines = self._backup().splitlines(True)
+
+        with self.assertRaises(ValueError):
+            piv.read_backup(io.StringIO("".join(lines[:-1])))  # Truncated
+        with self.assertRaises(ValueError):
+            piv.read_backup(io.StringIO("".join(lines[:2] + lines[3:])))  # Removed
+
+        entry = json.loads(lines[2])
+        entry["data"] = entry["data"][::-1]
+        lines[2] = json.dumps(entry) + "\n"
+        with self.assertRaises(ValueError):
+            piv.read_backup(io.StringIO("".join(lines)))
+
+        with self.assertRaises(ValueError):
+            piv.read_backup(io.StringIO("not a backup\n"))
+
+    def test_attestation_excluded(self):
+        self.assertNotIn(OBJECT_ID.ATTESTATION, piv.BACKUP_OBJECTS)
+        self.assertNotIn('"5fff01"', self._backup())
+
+        # Not restored from a backup which includes it
+        f = io.StringIO()
+        piv.write_backup(f, [(OBJECT_ID.ATTESTATION, b"other attestation")])
+        f.seek(0)
+        self.assertEqual({}, piv.read_backup(f))
+
+    def test_restore_differences(self):
+        objects = piv.read_backup(io.StringIO(self._backup()))
+        conn = FakePivConnection()
+        conn.objects[OBJECT_ID.CHUID] = self.objects[OBJECT_ID.CHUID]
+        conn.objects[OBJECT_ID.CAPABILITY] = b"old"
+        controller = piv.PivController(PivSession(conn))
+        controller.authenticate(DEFAULT_MANAGEMENT_KEY)
+
+        written = controller.write_objects(objects.items())
+        self.assertEqual([OBJECT_ID.CAPABILITY, OBJECT_ID.AUTHENTICATION], written)
+        self.assertEqual(conn.count(INS_PUT_DATA), 2)
+        self.assertEqual(conn.transactions, 1)
+        for object_id, data in objects.items():
+            self.assertEqual(conn.objects[object_id], data)
+
+        # Nothing left to write
+        self.assertEqual([], controller.write_objects(objects.items()))
+        self.assertEqual(conn.count(INS_PUT_DATA), 2)
+
+
+class TestProvisionSlot(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakePivConnection()
+        self.controller = piv.PivController(PivSession(self.conn))
+        self.controller.authenticate(DEFAULT_MANAGEMENT_KEY)
+        self.controller.verify("123456")
+        self.conn.apdus = []
+
+    def _ins(self):
+        return [apdu[1] for apdu in self.conn.apdus if apdu[1] != 0xC0]
+
+    def test_certificate(self):
+        public_key, cert = self.controller.provision_slot(
+            SLOT.AUTHENTICATION, KEY_TYPE.ECCP256, "test", verify=True
+        )
+        self.assertEqual(
+            [INS_GENERATE_ASYMMETRIC, INS_AUTHENTICATE, INS_PUT_DATA, INS_PUT_DATA],
+            self._ins(),
+        )
+        self.assertEqual(
+            public_key.public_numbers(), cert.public_key().public_numbers()
+        )
+        self.assertEqual(
+            cert, self.controller.read_certificate(SLOT.AUTHENTICATION),
+        )
+        self.assertIn(OBJECT_ID.CHUID, self.conn.objects)
+        delta = cert.not_valid_after - cert.not_valid_before
+        self.assertEqual(365, delta.days)
+
+    def test_csr(self):
+        public_key, csr = self.controller.provision_slot(
+            SLOT.SIGNATURE, KEY_TYPE.ECCP384, "test", csr=True, verify=True
+        )
+        self.assertEqual([INS_GENERATE_ASYMMETRIC, INS_AUTHENTICATE], self._ins())
+        self.assertTrue(csr.is_signature_valid)
+        self.assertEqual(public_key.public_numbers(), csr.public_key().public_numbers())
+        self.assertNotIn(OBJECT_ID.SIGNATURE, self.conn.objects)
+
+    def test_verify_mismatch(self):
+        def replace_key(slot, data):
+            # Respond with the public key of a different key than the one stored
+            response, sw = FakePivConnection._generate(self.conn, slot, data)
+            self.conn.keys[slot] = self.conn.keys[slot][:1] + (
+                ec.generate_private_key(ec.SECP256R1(), default_backend()),
+                PIN_POLICY.ONCE,
+            )
+            return response, sw
+
+        self.conn._generate = replace_key
+        with self.assertRaises(piv.KeypairMismatch):
+            self.controller.provision_slot(
+                SLOT.AUTHENTICATION, KEY_TYPE.ECCP256, "test", verify=True
+            )
+        self.assertNotIn(OBJECT_ID.AUTHENTICATION, self.conn.objects)
+        self.assertNotIn(OBJECT_ID.CHUID, self.conn.objects)
+
+
 class TestPivFunctions(unittest.TestCase):
     def test_generate_random_management_key(self):
         output1 = piv.generate_random_management_key()
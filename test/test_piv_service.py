@@ -0,0 +1,192 @@
+#  vim: set fileencoding=utf-8 :
+
+from ykman import piv_service
+from ykman.piv_service import KeyPool, find_keys, get_public_key_fingerprint
+from yubikit.piv import (
+    PivSession,
+    SLOT,
+    PIN_POLICY,
+    INS_AUTHENTICATE,
+    INS_VERIFY,
+    DEFAULT_MANAGEMENT_KEY,
+)
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from .test_piv import FakePivConnection, _cert_builder
+from threading import Thread
+import tempfile
+import socket
+import json
+import os
+import unittest
+
+
+class FakeDevice(object):
+    def __init__(self, name, connection):
+        self.fingerprint = name
+        self.connection = connection
+        self.removed = False
+
+    def open_connection(self, connection_type):
+        if self.removed:
+            raise OSError("Device removed")
+        return self.connection
+
+    def remove(self):
+        self.removed = True
+
+        def send_and_receive(apdu):
+            raise OSError("Device removed")
+
+        self.connection.send_and_receive = send_and_receive
+
+
+def _device(name, private_key, version=(5, 3, 0), pin_policy=PIN_POLICY.ONCE):
+    conn = FakePivConnection(version)
+    conn.add_key(SLOT.SIGNATURE, private_key, pin_policy)
+    if version < (5, 3, 0):
+        cert = _cert_builder(private_key.public_key()).sign(
+            private_key, hashes.SHA256(), default_backend()
+        )
+        session = PivSession(conn)
+        session.authenticate(DEFAULT_MANAGEMENT_KEY)
+        session.put_certificate(SLOT.SIGNATURE, cert)
+        conn.apdus = []
+    return FakeDevice(name, conn)
+
+
+def _digest(data=b"hello"):
+    h = hashes.Hash(hashes.SHA256(), default_backend())
+    h.update(data)
+    return h.finalize()
+
+
+class TestPivService(unittest.TestCase):
+    def setUp(self):
+        self.key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.fingerprint = get_public_key_fingerprint(self.key.public_key())
+        other_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.devices = [
+            _device("reader 1", self.key),
+            _device("reader 2", self.key, version=(4, 3, 5)),
+            _device("reader 3", other_key),
+        ]
+
+    def _pool(self):
+        pool = KeyPool(self.fingerprint, "123456", lambda: self.devices)
+        pool.scan()
+        return pool
+
+    def _verify(self, signature, digest):
+        self.key.public_key().verify(
+            signature, digest, ec.ECDSA(Prehashed(hashes.SHA256()))
+        )
+
+    def test_find_keys(self):
+        workers = find_keys(self.fingerprint, devices=self.devices)
+        self.assertEqual(
+            [w.device.fingerprint for w in workers], ["reader 1", "reader 2"]
+        )
+        self.assertEqual([w.slot for w in workers], [SLOT.SIGNATURE] * 2)
+
+    def test_least_loaded(self):
+        pool = self._pool()
+        self.assertEqual(len(pool.workers), 2)
+        pool.workers[0].pending = 1
+        digest = _digest()
+        self._verify(pool.sign(digest, hashes.SHA256()), digest)
+        self.assertEqual(self.devices[0].connection.count(INS_AUTHENTICATE), 0)
+        self.assertEqual(self.devices[1].connection.count(INS_AUTHENTICATE), 1)
+        self.assertEqual(pool.workers[0].pending, 1)
+        self.assertEqual(pool.workers[1].pending, 0)
+
+    def test_pin_verified_once(self):
+        pool = self._pool()
+        for i in range(5):
+            pool.sign(_digest(), hashes.SHA256())
+        for device in self.devices[:2]:
+            self.assertEqual(device.connection.count(INS_VERIFY), 1)
+
+    def test_pin_policy_always(self):
+        self.devices = [_device("reader", self.key, pin_policy=PIN_POLICY.ALWAYS)]
+        pool = self._pool()
+        for i in range(3):
+            digest = _digest(bytes([i]))
+            self._verify(pool.sign(digest, hashes.SHA256()), digest)
+        self.assertEqual(self.devices[0].connection.count(INS_VERIFY), 3)
+
+    def test_retry_on_removal(self):
+        pool = self._pool()
+        self.devices[0].remove()
+        digest = _digest()
+        self._verify(pool.sign(digest, hashes.SHA256()), digest)
+        self.assertEqual([w.device.fingerprint for w in pool.workers], ["reader 2"])
+
+    def test_rescan_when_all_removed(self):
+        pool = self._pool()
+        for device in self.devices:
+            device.remove()
+        with self.assertRaises(ValueError):
+            pool.sign(_digest(), hashes.SHA256())
+        self.assertEqual(pool.workers, [])
+
+        self.devices = [_device("reader 4", self.key)]
+        digest = _digest()
+        self._verify(pool.sign(digest, hashes.SHA256()), digest)
+        self.assertEqual(len(pool.workers), 1)
+
+    def test_handle_request(self):
+        pool = self._pool()
+        response = piv_service.handle_request(
+            pool, {"op": "sign", "data": b"hello".hex()}
+        )
+        self._verify(bytes.fromhex(response["result"]), _digest())
+
+        peer = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        peer_der = peer.public_key().public_bytes(
+            Encoding.DER, PublicFormat.SubjectPublicKeyInfo
+        )
+        response = piv_service.handle_request(
+            pool, {"op": "ecdh", "public_key": peer_der.hex()}
+        )
+        self.assertEqual(
+            bytes.fromhex(response["result"]),
+            peer.exchange(ec.ECDH(), self.key.public_key()),
+        )
+
+        self.assertIn("error", piv_service.handle_request(pool, {"op": "foo"}))
+        self.assertIn("error", piv_service.handle_request(pool, {"op": "sign"}))
+        self.assertIn(
+            "error",
+            piv_service.handle_request(
+                pool, {"op": "decrypt", "data": "00" * 256, "padding": "PKCS1V15"}
+            ),
+        )
+
+    @unittest.skipUnless(hasattr(piv_service, "UnixServer"), "Requires Unix sockets")
+    def test_unix_server(self):
+        pool = self._pool()
+        path = os.path.join(tempfile.mkdtemp(), "piv.sock")
+        server = piv_service.UnixServer(pool, path)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            with sock, sock.makefile("rwb") as f:
+                for i in range(2):
+                    digest = _digest(bytes([i]))
+                    request = {"op": "sign", "digest": digest.hex()}
+                    f.write(json.dumps(request).encode() + b"\n")
+                    f.flush()
+                    response = json.loads(f.readline())
+                    self._verify(bytes.fromhex(response["result"]), digest)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,423 @@
+#  vim: set fileencoding=utf-8 :
+
+from yubikit.core import TRANSPORT, TimeoutError, CommandError
+from yubikit.core.smartcard import SmartCardConnection, SW
+from yubikit.core.otp import (
+    OtpConnection,
+    calculate_crc,
+    FEATURE_RPT_DATA_SIZE,
+    SLOT_DATA_SIZE,
+    RESP_PENDING_FLAG,
+    SLOT_WRITE_FLAG,
+)
+from yubikit.yubiotp import (
+    YubiOtpSession,
+    YubiOtpSlotConfiguration,
+    HotpSlotConfiguration,
+    SLOT,
+    CONFIG_SLOT,
+)
+from ykman.cli import otp as otp_cli
+from ykman.cli.util import YkmanContextObject
+from ykman.otp import (
+    CompiledSlotConfiguration,
+    COMPILED_MIN_VERSIONS,
+    compile_configuration,
+    write_compiled,
+    read_compiled,
+)
+from click.testing import CliRunner
+from .util import benchmark
+from threading import Event
+from time import monotonic, sleep
+from types import SimpleNamespace
+from unittest import mock
+import hashlib
+import hmac
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+
+def _with_crc(data):
+    return data + struct.pack("<H", ~calculate_crc(data) & 0xFFFF)
+
+
+class VirtualOtpConnection(OtpConnection):
+    """Emulates the HID feature report protocol of a YubiKey, with a delay for
+    processing each command."""
+
+    def __init__(self, processing_time=0.005):
+        self.processing_time = processing_time
+        self.version = (5, 2, 7)
+        self.prog_seq = 1
+        self.touch_level = 0x0002  # Slot 2 configured
+        self.serial = 123456
+        self.hmac_keys = {CONFIG_SLOT.CHAL_HMAC_2: b"secret"}
+        self.commands = []
+        self.payloads = []
+        self._buf = bytearray(70)
+        self._ready_at = None
+        self._response = None
+
+    @property
+    def transport(self):
+        return TRANSPORT.USB
+
+    def close(self):
+        pass
+
+    def _status(self, flags=0):
+        return (
+            b"\0"
+            + bytes(self.version)
+            + struct.pack("<BH", self.prog_seq, self.touch_level)
+            + bytes([flags])
+        )
+
+    def send(self, data):
+        flags = data[FEATURE_RPT_DATA_SIZE]
+        if flags == 0xFF:  # Reset
+            self._response = None
+            return
+        seq = flags & 0x1F
+        offset = seq * FEATURE_RPT_DATA_SIZE
+        self._buf[offset : offset + FEATURE_RPT_DATA_SIZE] = data[:-1]
+        if seq == 9:  # Last report of the frame
+            payload = bytes(self._buf[:SLOT_DATA_SIZE])
+            slot = self._buf[SLOT_DATA_SIZE]
+            self._buf = bytearray(70)
+            self.commands.append(slot)
+            self.payloads.append(payload)
+            self._ready_at = monotonic() + self.processing_time
+            self._response = self._process(slot, payload)
+
+    def _process(self, slot, payload):
+        if slot in self.hmac_keys:
+            challenge = payload.rstrip(payload[-1:])
+            return _with_crc(hmac.new(self.hmac_keys[slot], challenge, "sha1").digest())
+        if slot == CONFIG_SLOT.DEVICE_SERIAL:
+            return _with_crc(struct.pack(">I", self.serial))
+        self.prog_seq += 1
+        return None
+
+    def receive(self):
+        if self._ready_at is None:
+            return self._status()
+        if monotonic() < self._ready_at:
+            return self._status(SLOT_WRITE_FLAG)  # Still processing
+        if self._response is None:  # Configuration updated
+            self._ready_at = None
+            return self._status()
+        if isinstance(self._response, bytes):
+            data = self._response.ljust(-(-len(self._response) // 7) * 7, b"\0")
+            self._response = [
+                data[i : i + 7] + bytes([RESP_PENDING_FLAG | i // 7])
+                for i in range(0, len(data), 7)
+            ] + [b"\0" * 7 + bytes([RESP_PENDING_FLAG])]
+        report = self._response.pop(0)
+        if not self._response:
+            self._ready_at = None
+        return report
+
+
+class NoOtpCcidConnection(SmartCardConnection):
+    """A CCID connection to a YubiKey without the OTP application over CCID."""
+
+    def __init__(self):
+        self.closed = False
+
+    @property
+    def transport(self):
+        return TRANSPORT.USB
+
+    def close(self):
+        self.closed = True
+
+    def send_and_receive(self, apdu):
+        return b"", SW.FILE_NOT_FOUND
+
+
+class RecordingEvent(Event):
+    def __init__(self):
+        super(RecordingEvent, self).__init__()
+        self.timeouts = []
+
+    def wait(self, timeout=None):
+        self.timeouts.append(timeout)
+        return super(RecordingEvent, self).wait(timeout)
+
+
+class TestOtpProtocol(unittest.TestCase):
+    def setUp(self):
+        self.conn = VirtualOtpConnection()
+        self.session = YubiOtpSession(self.conn)
+
+    def test_calculate_hmac_sha1(self):
+        response = self.session.calculate_hmac_sha1(SLOT.TWO, b"challenge")
+        self.assertEqual(
+            hmac.new(b"secret", b"challenge", hashlib.sha1).digest(), response
+        )
+        self.assertEqual(123456, self.session.get_serial())
+
+    def test_write_configuration(self):
+        self.session.swap_slots()
+        self.assertEqual([CONFIG_SLOT.SWAP], self.conn.commands)
+        self.assertEqual(2, self.session._status[3])
+
+    def test_poll_backoff(self):
+        self.conn.processing_time = 0.05
+        event = RecordingEvent()
+        self.session.calculate_hmac_sha1(SLOT.TWO, b"challenge", event)
+        timeouts = event.timeouts
+        self.assertEqual(0.001, timeouts[0])
+        self.assertEqual(timeouts, sorted(timeouts), "Delays should never get shorter")
+        self.assertEqual(0.02, max(timeouts))
+
+    def test_cancel(self):
+        self.conn.processing_time = 1
+        event = Event()
+        event.set()
+        with self.assertRaises(TimeoutError):
+            self.session.calculate_hmac_sha1(SLOT.TWO, b"challenge", event)
+
+    @benchmark
+    def test_latency(self):
+        # Benchmark against the virtual YubiKey. With fixed delays of 2 x 20 ms per
+        # poll, each challenge used to take at least 40 ms.
+        count = 20
+        start = monotonic()
+        for i in range(count):
+            self.session.calculate_hmac_sha1(SLOT.TWO, struct.pack(">I", i))
+        latency = (monotonic() - start) / count
+        self.assertLess(latency, 0.025)
+
+    def test_busy_before_write(self):
+        # The YubiKey is still busy with a previous command
+        self.conn._ready_at = monotonic() + 0.01
+        self.conn._response = None
+        sleep(0.001)
+        self.session.swap_slots()
+        self.assertEqual([CONFIG_SLOT.SWAP], self.conn.commands)
+
+    def test_calculate_hmac_sha1_many(self):
+        challenges = [struct.pack(">I", i) for i in range(5)] + [b"ends with\0"]
+        responses = self.session.calculate_hmac_sha1_many(SLOT.TWO, iter(challenges))
+        self.assertEqual([], self.conn.commands)  # Nothing sent until needed
+        for challenge, response in zip(challenges, responses):
+            self.assertEqual(
+                hmac.new(b"secret", challenge, hashlib.sha1).digest(), response
+            )
+        self.assertEqual([CONFIG_SLOT.CHAL_HMAC_2] * 6, self.conn.commands)
+
+
+class TestCompiledConfiguration(unittest.TestCase):
+    def test_write_read(self):
+        config = YubiOtpSlotConfiguration(b"\xff\0\0\0\0\1", b"\1" * 6, b"\2" * 16)
+        entry = compile_configuration(
+            1, config, b"\3" * 6, public_id=b"\xff\0\0\0\0\1", key=b"\2" * 16
+        )
+        f = io.StringIO()
+        write_compiled(f, "yubiotp", [entry])
+        self.assertIn('"public_id": "vvcccccccccb"', f.getvalue())
+        f.seek(0)
+        config_type, entries = read_compiled(f)
+        self.assertEqual("yubiotp", config_type)
+        self.assertEqual([entry], entries)
+        self.assertEqual(config.get_config(b"\3" * 6), entries[0]["config"])
+
+    def test_read_sorted(self):
+        config = HotpSlotConfiguration(b"\1" * 20)
+        f = io.StringIO()
+        write_compiled(f, "hotp", [compile_configuration(i, config) for i in (2, 1)])
+        f.seek(0)
+        _, entries = read_compiled(f)
+        self.assertEqual([1, 2], [e["sequence"] for e in entries])
+
+    def test_read_invalid(self):
+        with self.assertRaises(ValueError):
+            read_compiled(io.StringIO('{"format": "other"}\n'))
+        with self.assertRaises(ValueError):
+            read_compiled(io.StringIO(""))
+        f = io.StringIO()
+        write_compiled(f, "hotp", [{"sequence": 1, "config": b"\0" * 10}])
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            read_compiled(f)
+
+    def test_read_unsupported_type(self):
+        f = io.StringIO()
+        write_compiled(f, "chalresp", [])
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            read_compiled(f)
+
+    def test_min_version(self):
+        config = CompiledSlotConfiguration(
+            HotpSlotConfiguration(b"\1" * 20).get_config(),
+            COMPILED_MIN_VERSIONS["hotp"],
+        )
+        self.assertFalse(config.is_supported_by((2, 1, 0)))
+        self.assertTrue(config.is_supported_by((2, 2, 0)))
+
+    def test_put_compiled(self):
+        conn = VirtualOtpConnection()
+        session = YubiOtpSession(conn)
+        config = HotpSlotConfiguration(b"\1" * 20).get_config(b"\3" * 6)
+        session.put_configuration(SLOT.ONE, CompiledSlotConfiguration(config))
+        self.assertEqual([CONFIG_SLOT.CONFIG_1], conn.commands)
+        self.assertEqual(config, conn.payloads[0][: len(config)])
+
+
+def _invoke(*args, **kwargs):
+    return CliRunner().invoke(
+        otp_cli.otp, list(args), obj=YkmanContextObject(), **kwargs
+    )
+
+
+class TestCompileFlash(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def compile(self, config_type="hotp", count=2):
+        result = _invoke("compile", config_type, "-n", str(count), "batch.json")
+        self.assertEqual(0, result.exit_code, result.output)
+        with open("batch.json") as f:
+            return read_compiled(f)[1]
+
+    def flash(self, *conns, args=(), exit_code=0):
+        inserted = [
+            (conn, None, SimpleNamespace(serial=serial))
+            for serial, conn in enumerate(conns, 1)
+        ]
+        with mock.patch.object(
+            otp_cli, "_wait_for_insert", side_effect=inserted
+        ), mock.patch.object(otp_cli, "_wait_for_removal"):
+            result = _invoke("flash", "1", "batch.json", "flashed.log", *args)
+        self.assertEqual(exit_code, result.exit_code, result.output)
+        return self.read_log("done"), result.output
+
+    def read_log(self, status):
+        with open("flashed.log") as f:
+            records = [json.loads(line) for line in f]
+        return [
+            {"sequence": r["sequence"], "serial": r["serial"]}
+            for r in records
+            if r.get("status", "done") == status
+        ]
+
+    def test_compile_yubiotp(self):
+        entries = self.compile("yubiotp", 3)
+        self.assertEqual([1, 2, 3], [e["sequence"] for e in entries])
+        self.assertEqual(
+            [b"\xff\0\0\0\0" + bytes([i]) for i in (1, 2, 3)],
+            [e["public_id"] for e in entries],
+        )
+        self.assertEqual(3, len({e["key"] for e in entries}))
+
+    def test_compile_prefix_too_long(self):
+        result = _invoke("compile", "yubiotp", "-n", "256", "-P", "vvcccccccc", "x")
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIn("too long for the sequence numbers", result.output)
+
+    def test_flash(self):
+        entries = self.compile()
+        keys = [VirtualOtpConnection(0), VirtualOtpConnection(0)]
+        log, _ = self.flash(*keys)
+        self.assertEqual(
+            [{"sequence": 1, "serial": 1}, {"sequence": 2, "serial": 2}], log
+        )
+        for key, entry in zip(keys, entries):
+            self.assertEqual([CONFIG_SLOT.CONFIG_1], key.commands)
+            self.assertEqual(entry["config"], key.payloads[0][: len(entry["config"])])
+
+    def test_flash_prefers_hid(self):
+        # CCID may need scdaemon to be stopped, so it is only preferred on request
+        self.compile(count=1)
+        with mock.patch.object(
+            otp_cli, "_wait_for_insert", side_effect=KeyboardInterrupt
+        ) as wait:
+            _invoke("flash", "1", "batch.json", "flashed.log")
+            _invoke("--transport", "ccid", "flash", "1", "batch.json", "flashed.log")
+        self.assertEqual(
+            [
+                mock.call([OtpConnection, SmartCardConnection]),
+                mock.call([SmartCardConnection, OtpConnection]),
+            ],
+            wait.call_args_list,
+        )
+
+    def test_flash_resume(self):
+        self.compile()
+        with open("flashed.log", "w") as f:
+            f.write(json.dumps({"sequence": 1, "serial": 9}) + "\n")
+        log, _ = self.flash(VirtualOtpConnection(0))
+        self.assertEqual([1, 2], [e["sequence"] for e in log])
+
+    def test_flash_failed_write(self):
+        self.compile()
+        with mock.patch.object(
+            otp_cli.YubiOtpSession,
+            "put_configuration",
+            side_effect=CommandError("Write failed"),
+        ):
+            self.flash(VirtualOtpConnection(0), exit_code=2)
+        # The write may still have reached the YubiKey
+        self.assertEqual([{"sequence": 1, "serial": 1}], self.read_log("pending"))
+
+        # Resuming never gives the pending configuration to another YubiKey
+        key = VirtualOtpConnection(0)
+        log, output = self.flash(key)
+        self.assertIn("Configuration 1 may have been written to YubiKey 1", output)
+        self.assertEqual([{"sequence": 2, "serial": 1}], log)
+
+    def test_flash_skip_configured(self):
+        self.compile()
+        configured = VirtualOtpConnection(0)
+        configured.touch_level = 0x0001  # Slot 1 configured
+        keys = [VirtualOtpConnection(0), configured, VirtualOtpConnection(0)]
+        log, output = self.flash(*keys)
+        self.assertIn("Slot 1 of YubiKey 2 is already configured", output)
+        self.assertEqual([], configured.commands)
+        self.assertEqual(
+            [{"sequence": 1, "serial": 1}, {"sequence": 2, "serial": 3}], log
+        )
+
+    def test_flash_force(self):
+        self.compile(count=1)
+        configured = VirtualOtpConnection(0)
+        configured.touch_level = 0x0001
+        log, _ = self.flash(configured, args=["--force"])
+        self.assertEqual([{"sequence": 1, "serial": 1}], log)
+
+    def test_flash_skip_unsupported(self):
+        self.compile(count=1)
+        old = VirtualOtpConnection(0)
+        old.version = (2, 1, 0)
+        log, output = self.flash(old, VirtualOtpConnection(0))
+        self.assertIn("YubiKey 1 does not support hotp configurations", output)
+        self.assertEqual([], old.commands)
+        self.assertEqual([{"sequence": 1, "serial": 2}], log)
+
+    def test_flash_hid_fallback(self):
+        self.compile(count=1)
+        ccid = NoOtpCcidConnection()
+        hid = VirtualOtpConnection(0)
+        with mock.patch.object(
+            otp_cli, "connect_to_device", return_value=(hid, None, None)
+        ) as connect:
+            log, _ = self.flash(ccid)
+        connect.assert_called_once_with(1, [OtpConnection])
+        self.assertTrue(ccid.closed)
+        self.assertEqual([CONFIG_SLOT.CONFIG_1], hid.commands)
+        self.assertEqual([{"sequence": 1, "serial": 1}], log)
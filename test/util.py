@@ -1,6 +1,7 @@
 import datetime
 import logging
 import os
+import unittest
 
 from click.testing import CliRunner
 from cryptography import x509
@@ -18,6 +19,11 @@ logger = logging.getLogger(__name__)
 
 PKG_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Benchmarks depend on the speed of the machine, so they only run when asked for
+benchmark = unittest.skipUnless(
+    os.environ.get("YKMAN_BENCHMARK") == "TRUE", "Set YKMAN_BENCHMARK=TRUE to run"
+)
+
 
 def open_file(*relative_path):
     return open(os.path.join(PKG_DIR, "files", *relative_path), "rb")
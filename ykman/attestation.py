@@ -0,0 +1,367 @@
+# Copyright (c) 2020 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from yubikit.core import Tlv, Version, FORM_FACTOR
+from yubikit.piv import PIN_POLICY, TOUCH_POLICY
+
+from .opgp import TOUCH_MODE
+from .util import parse_certificates
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.backends import default_backend
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Union
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Extensions in PIV attestation certificates
+OID_PIV_FIRMWARE = x509.ObjectIdentifier("1.3.6.1.4.1.41482.3.3")
+OID_PIV_SERIAL = x509.ObjectIdentifier("1.3.6.1.4.1.41482.3.7")
+OID_PIV_POLICY = x509.ObjectIdentifier("1.3.6.1.4.1.41482.3.8")
+OID_PIV_FORM_FACTOR = x509.ObjectIdentifier("1.3.6.1.4.1.41482.3.9")
+
+# Extensions in OpenPGP attestation certificates
+OID_OPGP_SOURCE = x509.ObjectIdentifier("1.3.6.1.4.1.41482.5.2")
+OID_OPGP_FIRMWARE = x509.ObjectIdentifier("1.3.6.1.4.1.41482.5.3")
+OID_OPGP_SERIAL = x509.ObjectIdentifier("1.3.6.1.4.1.41482.5.7")
+OID_OPGP_TOUCH = x509.ObjectIdentifier("1.3.6.1.4.1.41482.5.8")
+OID_OPGP_FORM_FACTOR = x509.ObjectIdentifier("1.3.6.1.4.1.41482.5.9")
+
+
+# CA certificates allowed below a root: a Yubico intermediate CA, and the F9
+# attestation certificate of the YubiKey.
+MAX_INTERMEDIATES = 2
+
+
+class InvalidAttestation(Exception):
+    """The attestation could not be verified against the trusted roots."""
+
+
+@dataclass
+class AttestationResult:
+    public_key: bytes  # DER encoded SubjectPublicKeyInfo of the attested key
+    serial: Optional[int]
+    version: Optional[Version]
+    form_factor: Optional[FORM_FACTOR]
+    pin_policy: Optional[PIN_POLICY]  # PIV only
+    touch_policy: Optional[Union[TOUCH_POLICY, TOUCH_MODE]]
+    generated: bool
+
+
+def _get_extension(cert, oid):
+    try:
+        return cert.extensions.get_extension_for_oid(oid).value.value
+    except x509.ExtensionNotFound:
+        return None
+
+
+def _parse_int(value):
+    if value[0] == 0x02 and value[1] == len(value) - 2:  # ASN.1 INTEGER
+        value = Tlv.unwrap(0x02, value)
+    return int.from_bytes(value, "big")
+
+
+def _parse_form_factor(value):
+    try:
+        return FORM_FACTOR(value[0] & 0x0F)  # Upper bits are used for flags
+    except ValueError:
+        return FORM_FACTOR.UNKNOWN
+
+
+def parse_attestation(cert):
+    """Reads the YubiKey specific extensions of a PIV or OpenPGP attestation.
+
+    The attestation is not verified, see AttestationVerifier for that.
+    """
+    public_key = cert.public_key().public_bytes(
+        Encoding.DER, PublicFormat.SubjectPublicKeyInfo
+    )
+    if _get_extension(cert, OID_OPGP_FIRMWARE) is not None:
+        firmware = _get_extension(cert, OID_OPGP_FIRMWARE)
+        serial = _get_extension(cert, OID_OPGP_SERIAL)
+        touch = _get_extension(cert, OID_OPGP_TOUCH)
+        form_factor = _get_extension(cert, OID_OPGP_FORM_FACTOR)
+        source = _get_extension(cert, OID_OPGP_SOURCE)
+        return AttestationResult(
+            public_key,
+            _parse_int(serial) if serial else None,
+            Version.from_bytes(firmware),
+            _parse_form_factor(form_factor) if form_factor else None,
+            None,
+            TOUCH_MODE(touch[0]) if touch else None,
+            source == b"\1",
+        )
+
+    # Only keys generated on the YubiKey can be attested using PIV
+    firmware = _get_extension(cert, OID_PIV_FIRMWARE)
+    serial = _get_extension(cert, OID_PIV_SERIAL)
+    policy = _get_extension(cert, OID_PIV_POLICY)
+    form_factor = _get_extension(cert, OID_PIV_FORM_FACTOR)
+    return AttestationResult(
+        public_key,
+        _parse_int(serial) if serial else None,
+        Version.from_bytes(firmware) if firmware else None,
+        _parse_form_factor(form_factor) if form_factor else None,
+        PIN_POLICY(policy[0]) if policy else None,
+        TOUCH_POLICY(policy[1]) if policy else None,
+        True,
+    )
+
+
+def _get_key_id(cert):
+    try:
+        ski = cert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier)
+        return ski.value.digest
+    except x509.ExtensionNotFound:
+        return x509.SubjectKeyIdentifier.from_public_key(cert.public_key()).digest
+
+
+def _get_issuer_key_id(cert):
+    try:
+        aki = cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier)
+        return aki.value.key_identifier
+    except x509.ExtensionNotFound:
+        return None  # Not included in YubiKey attestation certificates
+
+
+def _get_ca_path_length(cert):
+    """Returns the path length constraint of a CA certificate, or -1 if the
+    certificate is not a CA."""
+    try:
+        constraints = cert.extensions.get_extension_for_class(x509.BasicConstraints)
+    except x509.ExtensionNotFound:
+        return -1
+    if not constraints.value.ca:
+        return -1
+    path_length = constraints.value.path_length
+    return MAX_INTERMEDIATES if path_length is None else path_length
+
+
+def _is_signed_by(cert, issuer):
+    if cert.issuer != issuer.subject:
+        return False
+    public_key = issuer.public_key()
+    try:
+        if isinstance(public_key, rsa.RSAPublicKey):
+            public_key.verify(
+                cert.signature,
+                cert.tbs_certificate_bytes,
+                padding.PKCS1v15(),
+                cert.signature_hash_algorithm,
+            )
+        elif isinstance(public_key, ec.EllipticCurvePublicKey):
+            public_key.verify(
+                cert.signature,
+                cert.tbs_certificate_bytes,
+                ec.ECDSA(cert.signature_hash_algorithm),
+            )
+        else:
+            return False
+    except InvalidSignature:
+        return False
+    return True
+
+
+class AttestationVerifier(object):
+    """Verifies attestation certificates, against a set of trusted root CAs.
+
+    Intermediate certificates, such as the attestation certificate in slot F9 of
+    the YubiKey, are verified once and then cached, indexed by their key
+    identifier. Only CA certificates are trusted as issuers, and chains are at most
+    root, Yubico intermediate CA, F9 certificate and attestation. The cache holds
+    at most cache_size intermediates, evicting the least recently used.
+    """
+
+    def __init__(self, roots, cache_size=1024):
+        self._cache_size = cache_size
+        self._trusted = {}  # key identifier -> certificates
+        self._by_name = {}  # subject -> certificates, for issuers without AKI
+        self._path_lengths = {}  # certificate -> CA certificates allowed below it
+        self._intermediates = OrderedDict()  # certificate -> None, in LRU order
+        self._certificates = OrderedDict()  # DER -> parsed certificate
+        self._roots = [self._load(root) for root in roots]
+        for root in self._roots:
+            path_length = _get_ca_path_length(root)
+            if path_length < 0:
+                raise ValueError("Root certificate is not a CA: %s" % root.subject)
+            self._add_trusted(root, min(path_length, MAX_INTERMEDIATES))
+
+    @classmethod
+    def from_file(cls, path):
+        """Creates a verifier using the roots in a PEM or DER file."""
+        with open(path, "rb") as f:
+            return cls(parse_certificates(f.read(), None))
+
+    def _load(self, cert, cache=True):
+        if isinstance(cert, x509.Certificate):
+            return cert
+        if not cache:
+            return x509.load_der_x509_certificate(cert, default_backend())
+        if cert in self._certificates:
+            self._certificates.move_to_end(cert)
+        else:
+            self._certificates[cert] = x509.load_der_x509_certificate(
+                cert, default_backend()
+            )
+            if len(self._certificates) > self._cache_size:
+                self._certificates.popitem(last=False)
+        return self._certificates[cert]
+
+    def _add_trusted(self, cert, path_length):
+        self._trusted.setdefault(_get_key_id(cert), []).append(cert)
+        self._by_name.setdefault(cert.subject, []).append(cert)
+        self._path_lengths[cert] = path_length
+
+    def _remove_trusted(self, cert):
+        for index, key in (
+            (self._trusted, _get_key_id(cert)),
+            (self._by_name, cert.subject),
+        ):
+            index[key].remove(cert)
+            if not index[key]:
+                del index[key]
+        del self._path_lengths[cert]
+
+    def _touch(self, cert):
+        if cert in self._intermediates:
+            self._intermediates.move_to_end(cert)
+
+    def _is_trusted(self, cert):
+        return cert in self._trusted.get(_get_key_id(cert), [])
+
+    def _find_issuer(self, cert, is_ca=False, given=()):
+        key_id = _get_issuer_key_id(cert)
+        if key_id is not None:
+            candidates = self._trusted.get(key_id, [])
+        else:
+            # All F9 certificates share a name, so only fall back to looking up
+            # the issuer by name when it wasn't given along with the certificate.
+            candidates = [
+                c for c in given if c.subject == cert.issuer and self._is_trusted(c)
+            ] or self._by_name.get(cert.issuer, [])
+        for issuer in candidates:
+            if is_ca and self._path_lengths[issuer] < 1:
+                continue  # No more CA certificates allowed in the chain
+            if _is_signed_by(cert, issuer):
+                self._touch(issuer)
+                return issuer
+        return None
+
+    def _add_intermediate(self, cert, given):
+        path_length = _get_ca_path_length(cert)
+        if path_length < 0:
+            return False  # Not a CA, can't issue other certificates
+        issuer = self._find_issuer(cert, True, given)
+        if issuer is None:
+            return False
+        self._add_trusted(cert, min(path_length, self._path_lengths[issuer] - 1))
+        self._intermediates[cert] = None
+        if len(self._intermediates) > self._cache_size:
+            self._remove_trusted(self._intermediates.popitem(last=False)[0])
+        return True
+
+    def add_intermediates(self, certs):
+        """Verifies intermediate CA certificates, and trusts the ones that are valid.
+
+        Certificates may be given in any order, and as DER encoded bytes.
+        Certificates which are not CAs are ignored. Returns the parsed certificates.
+        """
+        given = [self._load(cert) for cert in certs]
+        pending = []
+        for cert in given:
+            if self._is_trusted(cert):
+                self._touch(cert)
+            else:
+                pending.append(cert)
+        while pending:
+            remaining = [c for c in pending if not self._add_intermediate(c, given)]
+            if len(remaining) == len(pending):
+                break  # No progress, remaining certificates are not trusted
+            pending = remaining
+        for cert in pending:
+            logger.debug("Untrusted intermediate certificate: %s", cert.subject)
+        return given
+
+    def verify(self, attestation, intermediates=()):
+        """Verifies an attestation certificate, and returns an AttestationResult.
+
+        The attestation and intermediate certificates may be given as DER encoded
+        bytes. The given intermediates are tried as issuers first, so passing the F9
+        certificate along with the attestation avoids searching the cache. Raises
+        InvalidAttestation if the certificate can't be verified.
+        """
+        given = self.add_intermediates(intermediates)
+        cert = self._load(attestation, cache=False)
+        if self._find_issuer(cert, given=given) is None:
+            raise InvalidAttestation(
+                "Attestation is not issued by a trusted certificate: %s" % cert.subject
+            )
+        return parse_attestation(cert)
+
+    def verify_many(self, attestations, max_workers=None, chunksize=16):
+        """Verifies many attestations, using a pool of processes.
+
+        attestations is an iterable of (attestation, intermediates) pairs, given
+        as DER encoded bytes. Returns a list with the AttestationResult, or the
+        InvalidAttestation error, for each attestation, in the same order.
+        """
+        # Workers start out trusting the intermediates verified so far
+        roots = [cert.public_bytes(Encoding.DER) for cert in self._roots]
+        intermediates = [
+            cert.public_bytes(Encoding.DER) for cert in self._intermediates
+        ]
+        with ProcessPoolExecutor(
+            max_workers, initializer=_init_worker, initargs=(roots, intermediates)
+        ) as executor:
+            return list(executor.map(_verify, attestations, chunksize=chunksize))
+
+
+_worker_verifier = None
+
+
+def _init_worker(roots, intermediates):
+    global _worker_verifier
+    _worker_verifier = AttestationVerifier(roots)
+    _worker_verifier.add_intermediates(intermediates)
+
+
+def _verify(item):
+    attestation, intermediates = item
+    try:
+        return _worker_verifier.verify(attestation, intermediates)
+    except InvalidAttestation as e:
+        return e
+    except ValueError as e:  # Malformed certificate
+        return InvalidAttestation("Invalid certificate: %s" % e)
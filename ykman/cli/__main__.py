@@ -42,7 +42,7 @@ from ..device import (
     get_connection_types,
     connect_to_device,
 )
-from .util import UpperCaseChoice, YkmanContextObject
+from .util import UpperCaseChoice, YkmanContextObject, PREFERRED_INTERFACES
 from .info import info
 from .mode import mode
 from .otp import otp
@@ -63,10 +63,12 @@ logger = logging.getLogger(__name__)
 CLICK_CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"], max_content_width=999)
 
 
-def retrying_connect(serial, interfaces, attempts=10):
+def retrying_connect(serial, interfaces, attempts=10, preferred=()):
     while True:
         try:
-            return connect_to_device(serial, get_connection_types(interfaces))
+            return connect_to_device(
+                serial, get_connection_types(interfaces, preferred)
+            )
         except Exception as e:
             if attempts:
                 attempts -= 1
@@ -92,9 +94,9 @@ def _disabled_interface(ctx, interfaces, cmd_name):
     ctx.fail("Use 'ykman config usb' to set the enabled USB interfaces.")
 
 
-def _run_cmd_for_serial(ctx, cmd, interfaces, serial):
+def _run_cmd_for_serial(ctx, cmd, interfaces, serial, preferred=()):
     try:
-        return retrying_connect(serial, interfaces)
+        return retrying_connect(serial, interfaces, preferred=preferred)
     except ValueError:
         try:
             # Serial not found, see if it's among other interfaces in USB enabled:
@@ -109,7 +111,7 @@ def _run_cmd_for_serial(ctx, cmd, interfaces, serial):
             )
 
 
-def _run_cmd_for_single(ctx, cmd, interfaces, reader_name=None):
+def _run_cmd_for_single(ctx, cmd, interfaces, reader_name=None, preferred=()):
     # Use a specific CCID reader
     if reader_name:
         if USB_INTERFACE.CCID in interfaces or cmd in (fido.name, otp.name):
@@ -147,7 +149,7 @@ def _run_cmd_for_single(ctx, cmd, interfaces, reader_name=None):
     # Only one connected device, check if any needed interfaces are available
     pid = next(iter(devices.keys()))
     if pid.get_interfaces() & interfaces:
-        return retrying_connect(None, interfaces)
+        return retrying_connect(None, interfaces, preferred=preferred)
     _disabled_interface(ctx, interfaces, cmd)
 
 
@@ -217,13 +219,14 @@ def cli(ctx, device, log_level, log_file, reader):
 
         def resolve():
             if not getattr(resolve, "items", None):
+                preferred = ctx.meta.get(PREFERRED_INTERFACES, ())
                 if device is not None:
                     resolve.items = _run_cmd_for_serial(
-                        ctx, subcmd.name, interfaces, device
+                        ctx, subcmd.name, interfaces, device, preferred
                     )
                 else:
                     resolve.items = _run_cmd_for_single(
-                        ctx, subcmd.name, interfaces, reader
+                        ctx, subcmd.name, interfaces, reader, preferred
                     )
                 ctx.call_on_close(resolve.items[0].close)
             return resolve.items
@@ -28,6 +28,7 @@
 import click
 import logging
 from threading import Timer
+from time import time, sleep
 from .util import (
     click_force_option,
     click_postpone_execution,
@@ -36,23 +37,34 @@ from .util import (
     click_prompt,
     prompt_for_touch,
     EnumChoice,
+    click_complete,
 )
-from yubikit.core import USB_INTERFACE
-from yubikit.core.smartcard import ApduError, SW
+from yubikit.core import USB_INTERFACE, CommandError, ConnectionLostError
+from yubikit.core.smartcard import SmartCardConnection, ApduError, SW
 from yubikit.oath import (
     OathSession,
+    Credential,
     CredentialData,
     OATH_TYPE,
     HASH_ALGORITHM,
+    DEFAULT_PERIOD,
     parse_b32_key,
 )
-from ..oath import is_steam, calculate_steam, is_hidden
-from ..device import is_fips_version
+from ..oath import (
+    is_steam,
+    is_hidden,
+    calculate_code,
+    calculate_all,
+    parse_credentials,
+)
+from ..device import is_fips_version, connect_to_device
 from ..settings import Settings
 
 
 logger = logging.getLogger(__name__)
 
+CACHE_NAME = "oath_cache"
+
 click_touch_option = click.option(
     "-t", "--touch", is_flag=True, help="Require touch on YubiKey to generate code."
 )
@@ -67,6 +79,103 @@ def _string_id(credential):
     return credential.id.decode("utf-8")
 
 
+def _update_cache(ctx, creds):
+    app = ctx.obj["controller"]
+    device_id = app.info.device_id
+    if ctx.obj["protected"] and device_id not in ctx.obj["settings"].get("keys", {}):
+        # Don't store credential names for keys which require a password
+        _forget_cached_credentials(ctx, device_id)
+        return
+
+    cache = ctx.obj["cache"]
+    old = {c["id"]: c for c in cache.get(device_id, {}).get("credentials", [])}
+    credentials = []
+    for cred in sorted(creds, key=lambda c: c.id):
+        cred_id = _string_id(cred)
+        touch_required = cred.touch_required
+        if touch_required is None and cred_id in old:  # LIST doesn't include touch
+            touch_required = old[cred_id]["touch_required"]
+        credentials.append(
+            {
+                "id": cred_id,
+                "issuer": cred.issuer,
+                "name": cred.name,
+                "oath_type": cred.oath_type.name,
+                "period": cred.period,
+                "touch_required": touch_required,
+            }
+        )
+
+    serial = ctx.obj["info"].serial
+    entry = {"serial": serial, "credentials": credentials}
+    stale = _stale_cache_entries(cache, serial, device_id)
+    if cache.get(device_id) != entry or stale:
+        for stale_id in stale:
+            del cache[stale_id]
+        cache[device_id] = entry
+        cache.write()
+
+
+def _stale_cache_entries(cache, serial, device_id):
+    # The device ID is derived from the salt, which changes when the OATH application
+    # is reset, so entries for the same serial with other IDs are out of date.
+    if serial is None:
+        return []
+    return [k for k, e in cache.items() if e.get("serial") == serial and k != device_id]
+
+
+def _invalidate_cache(ctx):
+    cache = ctx.obj["cache"]
+    stale = _stale_cache_entries(
+        cache, ctx.obj["info"].serial, ctx.obj["controller"].info.device_id
+    )
+    for device_id in stale:
+        del cache[device_id]
+    if stale:
+        cache.write()
+
+
+def _forget_cached_credentials(ctx, device_id):
+    cache = ctx.obj["cache"]
+    if cache.pop(device_id, None) is not None:
+        cache.write()
+
+
+def _get_cached_credentials(ctx):
+    """Read cached credentials without connecting to the YubiKey.
+
+    Returns a list of credential lists, one per cached YubiKey, limited to the
+    YubiKey given by --device, if any.
+    """
+    serial = ctx.find_root().params.get("device")
+    caches = []
+    for device_id, entry in Settings(CACHE_NAME).items():
+        if serial is None or entry.get("serial") == serial:
+            caches.append(
+                [
+                    Credential(
+                        device_id,
+                        c["id"].encode("utf-8"),
+                        c["issuer"],
+                        c["name"],
+                        OATH_TYPE[c["oath_type"]],
+                        c["period"],
+                        c["touch_required"],
+                    )
+                    for c in entry["credentials"]
+                ]
+            )
+    return caches
+
+
+def _complete_query(ctx, incomplete):
+    try:
+        creds = [c for caches in _get_cached_credentials(ctx) for c in caches]
+    except Exception:  # Never fail completion
+        return []
+    return sorted({_string_id(c) for c in _search(creds, incomplete, False)})
+
+
 @click_callback()
 def _clear_callback(ctx, param, clear):
     if clear:
@@ -119,10 +228,13 @@ def oath(ctx, password):
         controller = OathSession(ctx.obj["conn"])
         ctx.obj["controller"] = controller
         ctx.obj["settings"] = Settings("oath")
+        ctx.obj["cache"] = Settings(CACHE_NAME)
+        ctx.obj["protected"] = controller.locked
     except ApduError as e:
         if e.sw == SW.FILE_NOT_FOUND:
             ctx.fail("The OATH application can't be found on this YubiKey.")
         raise
+    _invalidate_cache(ctx)
 
     if password:
         ctx.obj["key"] = controller.derive_key(password)
@@ -173,6 +285,7 @@ def reset(ctx):
     if old_id in keys:
         del keys[old_id]
         settings.write()
+    _forget_cached_credentials(ctx, old_id)
 
     click.echo("Success! All OATH credentials have been cleared from your YubiKey.")
 
@@ -296,26 +409,35 @@ def uri(ctx, uri, touch, force):
     _add_cred(ctx, data, touch, force)
 
 
-def _add_cred(ctx, data, touch, force):
-    app = ctx.obj["controller"]
-    version = app.info.version
-
+def _check_cred_data(data, touch, version):
+    """Returns an error message if the credential can't be added, else None."""
     if not (0 < len(data.name) <= 64):
-        ctx.fail("Name must be between 1 and 64 bytes.")
+        return "Name must be between 1 and 64 bytes."
 
     if len(data.secret) < 2:
-        ctx.fail("Secret must be at least 2 bytes.")
+        return "Secret must be at least 2 bytes."
 
     if touch and version < (4, 2, 6):
-        ctx.fail("Touch-required credentials not supported on this key.")
+        return "Touch-required credentials not supported on this key."
 
     if data.counter and data.oath_type != OATH_TYPE.HOTP:
-        ctx.fail("Counter only supported for HOTP credentials.")
+        return "Counter only supported for HOTP credentials."
 
     if data.hash_algorithm == HASH_ALGORITHM.SHA512 and (
         version < (4, 3, 1) or is_fips_version(version)
     ):
-        ctx.fail("Algorithm SHA512 not supported on this YubiKey.")
+        return "Algorithm SHA512 not supported on this YubiKey."
+
+    return None
+
+
+def _add_cred(ctx, data, touch, force):
+    app = ctx.obj["controller"]
+    version = app.info.version
+
+    error = _check_cred_data(data, touch, version)
+    if error:
+        ctx.fail(error)
 
     creds = app.list_credentials()
     cred_id = data.get_id()
@@ -337,7 +459,8 @@ def _add_cred(ctx, data, touch, force):
         ctx.fail("Choose a name that is not a subset of an existing credential.")
 
     try:
-        app.put_credential(data, touch)
+        cred = app.put_credential(data, touch)
+        _update_cache(ctx, [c for c in creds if c.id != cred_id] + [cred])
     except ApduError as e:
         if e.sw == SW.NO_SPACE:
             ctx.fail("No space left on your YubiKey for OATH credentials.")
@@ -348,24 +471,152 @@ def _add_cred(ctx, data, touch, force):
             raise
 
 
+@oath.command("import")
+@click.argument("file", type=click.File("r"), metavar="FILE")
+@click_touch_option
+@click.option("-f", "--force", is_flag=True, help="Overwrite existing credentials.")
+@click.pass_context
+def import_credentials(ctx, file, touch, force):
+    """
+    Add credentials from a file.
+
+    Add all credentials listed in FILE to your YubiKey, in a single session.
+    Use - to read from stdin. FILE can contain otpauth:// or
+    otpauth-migration:// URIs (one per line), a JSON list of such URIs
+    or of objects, or CSV with a header row. JSON objects and CSV columns
+    use the otpauth:// parameter names: name, secret, issuer, type,
+    algorithm, digits, period and counter.
+
+    Credentials which already exist on the YubiKey are skipped, unless
+    --force is given.
+    """
+    try:
+        credentials = parse_credentials(file.read())
+    except ValueError as e:
+        ctx.fail(str(e))
+
+    ensure_validated(ctx)
+    app = ctx.obj["controller"]
+    version = app.info.version
+
+    valid = []
+    failed = 0
+    for data in credentials:
+        # Steam is a special case where we allow a 'digits' value of '5'.
+        if data.digits == 5 and is_steam(data):
+            data.digits = 6
+        error = _check_cred_data(data, touch, version)
+        if error:
+            click.echo(u"Failed {}: {}".format(data.get_id().decode(), error))
+            failed += 1
+        else:
+            valid.append(data)
+
+    creds = app.list_credentials()
+    existing_ids = [cred.id for cred in creds]
+
+    #  YK4 has an issue with credential overwrite in firmware versions < 4.3.5
+    if (4, 0, 0) < version < (4, 3, 5):
+        ids = existing_ids + [data.get_id() for data in valid]
+        for data in valid[:]:
+            cred_id = data.get_id()
+            if any(i.startswith(cred_id) and i != cred_id for i in ids):
+                click.echo(
+                    u"Failed {}: Name is a subset of an existing "
+                    "credential.".format(cred_id.decode())
+                )
+                valid.remove(data)
+                failed += 1
+
+    added = 0
+    existing = set(existing_ids)
+    for i, data in enumerate(valid):
+        cred_id = data.get_id()
+        if cred_id in existing and not force:
+            click.echo(
+                u"Skipped {}: Credential already exists.".format(cred_id.decode())
+            )
+            continue
+        try:
+            cred = app.put_credential(data, touch)
+        except ApduError as e:
+            logger.debug("Failed to store credential", exc_info=e)
+            if e.sw in (SW.NO_SPACE, SW.COMMAND_ABORTED):
+                # Some NEOs do not use the NO_SPACE error.
+                # No later credential will fit either, so stop here.
+                for remaining in valid[i:]:
+                    click.echo(
+                        u"Failed {}: No space left on your YubiKey for OATH "
+                        "credentials.".format(remaining.get_id().decode())
+                    )
+                failed += len(valid) - i
+                break
+            click.echo(
+                u"Failed {}: The YubiKey returned an error ({:04x}).".format(
+                    cred_id.decode(), e.sw
+                )
+            )
+            failed += 1
+            continue
+        existing.add(cred_id)
+        click.echo(u"Added {}.".format(_string_id(cred)))
+        creds.append(cred)
+        added += 1
+
+    if added:
+        # Added credentials replace any overwritten ones
+        _update_cache(ctx, {cred.id: cred for cred in creds}.values())
+
+    click.echo("Added {} of {} credentials.".format(added, len(credentials)))
+    if failed:
+        ctx.exit(1)
+
+
 @oath.command()
 @click_show_hidden_option
 @click.pass_context
 @click.option("-o", "--oath-type", is_flag=True, help="Display the OATH type.")
 @click.option("-p", "--period", is_flag=True, help="Display the period.")
-def list(ctx, show_hidden, oath_type, period):
+@click.option(
+    "-c",
+    "--cached",
+    is_flag=True,
+    help="List credentials stored in the local cache, without accessing the "
+    "YubiKey. Changes made by other programs are not seen until ykman next reads "
+    "the credentials from the YubiKey.",
+)
+def list(ctx, show_hidden, oath_type, period, cached):
     """
     List all credentials.
 
     List all credentials stored on your YubiKey.
+
+    The list of credentials is cached locally each time it is read from the
+    YubiKey, unless the YubiKey is password protected and the password is not
+    remembered. Use --cached to list credentials from this cache.
+
+    The cache is dropped when the OATH application of the YubiKey is reset, but
+    credentials added, deleted or renamed by another program are only noticed the
+    next time a command reads the credentials from the YubiKey, such as "list" or
+    "code". Until then, --cached lists the credentials as they were.
     """
-    ensure_validated(ctx)
-    controller = ctx.obj["controller"]
-    creds = [
-        cred
-        for cred in controller.list_credentials()
-        if show_hidden or not is_hidden(cred)
-    ]
+    if cached:
+        caches = _get_cached_credentials(ctx)
+        if not caches:
+            ctx.fail("No cached credentials found for this YubiKey.")
+        if len(caches) > 1:
+            ctx.fail(
+                "Credentials are cached for multiple YubiKeys. Use --device "
+                "SERIAL to specify which one to use."
+            )
+        all_creds = caches[0]
+    else:
+        ensure_validated(ctx)
+        controller = ctx.obj["controller"]
+        all_creds = controller.list_credentials()
+        _update_cache(ctx, all_creds)
+
+    creds = [cred for cred in all_creds if show_hidden or not is_hidden(cred)]
     creds.sort()
     for cred in creds:
         click.echo(_string_id(cred), nl=False)
@@ -379,14 +630,20 @@ def list(ctx, show_hidden, oath_type, period):
 @oath.command()
 @click_show_hidden_option
 @click.pass_context
-@click.argument("query", required=False, default="")
+@click.argument("query", required=False, default="", **click_complete(_complete_query))
 @click.option(
     "-s",
     "--single",
     is_flag=True,
     help="Ensure only a single match, and output only the code.",
 )
-def code(ctx, show_hidden, query, single):
+@click.option(
+    "-w",
+    "--watch",
+    is_flag=True,
+    help="Keep displaying codes, refreshing them when they expire.",
+)
+def code(ctx, show_hidden, query, single, watch):
     """
     Generate codes.
 
@@ -395,10 +652,18 @@ def code(ctx, show_hidden, query, single):
     Touch and HOTP credentials require a single match to be triggered.
     """
 
+    if single and watch:
+        ctx.fail("--single can't be combined with --watch.")
+
     ensure_validated(ctx)
 
+    if watch:
+        _watch_codes(ctx, query, show_hidden)
+        return
+
     app = ctx.obj["controller"]
-    entries = app.calculate_all()
+    entries = calculate_all(app)
+    _update_cache(ctx, entries.keys())
     creds = _search(entries.keys(), query, show_hidden)
 
     if len(creds) == 1:
@@ -415,7 +680,7 @@ def code(ctx, show_hidden, query, single):
                 code = app.calculate_code(cred)
                 hotp_touch_timer.cancel()
             elif code is None:
-                code = app.calculate_code(cred)
+                code = calculate_code(app, cred)
         except ApduError as e:
             if e.sw == SW.SECURITY_CONDITION_NOT_SATISFIED:
                 ctx.fail("Touch credential timed out!")
@@ -428,37 +693,104 @@ def code(ctx, show_hidden, query, single):
         ctx.fail("No matching credential found.")
 
     if single and creds:
-        if is_steam(cred):
-            click.echo(calculate_steam(app, cred))
-        else:
-            click.echo(code.value)
+        click.echo(code.value)
     else:
-        outputs = []
-        for cred in sorted(creds):
-            code = entries[cred]
-            if code:
-                code = code.value
-            elif cred.touch_required:
-                code = "[Touch Credential]"
-            elif cred.oath_type == OATH_TYPE.HOTP:
-                code = "[HOTP Credential]"
-            else:
-                code = ""
-            if is_steam(cred):
-                code = calculate_steam(app, cred)
-            outputs.append((_string_id(cred), code))
-
-        longest_name = max(len(n) for (n, c) in outputs) if outputs else 0
-        longest_code = max(len(c) for (n, c) in outputs) if outputs else 0
-        format_str = u"{:<%d}  {:>%d}" % (longest_name, longest_code)
-
-        for name, result in outputs:
-            click.echo(format_str.format(name, result))
+        _print_codes(entries, creds)
+
+
+def _print_codes(entries, creds):
+    outputs = []
+    for cred in sorted(creds):
+        code = entries[cred]
+        if code:
+            code = code.value
+        elif cred.touch_required:
+            code = "[Touch Credential]"
+        elif cred.oath_type == OATH_TYPE.HOTP:
+            code = "[HOTP Credential]"
+        else:
+            code = ""
+        outputs.append((_string_id(cred), code))
+
+    longest_name = max(len(n) for (n, c) in outputs) if outputs else 0
+    longest_code = max(len(c) for (n, c) in outputs) if outputs else 0
+    format_str = u"{:<%d}  {:>%d}" % (longest_name, longest_code)
+
+    for name, result in outputs:
+        click.echo(format_str.format(name, result))
+
+
+# Errors from a YubiKey being removed, or otherwise failing to communicate
+_CONNECTION_ERRORS = (CommandError, ConnectionLostError)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except _CONNECTION_ERRORS as e:
+        logger.debug("Failed to close connection", exc_info=e)
+
+
+def _watch_codes(ctx, query, show_hidden):
+    app = ctx.obj["controller"]
+    conn = ctx.obj["conn"]
+    device_id = app.info.device_id
+    serial = ctx.obj["info"].serial
+
+    try:
+        while True:
+            timestamp = int(time())
+            try:
+                entries = calculate_all(app, timestamp)
+                _update_cache(ctx, entries.keys())
+            except _CONNECTION_ERRORS as e:
+                logger.debug("Lost connection to YubiKey", exc_info=e)
+                click.clear()
+                click.echo("Waiting for YubiKey...", err=True)
+                _close_quietly(conn)
+                conn, app = _reconnect(ctx, serial, device_id)
+                continue
+
+            creds = _search(entries.keys(), query, show_hidden)
+            click.clear()
+            _print_codes(entries, creds)
+
+            # Only wake up when one of the displayed codes expires
+            expiries = [
+                entries[cred].valid_to
+                for cred in creds
+                if entries[cred] and entries[cred].valid_to != float("Inf")
+            ]
+            next_period = (timestamp // DEFAULT_PERIOD + 1) * DEFAULT_PERIOD
+            sleep(max(min(expiries, default=next_period) - time(), 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _close_quietly(conn)
+
+
+def _reconnect(ctx, serial, device_id):
+    while True:
+        sleep(0.5)
+        try:
+            conn = connect_to_device(serial, [SmartCardConnection])[0]
+        except ValueError:
+            continue  # Not (yet) re-inserted
+        try:
+            app = OathSession(conn)
+            if app.info.device_id == device_id:
+                ctx.obj["conn"] = conn
+                ctx.obj["controller"] = app
+                ensure_validated(ctx)
+                return conn, app
+        except _CONNECTION_ERRORS as e:
+            logger.debug("Failed to select OATH application", exc_info=e)
+        _close_quietly(conn)
 
 
 @oath.command()
 @click.pass_context
-@click.argument("query")
+@click.argument("query", **click_complete(_complete_query))
 @click.option("-f", "--force", is_flag=True, help="Confirm deletion without prompting")
 def delete(ctx, query, force):
     """
@@ -484,6 +816,7 @@ def delete(ctx, query, force):
             )
         ):
             app.delete_credential(cred.id)
+            _update_cache(ctx, [c for c in creds if c != cred])
             click.echo(u"Deleted {}.".format(_string_id(cred)))
         else:
             click.echo("Deletion aborted by user.")
@@ -534,6 +867,8 @@ def set_password(ctx, new_password, remember):
     elif device_id in keys:
         del keys[device_id]
         settings.write()
+    if not remember:
+        _forget_cached_credentials(ctx, device_id)
 
 
 @oath.command("remember-password")
@@ -559,11 +894,15 @@ def remember_password(ctx, forget, clear_all):
     if clear_all:
         del settings["keys"]
         settings.write()
+        cache = ctx.obj["cache"]
+        cache.clear()
+        cache.write()
         click.echo("All passwords have been cleared.")
     elif forget:
         if device_id in keys:
             del keys[device_id]
             settings.write()
+            _forget_cached_credentials(ctx, device_id)
         click.echo("Password forgotten.")
     else:
         ensure_validated(ctx, remember=True)
@@ -599,6 +938,7 @@ def _validate(ctx, key, remember):
     try:
         app = ctx.obj["controller"]
         app.validate(key)
+        ctx.obj["key"] = key
         if remember:
             settings = ctx.obj["settings"]
             keys = settings.setdefault("keys", {})
@@ -27,7 +27,7 @@
 
 import logging
 import click
-from ..util import parse_certificates, parse_private_key
+from ..util import parse_certificates, parse_private_key, HASH_ALGORITHMS
 from ..opgp import OpgpController, KEY_SLOT, TOUCH_MODE
 from .util import (
     click_force_option,
@@ -35,11 +35,14 @@ from .util import (
     click_postpone_execution,
     click_prompt,
     EnumChoice,
+    read_digests,
+    write_signatures,
 )
 
 from yubikit.core import USB_INTERFACE
 from yubikit.core.smartcard import SmartCardProtocol, ApduError, SW
 
+
 logger = logging.getLogger(__name__)
 
 
@@ -90,6 +93,10 @@ def openpgp(ctx):
     \b
       Require touch to use the authentication key:
       $ ykman openpgp set-touch aut on
+
+    \b
+      Sign a file using the signature key:
+      $ ykman openpgp sign document.txt signature.hex
     """
     try:
         ctx.obj["controller"] = OpgpController(SmartCardProtocol(ctx.obj["conn"]))
@@ -415,4 +422,65 @@ def import_attestation_key(ctx, private_key, admin_pin):
         ctx.fail("Failed to import attestation key.")
 
 
+@openpgp.command()
+@click.pass_context
+@click.option("-P", "--pin", help="PIN code.")
+@click.option(
+    "-H",
+    "--hash-algorithm",
+    type=click.Choice(["SHA256", "SHA384", "SHA512"], case_sensitive=False),
+    default="SHA256",
+    show_default=True,
+    help="Hash algorithm to use.",
+)
+@click.option(
+    "-b",
+    "--batch",
+    is_flag=True,
+    help="Sign hex encoded digests read from INPUT, one per line.",
+)
+@click.argument("input", type=click.File("rb"), metavar="INPUT")
+@click.argument("output", type=click.File("w"), metavar="OUTPUT")
+def sign(ctx, pin, hash_algorithm, batch, input, output):
+    """
+    Sign data using the signature key.
+
+    Signs the data in INPUT, writing the signature to OUTPUT as hex.
+
+    With --batch, INPUT instead contains hex encoded digests, one per line. For
+    each digest, a JSON object holding the digest and signature (hex encoded) is
+    written to OUTPUT, one per line. The PIN is only verified once, unless the
+    YubiKey requires it for each signature.
+
+    \b
+    INPUT       File to read data or digests from. Use '-' to use stdin.
+    OUTPUT      File to write the signature(s) to. Use '-' to use stdout.
+    """
+    controller = ctx.obj["controller"]
+    hash_algorithm = HASH_ALGORITHMS[hash_algorithm.upper()]()
+    digests = read_digests(ctx, input, hash_algorithm, batch)
+
+    if not pin:
+        pin = click_prompt("Enter PIN", default="", hide_input=True, show_default=False)
+
+    if (
+        controller.supported_touch_policies
+        and controller.get_touch(KEY_SLOT.SIG) != TOUCH_MODE.OFF
+    ):
+        click.echo("Touch your YubiKey for each signature...", err=True)
+
+    try:
+        write_signatures(
+            output,
+            digests,
+            lambda to_sign: controller.sign_many(to_sign, hash_algorithm, pin),
+            batch,
+        )
+    except ValueError as e:
+        ctx.fail(str(e))
+    except ApduError as e:
+        logger.error("Failed to sign", exc_info=e)
+        ctx.fail("Signing failed.")
+
+
 openpgp.interfaces = USB_INTERFACE.CCID  # type: ignore
@@ -34,7 +34,14 @@ from yubikit.yubiotp import (
     HotpSlotConfiguration,
     UpdateConfiguration,
 )
-from yubikit.core import TRANSPORT, USB_INTERFACE, CommandError
+from yubikit.core import (
+    TRANSPORT,
+    USB_INTERFACE,
+    CommandError,
+    ApplicationNotAvailableError,
+)
+from yubikit.core.otp import OtpConnection
+from yubikit.core.smartcard import SmartCardConnection
 from ..scancodes import encode, KEYBOARD_LAYOUT
 
 from .util import (
@@ -45,6 +52,7 @@ from .util import (
     click_prompt,
     prompt_for_touch,
     EnumChoice,
+    PREFERRED_INTERFACES,
 )
 from ..util import (
     generate_static_pw,
@@ -57,10 +65,26 @@ from ..util import (
     format_code,
 )
 from .. import __version__
-from ..device import is_fips_version
-from ..otp import PrepareUploadFailed, prepare_upload_key, is_in_fips_mode
+from ..device import (
+    is_fips_version,
+    connect_to_device,
+    scan_devices,
+    get_connection_types,
+    CONNECTION_TYPE_MAPPING,
+)
+from ..otp import (
+    PrepareUploadFailed,
+    prepare_upload_key,
+    is_in_fips_mode,
+    CompiledSlotConfiguration,
+    COMPILED_MIN_VERSIONS,
+    compile_configuration,
+    write_compiled,
+    read_compiled,
+)
 from threading import Event
-from time import time
+from time import time, sleep
+import json
 import logging
 import os
 import struct
@@ -115,6 +139,51 @@ def _confirm_slot_overwrite(slot_state, slot):
         )
 
 
+def _parse_access_code(ctx, access_code, prompt="Enter access code"):
+    if access_code is not None:
+        if access_code == "":
+            access_code = click_prompt(prompt, show_default=False)
+
+        try:
+            access_code = parse_access_code_hex(access_code)
+        except Exception as e:
+            ctx.fail("Failed to parse access code: " + str(e))
+    return access_code
+
+
+def _prefer_transport(ctx, param, transport):
+    # Runs before the connection is opened, which happens before the group callback
+    if transport == "auto":
+        # CCID would be faster, but opening it may need to stop scdaemon, which
+        # holds the reader for GnuPG, so it is only used when asked for.
+        preferred = [USB_INTERFACE.OTP]
+    else:
+        preferred = [USB_INTERFACE[transport.upper()]]
+    ctx.meta[PREFERRED_INTERFACES] = preferred
+    return transport
+
+
+def _open_session(ctx, conn, serial, transport):
+    """Opens the OTP application, returning the connection used and the session.
+
+    Not all YubiKeys have the OTP application over CCID, so with the auto transport
+    a new connection is opened over HID instead, if needed.
+    """
+    try:
+        return conn, YubiOtpSession(conn)
+    except ApplicationNotAvailableError:
+        if transport != "auto" or not (
+            isinstance(conn, SmartCardConnection) and conn.transport == TRANSPORT.USB
+        ):
+            raise
+    logger.debug("OTP application not available over CCID, using HID")
+    try:
+        conn, _, _ = connect_to_device(serial, [OtpConnection])
+    except ValueError:
+        ctx.fail("The OTP application is not available on this YubiKey.")
+    return conn, YubiOtpSession(conn)
+
+
 @click.group()
 @click.pass_context
 @click_postpone_execution
@@ -124,7 +193,17 @@ def _confirm_slot_overwrite(slot_state, slot):
     metavar="HEX",
     help="A 6 byte access code. Set to empty to use a prompt for input.",
 )
-def otp(ctx, access_code):
+@click.option(
+    "-t",
+    "--transport",
+    type=click.Choice(["auto", "otp", "ccid"], case_sensitive=False),
+    default="auto",
+    show_default=True,
+    callback=_prefer_transport,
+    help="USB interface to use. By default, OTP HID is used, or CCID when OTP HID "
+    "is not enabled.",
+)
+def otp(ctx, access_code, transport):
     """
     Manage OTP Application.
 
@@ -153,19 +232,34 @@ def otp(ctx, access_code):
     \b
       Program a random 38 characters long static password to slot 2:
       $ ykman otp static --generate 2 --length 38
-    """
 
-    ctx.obj["session"] = YubiOtpSession(ctx.obj["conn"])
-    if access_code is not None:
-        if access_code == "":
-            access_code = click_prompt("Enter access code", show_default=False)
+    \b
+      Compile 1000 Yubico OTP credentials, then program them to slot 1 of each
+      inserted YubiKey:
+      $ ykman otp compile yubiotp --count 1000 batch.json
+      $ ykman otp flash 1 batch.json flashed.log
 
-        try:
-            access_code = parse_access_code_hex(access_code)
-        except Exception as e:
-            ctx.fail("Failed to parse access code: " + str(e))
+    \b
+      Use the faster CCID interface, when it is enabled:
+      $ ykman otp --transport ccid info
+    """
 
-    ctx.obj["access_code"] = access_code
+    conn = ctx.obj["conn"]
+    if transport != "auto" and not isinstance(
+        conn, CONNECTION_TYPE_MAPPING[USB_INTERFACE[transport.upper()]]
+    ):
+        ctx.fail(
+            "The {} interface is not available on this YubiKey.".format(
+                transport.upper()
+            )
+        )
+    otp_conn, ctx.obj["session"] = _open_session(
+        ctx, conn, ctx.obj["info"].serial, transport
+    )
+    if otp_conn is not conn:
+        ctx.call_on_close(otp_conn.close)
+        ctx.obj["conn"] = otp_conn
+    ctx.obj["access_code"] = _parse_access_code(ctx, access_code)
 
 
 @otp.command()
@@ -590,34 +684,60 @@ def chalresp(ctx, slot, key, totp, touch, force, generate):
     default="6",
     help="Number of digits in generated TOTP code (default is 6).",
 )
+@click.option(
+    "-b",
+    "--batch",
+    is_flag=True,
+    help="Read challenges from stdin, one per line, and write one response per line.",
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="With --batch, also write the time taken for each response to stderr.",
+)
 @click.pass_context
-def calculate(ctx, slot, challenge, totp, digits):
+def calculate(ctx, slot, challenge, totp, digits, batch, verbose):
     """
     Perform a challenge-response operation.
 
     Send a challenge (in hex) to a YubiKey slot with a challenge-response
     credential, and read the response. Supports output as a OATH-TOTP code.
+
+    With --batch, challenges (or timestamps, with --totp) are instead read from
+    stdin, one per line. Each response is written as soon as it is read, and
+    the connection to the YubiKey is kept open for all of them.
     """
     session = ctx.obj["session"]
 
-    if not challenge and not totp:
+    if batch and challenge:
+        ctx.fail("CHALLENGE can't be combined with --batch.")
+    if not challenge and not totp and not batch:
         challenge = click_prompt("Enter a challenge (hex)")
 
     # Check that slot is not empty
     if not session.get_config_state().is_configured(slot):
         ctx.fail("Cannot perform challenge-response on an empty slot.")
 
-    if totp:  # Challenge omitted or timestamp
-        if challenge is None:
-            challenge = time_challenge(time())
-        else:
+    def parse_challenge(value):
+        if totp:  # Challenge omitted or timestamp
+            if value is None:
+                return time_challenge(time())
             try:
-                challenge = time_challenge(int(challenge))
+                return time_challenge(int(value))
             except Exception as e:
                 logger.error("Error", exc_info=e)
                 ctx.fail("Timestamp challenge for TOTP must be an integer.")
-    else:  # Challenge is hex
-        challenge = bytes.fromhex(challenge)
+        try:  # Challenge is hex
+            return bytes.fromhex(value)
+        except ValueError:
+            ctx.fail("Challenge must be hex encoded.")
+
+    if batch:
+        lines = (line.strip() for line in click.get_text_stream("stdin"))
+        challenges = (parse_challenge(line) for line in lines if line)
+    else:
+        challenges = iter([parse_challenge(challenge)])
 
     try:
         event = Event()
@@ -627,13 +747,32 @@ def calculate(ctx, slot, challenge, totp, digits):
                 prompt_for_touch()
                 on_keepalive.prompted = True
 
-        response = session.calculate_hmac_sha1(slot, challenge, event, on_keepalive)
-        if totp:
-            value = format_code(parse_totp_hash(response), int(digits))
-        else:
-            value = response.hex()
+        sent_at = []
 
-        click.echo(value)
+        def timed(challenges):
+            # Records when each challenge is sent, not counting time spent on input
+            for challenge in challenges:
+                sent_at.append(time())
+                yield challenge
+
+        if isinstance(ctx.obj["conn"], SmartCardConnection):
+            # No keepalives over CCID, prompt up front instead
+            if session.get_config_state().requires_touch(slot):
+                prompt_for_touch()
+
+        responses = session.calculate_hmac_sha1_many(
+            slot, timed(challenges), event, on_keepalive
+        )
+        for n, response in enumerate(responses, 1):
+            if totp:
+                value = format_code(parse_totp_hash(response), int(digits))
+            else:
+                value = response.hex()
+
+            click.echo(value)
+            if batch and verbose:
+                latency = (time() - sent_at[-1]) * 1000
+                click.echo("Response {}: {:.1f} ms".format(n, latency), err=True)
     except CommandError as e:
         _failed_to_write_msg(ctx, e)
 
@@ -786,4 +925,288 @@ def settings(
         _failed_to_write_msg(ctx, e)
 
 
-otp.interfaces = USB_INTERFACE.OTP  # type: ignore
+@otp.command("compile")
+@click.argument(
+    "config-type", metavar="TYPE", type=click.Choice(["yubiotp", "hotp", "static"])
+)
+@click.argument("output", type=click.File("w"), metavar="OUTPUT")
+@click.option(
+    "-n", "--count", type=click.IntRange(1), required=True, help="Number of entries."
+)
+@click.option(
+    "-s",
+    "--start",
+    type=click.IntRange(0),
+    default=1,
+    show_default=True,
+    help="Sequence number of the first entry.",
+)
+@click.option(
+    "-P",
+    "--public-id-prefix",
+    default="vv",
+    show_default=True,
+    metavar="MODHEX",
+    help="Public ID prefix for Yubico OTP. The sequence number fills the rest of "
+    "the 6 byte public ID.",
+)
+@click.option(
+    "-d",
+    "--digits",
+    type=click.Choice(["6", "8"]),
+    default="6",
+    help="Number of digits in generated HOTP codes (default is 6).",
+)
+@click.option(
+    "-l",
+    "--length",
+    type=click.IntRange(1, 38),
+    default=38,
+    show_default=True,
+    help="Length of generated static passwords.",
+)
+@click.option(
+    "-k",
+    "--keyboard-layout",
+    type=EnumChoice(KEYBOARD_LAYOUT),
+    default="MODHEX",
+    show_default=True,
+    help="Keyboard layout to use for static passwords.",
+)
+@click.option(
+    "-A",
+    "--new-access-code",
+    metavar="HEX",
+    required=False,
+    help="A 6 byte access code to protect every slot with. Set to empty to use a "
+    "prompt for input.",
+)
+@click.option(
+    "--generate-access-code",
+    is_flag=True,
+    help="Protect each slot with a random access code. Conflicts with "
+    "--new-access-code.",
+)
+@click.option(
+    "--no-enter",
+    is_flag=True,
+    help="Don't send an Enter keystroke after emitting the output.",
+)
+@click.pass_context
+def compile_configs(
+    ctx,
+    config_type,
+    output,
+    count,
+    start,
+    public_id_prefix,
+    digits,
+    length,
+    keyboard_layout,
+    new_access_code,
+    generate_access_code,
+    no_enter,
+):
+    """
+    Compile slot configurations for programming many YubiKeys.
+
+    Generates COUNT credentials of the given TYPE, with random secrets, and writes
+    their fully serialized slot configurations to OUTPUT, numbered by sequence. Use
+    "ykman otp flash" to program YubiKeys with them.
+
+    OUTPUT contains the secret keys and access codes, and must be kept safe.
+    """
+    if new_access_code is not None and generate_access_code:
+        ctx.fail("--new-access-code conflicts with --generate-access-code.")
+    acc_code = _parse_access_code(ctx, new_access_code, "Enter new access code")
+
+    try:
+        prefix = modhex_decode(public_id_prefix)
+    except (ValueError, IndexError):
+        ctx.fail("Invalid public ID prefix, must be modhex.")
+    if len(prefix) > 5:
+        ctx.fail("Public ID prefix too long.")
+    if config_type == "yubiotp" and start + count > 1 << 8 * (6 - len(prefix)):
+        ctx.fail("Public ID prefix too long for the sequence numbers.")
+
+    def generate(sequence):
+        entry_acc_code = os.urandom(6) if generate_access_code else acc_code
+        if config_type == "yubiotp":
+            public_id = prefix + sequence.to_bytes(6 - len(prefix), "big")
+            private_id = os.urandom(6)
+            key = os.urandom(16)
+            config = YubiOtpSlotConfiguration(public_id, private_id, key)
+            details = dict(public_id=public_id, private_id=private_id, key=key)
+        elif config_type == "hotp":
+            key = os.urandom(20)
+            config = HotpSlotConfiguration(key).digits8(int(digits) == 8)
+            details = dict(key=key)
+        else:
+            password = generate_static_pw(length, keyboard_layout)
+            config = StaticPasswordSlotConfiguration(encode(password, keyboard_layout))
+            details = dict(password=password)
+        return compile_configuration(
+            sequence, config.append_cr(not no_enter), entry_acc_code, **details
+        )
+
+    write_compiled(
+        output, config_type, (generate(i) for i in range(start, start + count))
+    )
+    click.echo("Compiled {} {} configurations.".format(count, config_type), err=True)
+
+
+def _wait_for_insert(connection_types):
+    state = None
+    while True:
+        devices, new_state = scan_devices()
+        if new_state != state:
+            state = new_state
+            n_devs = sum(devices.values())
+            if n_devs == 1:
+                try:
+                    return connect_to_device(None, connection_types)
+                except ValueError as e:
+                    logger.debug("Failed to connect", exc_info=e)
+                    state = None  # The device may not be ready yet, try again
+            elif n_devs > 1:
+                click.echo("Only insert one YubiKey at a time.", err=True)
+        sleep(0.1)
+
+
+def _wait_for_removal():
+    while sum(scan_devices()[0].values()):
+        sleep(0.1)
+
+
+def _read_flash_log(log):
+    """Returns the sequence numbers in LOG, and the ones which are still pending."""
+    done, pending = set(), {}
+    if os.path.exists(log):
+        with open(log) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if record.get("status") == "pending":
+                        pending[record["sequence"]] = record["serial"]
+                    else:
+                        pending.pop(record["sequence"], None)
+                        done.add(record["sequence"])
+    return done | set(pending), pending
+
+
+def _write_flash_log(log_file, sequence, serial, status):
+    log_file.write(
+        json.dumps({"sequence": sequence, "serial": serial, "status": status}) + "\n"
+    )
+    log_file.flush()
+    os.fsync(log_file.fileno())
+
+
+@otp.command()
+@click_slot_argument
+@click.argument("batch", type=click.File("r"), metavar="BATCH")
+@click.argument("log", type=click.Path(dir_okay=False), metavar="LOG")
+@click_force_option
+@click.pass_context
+def flash(ctx, slot, batch, log, force):
+    """
+    Program YubiKeys with compiled slot configurations.
+
+    Each inserted YubiKey is programmed with the next unused configuration from
+    BATCH, as written by "ykman otp compile", using a single write. The sequence
+    number and the serial number of the YubiKey are appended to LOG before and
+    after the write, and configurations already listed in LOG are skipped, so that
+    an interrupted run can be resumed. A configuration whose write was interrupted
+    or failed is never used again. Remove each YubiKey once it has been programmed,
+    and insert the next one. Press Ctrl-C to stop.
+
+    YubiKeys which already have the slot configured, unless --force is given, or
+    which don't support the type of configuration are skipped, leaving their
+    configuration for the next YubiKey.
+
+    The current access code of the slot, if any, is given by the --access-code
+    option of the otp command.
+    """
+    # This command handles a sequence of YubiKeys, so it does not use the
+    # connection opened by the otp command.
+    cur_acc_code = _parse_access_code(ctx, ctx.parent.params["access_code"])
+    connection_types = get_connection_types(
+        otp.interfaces, ctx.meta.get(PREFERRED_INTERFACES, ())
+    )
+
+    try:
+        config_type, entries = read_compiled(batch)
+    except ValueError as e:
+        ctx.fail(str(e))
+    used, pending = _read_flash_log(log)
+    for sequence, serial in sorted(pending.items()):
+        click.echo(
+            "Configuration {} may have been written to YubiKey {}, check it. It "
+            "will not be used again.".format(sequence, serial),
+            err=True,
+        )
+    entries = [e for e in entries if e["sequence"] not in used]
+
+    transport = ctx.parent.params["transport"]
+    min_version = COMPILED_MIN_VERSIONS[config_type]
+
+    with open(log, "a") as log_file:
+        # A YubiKey which is skipped doesn't use up the entry
+        while entries:
+            entry = entries[0]
+            click.echo("Insert a YubiKey to program...", err=True)
+            conn, _, info = _wait_for_insert(connection_types)
+            try:
+                try:
+                    otp_conn, session = _open_session(ctx, conn, info.serial, transport)
+                except ApplicationNotAvailableError:
+                    ctx.fail(
+                        "The OTP application is not available over this interface, "
+                        "use the --transport option of the otp command."
+                    )
+                if otp_conn is not conn:
+                    conn.close()
+                    conn = otp_conn
+                config = CompiledSlotConfiguration(entry["config"], min_version)
+                if not config.is_supported_by(session.version):
+                    click.echo(
+                        "YubiKey {} does not support {} configurations, "
+                        "skipping it.".format(info.serial, config_type),
+                        err=True,
+                    )
+                    _wait_for_removal()
+                    continue
+                if not force and session.get_config_state().is_configured(slot):
+                    click.echo(
+                        "Slot {} of YubiKey {} is already configured, "
+                        "skipping it.".format(slot, info.serial),
+                        err=True,
+                    )
+                    _wait_for_removal()
+                    continue
+                # Once written, the entry must never be given to another YubiKey,
+                # even if the write seems to fail, so it is logged as pending first.
+                entries.pop(0)
+                _write_flash_log(log_file, entry["sequence"], info.serial, "pending")
+                start = time()
+                session.put_configuration(slot, config, None, cur_acc_code)
+                elapsed = (time() - start) * 1000
+            except CommandError as e:
+                _failed_to_write_msg(ctx, e)
+            finally:
+                conn.close()
+
+            _write_flash_log(log_file, entry["sequence"], info.serial, "done")
+            click.echo(
+                "Programmed {} configuration {} to YubiKey {} in {:.0f} ms. "
+                "Remove it.".format(
+                    config_type, entry["sequence"], info.serial, elapsed
+                ),
+                err=True,
+            )
+            _wait_for_removal()
+
+    click.echo("All configurations in the batch have been used.", err=True)
+
+
+otp.interfaces = USB_INTERFACE.OTP | USB_INTERFACE.CCID  # type: ignore
@@ -25,7 +25,7 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from yubikit.core import USB_INTERFACE
+from yubikit.core import USB_INTERFACE, BadResponseError
 from yubikit.piv import (
     PivSession,
     InvalidPinError,
@@ -43,11 +43,16 @@ from ..util import (
     get_leaf_certificates,
     parse_private_key,
     parse_certificates,
+    HASH_ALGORITHMS,
 )
+from .. import piv_service
 from ..piv import (
     PivController,
     generate_random_management_key,
     KeypairMismatch,
+    BACKUP_OBJECTS,
+    write_backup,
+    read_backup,
 )
 from .util import (
     click_force_option,
@@ -57,10 +62,12 @@ from .util import (
     click_prompt,
     prompt_for_touch,
     EnumChoice,
+    read_digests,
+    write_signatures,
 )
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa, padding
 from cryptography.hazmat.backends import default_backend
 import click
 import datetime
@@ -123,10 +130,19 @@ def piv(ctx):
       $ ykman piv generate-key --algorithm ECCP256 9a pubkey.pem
       $ ykman piv generate-certificate --subject "yubico" 9a pubkey.pem
 
+    \b
+      Or do both using a single command:
+      $ ykman piv provision-slot --algorithm ECCP256 --subject "yubico" 9a
+
     \b
       Change the PIN from 123456 to 654321:
       $ ykman piv change-pin --pin 123456 --new-pin 654321
 
+    \b
+      Copy all certificates and data objects to another YubiKey:
+      $ ykman --device 123456 piv backup piv-backup.jsonl
+      $ ykman --device 654321 piv restore piv-backup.jsonl
+
     \b
       Reset all PIV data and restore default settings:
       $ ykman piv reset
@@ -147,33 +163,28 @@ def info(ctx):
     Display status of PIV application.
     """
     controller = ctx.obj["controller"]
-    click.echo("PIV version: %d.%d.%d" % controller.version)
+    snapshot = controller.snapshot()
+    click.echo("PIV version: %d.%d.%d" % snapshot.version)
 
     # Largest possible number of PIN tries to get back is 15
-    tries = controller.get_pin_tries()
+    tries = snapshot.pin_tries
     tries = "15 or more." if tries == 15 else tries
     click.echo("PIN tries remaining: %s" % tries)
-    if controller.puk_blocked:
+    pivman = snapshot.pivman_data
+    if pivman.puk_blocked:
         click.echo("PUK blocked.")
-    if controller.has_derived_key:
+    if pivman.salt is not None:
         click.echo("Management key is derived from PIN.")
-    if controller.has_stored_key:
+    if pivman.mgm_key_protected:
         click.echo("Management key is stored on the YubiKey, protected by PIN.")
-    try:
-        chuid = controller.get_data(OBJECT_ID.CHUID).hex()
-    except ApduError as e:
-        if e.sw == SW.FILE_NOT_FOUND:
-            chuid = "No data available."
-    click.echo("CHUID:\t" + chuid)
-
-    try:
-        ccc = controller.get_data(OBJECT_ID.CAPABILITY).hex()
-    except ApduError as e:
-        if e.sw == SW.FILE_NOT_FOUND:
-            ccc = "No data available."
-    click.echo("CCC: \t" + ccc)
+    chuid = snapshot.objects.get(OBJECT_ID.CHUID)
+    click.echo(
+        "CHUID:\t" + (chuid.hex() if chuid is not None else "No data available.")
+    )
+    ccc = snapshot.objects.get(OBJECT_ID.CAPABILITY)
+    click.echo("CCC: \t" + (ccc.hex() if ccc is not None else "No data available."))
 
-    for (slot, cert) in controller.list_certificates().items():
+    for (slot, cert) in snapshot.list_certificates().items():
         click.echo("Slot %02x:" % slot)
 
         if isinstance(cert, x509.Certificate):
@@ -323,8 +334,15 @@ def generate_key(
     is_flag=True,
     help="Verify that the certificate matches the private key in the slot.",
 )
+@click.option(
+    "--compress/--no-compress",
+    default=None,
+    help="Store the certificate compressed (default: only if it is large).",
+)
 @click.argument("cert", type=click.File("rb"), metavar="CERTIFICATE")
-def import_certificate(ctx, slot, management_key, pin, cert, password, verify):
+def import_certificate(
+    ctx, slot, management_key, pin, cert, password, verify, compress
+):
     """
     Import a X.509 certificate.
 
@@ -370,7 +388,11 @@ def import_certificate(ctx, slot, management_key, pin, cert, password, verify):
     def do_import(retry=True):
         try:
             controller.import_certificate(
-                slot, cert_to_import, verify=verify, touch_callback=prompt_for_touch
+                slot,
+                cert_to_import,
+                verify=verify,
+                touch_callback=prompt_for_touch,
+                compress=compress,
             )
 
         except KeypairMismatch:
@@ -475,6 +497,151 @@ def attest(ctx, slot, certificate, format):
     certificate.write(cert.public_bytes(encoding=format))
 
 
+@piv.command()
+@click.pass_context
+@click_slot_argument
+@click_pin_option
+@click.option(
+    "-a",
+    "--algorithm",
+    type=EnumChoice(KEY_TYPE),
+    help="Algorithm of the key in the slot (read from the YubiKey by default).",
+)
+@click.option(
+    "-H",
+    "--hash-algorithm",
+    type=click.Choice(sorted(HASH_ALGORITHMS), case_sensitive=False),
+    default="SHA256",
+    show_default=True,
+    help="Hash algorithm to use.",
+)
+@click.option(
+    "-b",
+    "--batch",
+    is_flag=True,
+    help="Sign hex encoded digests read from INPUT, one per line.",
+)
+@click.argument("input", type=click.File("rb"), metavar="INPUT")
+@click.argument("output", type=click.File("w"), metavar="OUTPUT")
+def sign(ctx, slot, pin, algorithm, hash_algorithm, batch, input, output):
+    """
+    Sign data using a private key.
+
+    Signs the data in INPUT, writing the signature to OUTPUT as hex.
+
+    With --batch, INPUT instead contains hex encoded digests, one per line. For
+    each digest, a JSON object holding the digest and signature (hex encoded) is
+    written to OUTPUT, one per line. The PIN is only verified once, unless the
+    PIN policy of the key requires it for each signature.
+
+    \b
+    SLOT        PIV slot of the private key.
+    INPUT       File to read data or digests from. Use '-' to use stdin.
+    OUTPUT      File to write the signature(s) to. Use '-' to use stdout.
+    """
+    controller = ctx.obj["controller"]
+    hash_algorithm = HASH_ALGORITHMS[hash_algorithm.upper()]()
+
+    if algorithm is None:
+        try:
+            algorithm = controller.get_key_type(slot)
+        except (ApduError, BadResponseError):
+            ctx.fail(
+                "Unable to determine the key type of slot {}, "
+                "use --algorithm.".format(slot.name)
+            )
+
+    digests = read_digests(ctx, input, hash_algorithm, batch)
+
+    if not pin:
+        pin = _prompt_pin(ctx)
+
+    try:
+        write_signatures(
+            output,
+            digests,
+            lambda to_sign: controller.sign_many(
+                slot, algorithm, to_sign, hash_algorithm, padding.PKCS1v15(), pin
+            ),
+            batch,
+        )
+    except InvalidPinError as e:
+        if e.attempts_remaining > 0:
+            ctx.fail(
+                "PIN verification failed, {} tries left.".format(e.attempts_remaining)
+            )
+        else:
+            ctx.fail("PIN is blocked.")
+    except ApduError as e:
+        logger.error("Failed to sign using slot %s", slot, exc_info=e)
+        ctx.fail("Signing failed.")
+
+
+@piv.command()
+@click.pass_context
+@click_pin_option
+@click.option(
+    "-s",
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    metavar="PATH",
+    required=True,
+    help="Listen on a Unix socket at PATH, for JSON requests one per line.",
+)
+@click.argument("fingerprint", metavar="FINGERPRINT")
+def serve(ctx, pin, socket_path, fingerprint):
+    """
+    Serve private key operations using all YubiKeys holding a key.
+
+    Finds all attached YubiKeys with the key matching FINGERPRINT, and uses them
+    to handle sign, decrypt and ECDH requests. Each request is sent to the least
+    busy YubiKey, and is retried on another if a YubiKey is removed.
+
+    Requests are served on a Unix socket, which is only accessible to the current
+    user.
+
+    \b
+    FINGERPRINT SHA-256 fingerprint (hex) of the public key (SubjectPublicKeyInfo).
+
+    \b
+    Example, getting the fingerprint from a public key in PEM format:
+      $ openssl pkey -pubin -in pubkey.pem -outform DER | sha256sum
+    """
+    if not hasattr(piv_service, "UnixServer"):
+        ctx.fail("Unix sockets are not supported on this platform.")
+    try:
+        fingerprint = bytes.fromhex(fingerprint.replace(":", ""))
+    except ValueError:
+        ctx.fail("Invalid fingerprint.")
+
+    if not pin:
+        pin = _prompt_pin(ctx)
+
+    pool = piv_service.KeyPool(fingerprint, pin)
+    try:
+        pool.scan()
+    except InvalidPinError as e:
+        ctx.fail("PIN verification failed, {} tries left.".format(e.attempts_remaining))
+    if not pool.workers:
+        ctx.fail("No YubiKey holding the key found.")
+
+    server = piv_service.UnixServer(pool, socket_path)
+    click.echo(
+        "Serving requests on {} using {} YubiKey(s), press Ctrl+C to stop.".format(
+            socket_path, len(pool.workers)
+        ),
+        err=True,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
 @piv.command("export-certificate")
 @click.pass_context
 @click_slot_argument
@@ -613,6 +780,105 @@ def generate_certificate(
         ctx.fail("Certificate generation failed.")
 
 
+@piv.command("provision-slot")
+@click.pass_context
+@click_slot_argument
+@click_management_key_option
+@click_pin_option
+@click.option(
+    "-a",
+    "--algorithm",
+    help="Algorithm to use in key generation.",
+    type=EnumChoice(KEY_TYPE),
+    default=KEY_TYPE.RSA2048.name,
+    show_default=True,
+)
+@click_pin_policy_option
+@click_touch_policy_option
+@click.option(
+    "-s",
+    "--subject",
+    help="Subject common name (CN) for the certificate.",
+    required=True,
+)
+@click.option(
+    "-d",
+    "--valid-days",
+    help="Number of days until the certificate expires.",
+    type=click.INT,
+    default=365,
+    show_default=True,
+)
+@click.option(
+    "--csr",
+    "csr_output",
+    type=click.File("wb"),
+    metavar="FILE",
+    help="Write a CSR to FILE, instead of storing a self-signed certificate.",
+)
+@click.option(
+    "-v",
+    "--verify",
+    is_flag=True,
+    help="Verify the signature against the generated public key.",
+)
+def provision_slot(
+    ctx,
+    slot,
+    management_key,
+    pin,
+    algorithm,
+    pin_policy,
+    touch_policy,
+    subject,
+    valid_days,
+    csr_output,
+    verify,
+):
+    """
+    Generate a key pair and a certificate.
+
+    Generates a private key in a slot, and a self-signed certificate for it which
+    is written to the slot. With --csr, a Certificate Signing Request is written
+    to a file instead. This is the same as running generate-key followed by
+    generate-certificate or generate-csr, using a single session.
+
+    \b
+    SLOT        PIV slot where private key should be stored.
+    """
+    controller = ctx.obj["controller"]
+
+    _check_pin_policy(ctx, controller, pin_policy)
+    _check_touch_policy(ctx, controller, touch_policy)
+
+    _ensure_authenticated(
+        ctx, controller, pin, management_key, require_pin_and_key=True
+    )
+
+    now = datetime.datetime.utcnow()
+    try:
+        _, result = controller.provision_slot(
+            slot,
+            algorithm,
+            subject,
+            now,
+            now + datetime.timedelta(days=valid_days),
+            pin_policy,
+            touch_policy,
+            csr=csr_output is not None,
+            verify=verify,
+            touch_callback=prompt_for_touch,
+        )
+    except KeypairMismatch:
+        ctx.fail("The signature does not match the generated public key.")
+    except ApduError as e:
+        logger.error("Failed to provision slot %s", slot, exc_info=e)
+        ctx.fail("Provisioning the slot failed.")
+
+    if csr_output is not None:
+        csr_output.write(result.public_bytes(encoding=serialization.Encoding.PEM))
+
+
 @piv.command("generate-csr")
 @click.pass_context
 @click_slot_argument
@@ -962,6 +1228,67 @@ def write_object(ctx, pin, management_key, object_id, data):
     do_write_object()
 
 
+@piv.command()
+@click_pin_option
+@click.pass_context
+@click.argument("output", type=click.File("w"), metavar="FILE")
+def backup(ctx, pin, output):
+    """
+    Back up all PIV objects to a file.
+
+    Writes the certificates, CHUID, CCC and other data objects to a single file,
+    together with their SHA-256 digests. Private keys can't be read from the
+    YubiKey, and are not included. Objects which require the PIN, such as
+    biometric data, are only included if a PIN is given.
+
+    \b
+    FILE    File to write the backup to. Use '-' to use stdout.
+    """
+    controller = ctx.obj["controller"]
+    if pin:
+        _verify_pin(ctx, controller, pin)
+
+    n_objects = write_backup(output, controller.read_objects(BACKUP_OBJECTS))
+    click.echo("Backed up {} objects.".format(n_objects), err=True)
+
+
+@piv.command()
+@click_pin_option
+@click_management_key_option
+@click.pass_context
+@click.argument("input", type=click.File("r"), metavar="FILE")
+def restore(ctx, pin, management_key, input):
+    """
+    Restore PIV objects from a backup.
+
+    Writes the objects from a file created by the backup command, after checking
+    their digests for corruption. The digests do not protect against deliberate
+    modification, so only restore backups from a trusted source. Objects which
+    already hold the same data are left as is.
+
+    \b
+    FILE    File to read the backup from. Use '-' to use stdin.
+    """
+    try:
+        objects = read_backup(input)
+    except ValueError as e:
+        ctx.fail("Invalid backup file: {}".format(e))
+
+    controller = ctx.obj["controller"]
+    _ensure_authenticated(ctx, controller, pin, management_key)
+
+    try:
+        written = controller.write_objects(objects.items())
+    except ApduError as e:
+        logger.debug("Failed writing object", exc_info=e)
+        ctx.fail("Failed to restore objects.")
+    click.echo(
+        "Restored {} objects, {} already up to date.".format(
+            len(written), len(objects) - len(written)
+        )
+    )
+
+
 def _prompt_management_key(
     ctx, prompt="Enter a management key [blank to use default key]"
 ):
@@ -28,9 +28,13 @@
 import functools
 import click
 import sys
+import json
 from ..util import parse_b32_key
 from collections import OrderedDict, MutableMapping
-from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.backends import default_backend
+from itertools import tee
+from time import time
 
 
 class UpperCaseChoice(click.Choice):
@@ -117,6 +121,11 @@ click_format_option = click.option(
 )
 
 
+# Key in Context.meta where a command group can list the USB interfaces to prefer,
+# before the connection is first used.
+PREFERRED_INTERFACES = "ykman.preferred_interfaces"
+
+
 class YkmanContextObject(MutableMapping):
     def __init__(self):
         self._objects = OrderedDict()
@@ -165,6 +174,20 @@ def click_parse_b32_key(ctx, param, val):
     return parse_b32_key(val)
 
 
+def click_complete(f):
+    """Adapts a completion function to the running version of Click.
+
+    The function f(ctx, incomplete) should return a list of matching values.
+    Returns the keyword arguments to pass to click.argument or click.option.
+    """
+    try:
+        import click.shell_completion  # noqa: F401 - Click 8 or later
+
+        return {"shell_complete": lambda ctx, param, incomplete: f(ctx, incomplete)}
+    except ImportError:
+        return {"autocompletion": lambda ctx, args, incomplete: f(ctx, incomplete)}
+
+
 def click_prompt(prompt, err=True, **kwargs):
     """Replacement for click.prompt to better work when piping input to the command.
 
@@ -185,3 +208,64 @@ def prompt_for_touch():
         click.echo("Touch your YubiKey...", err=True)
     except Exception:
         sys.stderr.write("Touch your YubiKey...\n")
+
+
+def read_digests(ctx, input, hash_algorithm, batch):
+    """Reads the digests to sign from INPUT.
+
+    With batch, INPUT holds hex encoded digests, one per line. Otherwise the
+    digest of the full contents of INPUT is used.
+    """
+    if not batch:
+        h = hashes.Hash(hash_algorithm, default_backend())
+        for chunk in iter(lambda: input.read(8192), b""):
+            h.update(chunk)
+        yield h.finalize()
+        return
+
+    for n, line in enumerate(input, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            digest = bytes.fromhex(line.decode())
+        except ValueError:
+            ctx.fail("Invalid digest on line {}.".format(n))
+        if len(digest) != hash_algorithm.digest_size:
+            ctx.fail(
+                "Invalid digest length on line {}, expected {} bytes.".format(
+                    n, hash_algorithm.digest_size
+                )
+            )
+        yield digest
+
+
+def write_signatures(output, digests, sign_many, batch):
+    """Signs digests using sign_many, writing each signature to OUTPUT as hex.
+
+    With batch, a JSON object holding the digest and signature is written per line,
+    and the throughput is reported once all digests are signed.
+    """
+    # One copy of the digests for signing, one for the output
+    to_sign, to_output = tee(digests)
+    count = 0
+    start = time()
+    for digest, signature in zip(to_output, sign_many(to_sign)):
+        if batch:
+            output.write(
+                json.dumps({"digest": digest.hex(), "signature": signature.hex()})
+                + "\n"
+            )
+            output.flush()
+        else:
+            click.echo(signature.hex(), file=output)
+        count += 1
+
+    if batch:
+        elapsed = time() - start
+        click.echo(
+            "Signed {} digest(s) in {:.2f}s ({:.1f} signatures/s).".format(
+                count, elapsed, count / elapsed if elapsed else 0
+            ),
+            err=True,
+        )
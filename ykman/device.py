@@ -50,7 +50,17 @@ from .hid import list_otp_devices, list_ctap_devices
 from .scard import list_devices as _list_ccid_devices
 
 from collections import Counter
-from typing import Dict, Mapping, List, Tuple, Optional, Hashable, Iterable, Type
+from typing import (
+    Dict,
+    Mapping,
+    List,
+    Tuple,
+    Optional,
+    Hashable,
+    Iterable,
+    Sequence,
+    Type,
+)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -84,10 +94,16 @@ CONNECTION_LIST_MAPPING = {
 }
 
 
-def get_connection_types(usb_interfaces: USB_INTERFACE) -> Iterable[Type[Connection]]:
-    """Get a list of Connection types valid for the given USB interfaces."""
+def get_connection_types(
+    usb_interfaces: USB_INTERFACE, preferred: Sequence[USB_INTERFACE] = ()
+) -> Iterable[Type[Connection]]:
+    """Get a list of Connection types valid for the given USB interfaces.
+
+    Connection types for the preferred interfaces are listed first, in order.
+    """
+    order = list(preferred) + [i for i in CONNECTION_TYPE_MAPPING if i not in preferred]
     return [
-        ct for iface, ct in CONNECTION_TYPE_MAPPING.items() if iface in usb_interfaces
+        CONNECTION_TYPE_MAPPING[iface] for iface in order if iface in usb_interfaces
     ]
 
 
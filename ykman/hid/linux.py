@@ -35,16 +35,22 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-# usb_ioctl.h
-USB_GET_REPORT = 0xC0094807
-USB_SET_REPORT = 0xC0094806
-
 # hidraw.h
 HIDIOCGRAWINFO = 0x80084803
 HIDIOCGRDESCSIZE = 0x80044801
 HIDIOCGRDESC = 0x90044802
 
 
+def _hidioc_feature(nr, size):
+    # _IOC(_IOC_WRITE|_IOC_READ, 'H', nr, size)
+    return 0xC0000000 | size << 16 | ord("H") << 8 | nr
+
+
+# Feature reports are 8 bytes, prefixed by the report number
+HIDIOCSFEATURE = _hidioc_feature(0x06, 1 + 8)
+HIDIOCGFEATURE = _hidioc_feature(0x07, 1 + 8)
+
+
 class HidrawConnection(OtpConnection):
     def __init__(self, path):
         self.handle = open(path, "wb")
@@ -54,13 +60,13 @@ class HidrawConnection(OtpConnection):
 
     def receive(self):
         buf = bytearray(1 + 8)
-        fcntl.ioctl(self.handle, USB_GET_REPORT, buf, True)
+        fcntl.ioctl(self.handle, HIDIOCGFEATURE, buf, True)
         return buf[1:]
 
     def send(self, data):
         buf = bytearray([9])
         buf.extend(data)
-        fcntl.ioctl(self.handle, USB_SET_REPORT, buf, True)
+        fcntl.ioctl(self.handle, HIDIOCSFEATURE, buf, True)
 
 
 def get_info(dev):
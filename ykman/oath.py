@@ -25,12 +25,28 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from yubikit.oath import OATH_TYPE
+from yubikit.oath import (
+    OATH_TYPE,
+    HASH_ALGORITHM,
+    DEFAULT_DIGITS,
+    DEFAULT_PERIOD,
+    DEFAULT_IMF,
+    Code,
+    Credential,
+    CredentialData,
+    parse_b32_key,
+)
+from base64 import b64decode
+from urllib.parse import unquote, urlparse
 from time import time
+from typing import Optional, Mapping, List, Tuple, Union
 import struct
+import json
+import csv
 
 
 STEAM_CHAR_TABLE = "23456789BCDFGHJKMNPQRTVWXY"
+STEAM_PERIOD = 30
 
 
 def is_hidden(credential):
@@ -41,11 +57,13 @@ def is_steam(credential):
     return credential.oath_type == OATH_TYPE.TOTP and credential.issuer == "Steam"
 
 
-def calculate_steam(app, credential, timestamp=None):
-    timestamp = int(timestamp or time())
-    resp = app.calculate(credential.id, struct.pack(">q", timestamp // 30))
-    offset = resp[-1] & 0x0F
-    code = struct.unpack(">I", resp[offset : offset + 4])[0] & 0x7FFFFFFF
+def _truncate(response):
+    offset = response[-1] & 0x0F
+    return struct.unpack(">I", response[offset : offset + 4])[0] & 0x7FFFFFFF
+
+
+def _format_steam(response):
+    code = _truncate(response)
     chars = []
     for i in range(5):
         chars.append(STEAM_CHAR_TABLE[code % len(STEAM_CHAR_TABLE)])
@@ -53,5 +71,200 @@ def calculate_steam(app, credential, timestamp=None):
     return "".join(chars)
 
 
+def calculate_steam(app, credential, timestamp=None):
+    timestamp = int(timestamp or time())
+    resp = app.calculate(credential.id, struct.pack(">q", timestamp // STEAM_PERIOD))
+    return _format_steam(resp)
+
+
+def calculate_code(
+    app, credential: Credential, timestamp: Optional[int] = None
+) -> Code:
+    """Calculate a code for a credential, formatting Steam codes as such."""
+    if is_steam(credential):
+        timestamp = int(timestamp or time())
+        time_step = timestamp // STEAM_PERIOD
+        return Code(
+            calculate_steam(app, credential, timestamp),
+            time_step * STEAM_PERIOD,
+            (time_step + 1) * STEAM_PERIOD,
+        )
+    return app.calculate_code(credential, timestamp)
+
+
+def calculate_all(
+    app, timestamp: Optional[int] = None
+) -> Mapping[Credential, Optional[Code]]:
+    """Calculate codes for all credentials, including Steam credentials.
+
+    Full HMAC responses are requested from the YubiKey, and both numeric and Steam
+    codes are derived from them on the host, avoiding a separate CALCULATE command
+    for each Steam credential.
+    """
+    timestamp = int(timestamp or time())
+    entries = {}
+    for credential, response in app.calculate_all_responses(
+        timestamp, truncate=False
+    ).items():
+        code = None  # Will be None for HOTP and touch
+        if response:
+            digits, response = response[0], response[1:]
+            if is_steam(credential):
+                value = _format_steam(response)
+            else:
+                value = str(_truncate(response) % 10 ** digits).rjust(digits, "0")
+            time_step = timestamp // credential.period
+            code = Code(
+                value,
+                time_step * credential.period,
+                (time_step + 1) * credential.period,
+            )
+        entries[credential] = code
+    return entries
+
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        value |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            return value, offset
+
+
+def _parse_protobuf(data: bytes) -> List[Tuple[int, Union[int, bytes]]]:
+    """Minimal protobuf decoder, handling only varint and length-delimited fields"""
+    fields = []
+    offset = 0
+    try:
+        while offset < len(data):
+            key, offset = _read_varint(data, offset)
+            field, wire_type = key >> 3, key & 0x07
+            value: Union[int, bytes]
+            if wire_type == 0:  # Varint
+                value, offset = _read_varint(data, offset)
+            elif wire_type == 2:  # Length-delimited
+                length, offset = _read_varint(data, offset)
+                value, offset = data[offset : offset + length], offset + length
+            else:
+                raise ValueError("Unsupported wire type: %d" % wire_type)
+            fields.append((field, value))
+    except IndexError:
+        raise ValueError("Truncated protobuf data")
+    return fields
+
+
+# Enum values used by the otpauth-migration payload
+_MIGRATION_ALGORITHMS = {
+    0: HASH_ALGORITHM.SHA1,
+    1: HASH_ALGORITHM.SHA1,
+    2: HASH_ALGORITHM.SHA256,
+    3: HASH_ALGORITHM.SHA512,
+}
+_MIGRATION_DIGITS = {0: DEFAULT_DIGITS, 1: 6, 2: 8}
+_MIGRATION_TYPES = {0: OATH_TYPE.TOTP, 1: OATH_TYPE.HOTP, 2: OATH_TYPE.TOTP}
+
+
+def _split_issuer(name, issuer):
+    if ":" in name:
+        name_issuer, name = name.split(":", 1)
+        issuer = issuer or name_issuer
+    return name, issuer or None
+
+
+def parse_migration_uri(uri: str) -> List[CredentialData]:
+    """Parse an otpauth-migration:// URI, as exported by Google Authenticator."""
+    parsed = urlparse(uri.strip())
+    if parsed.scheme != "otpauth-migration":
+        raise ValueError("Invalid URI scheme")
+
+    # Don't use parse_qs, as it would turn "+" in the base64 data into spaces
+    params = dict(p.split("=", 1) for p in parsed.query.split("&") if "=" in p)
+    if "data" not in params:
+        raise ValueError("Missing migration data")
+
+    credentials = []
+    for field, value in _parse_protobuf(b64decode(unquote(params["data"]))):
+        if field != 1:  # Only otp_parameters are of interest
+            continue
+        otp = dict(_parse_protobuf(value))  # type: ignore
+        try:
+            hash_algorithm = _MIGRATION_ALGORITHMS[otp.get(4, 0)]
+            digits = _MIGRATION_DIGITS[otp.get(5, 0)]
+            oath_type = _MIGRATION_TYPES[otp.get(6, 0)]
+        except KeyError:
+            raise ValueError("Unsupported credential parameters")
+        name, issuer = _split_issuer(otp.get(2, b"").decode(), otp.get(3, b"").decode())
+        credentials.append(
+            CredentialData(
+                name=name,
+                oath_type=oath_type,
+                hash_algorithm=hash_algorithm,
+                secret=otp.get(1, b""),
+                digits=digits,
+                counter=otp.get(7, DEFAULT_IMF),
+                issuer=issuer,
+            )
+        )
+    return credentials
+
+
+def _parse_credential_params(params) -> CredentialData:
+    if not params.get("secret") or not params.get("name"):
+        raise ValueError("Both name and secret are required")
+    name, issuer = _split_issuer(params["name"], params.get("issuer"))
+    return CredentialData(
+        name=name,
+        oath_type=OATH_TYPE[(params.get("type") or "TOTP").upper()],
+        hash_algorithm=HASH_ALGORITHM[(params.get("algorithm") or "SHA1").upper()],
+        secret=parse_b32_key(params["secret"]),
+        digits=int(params.get("digits") or DEFAULT_DIGITS),
+        period=int(params.get("period") or DEFAULT_PERIOD),
+        counter=int(params.get("counter") or DEFAULT_IMF),
+        issuer=issuer,
+    )
+
+
+def _parse_credential_entry(entry) -> List[CredentialData]:
+    if isinstance(entry, str):
+        if entry.strip().startswith("otpauth-migration:"):
+            return parse_migration_uri(entry)
+        return [CredentialData.parse_uri(entry)]
+    return [_parse_credential_params(entry)]
+
+
+def parse_credentials(data: str) -> List[CredentialData]:
+    """Parse a list of credentials, for importing.
+
+    Supported formats are:
+    - otpauth:// or otpauth-migration:// URIs, one per line.
+    - A JSON list of such URIs, or of objects with the keys name, secret, issuer,
+      type, algorithm, digits, period and counter (as used by otpauth:// URIs).
+    - CSV with a header row, using the same column names as the JSON keys.
+    """
+    data = data.strip()
+    if data.startswith("[") or data.startswith("{"):
+        entries = json.loads(data)
+        if isinstance(entries, dict):
+            entries = [entries]
+    elif data.startswith("otpauth"):
+        entries = [line for line in data.splitlines() if line.strip()]
+    else:
+        entries = [
+            {k.strip().lower(): (v or "").strip() for k, v in row.items() if k}
+            for row in csv.DictReader(data.splitlines())
+        ]
+
+    credentials = []
+    for i, entry in enumerate(entries, 1):
+        try:
+            credentials.extend(_parse_credential_entry(entry))
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError("Invalid credential entry %d: %s" % (i, e))
+    return credentials
+
+
 def is_in_fips_mode(app):
     return app.locked
@@ -37,12 +37,15 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.serialization import (
     Encoding,
     PrivateFormat,
+    PublicFormat,
     NoEncryption,
 )
 from cryptography.hazmat.primitives.asymmetric import rsa, ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
 
 from enum import Enum, IntEnum, unique
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from types import MappingProxyType
 import time
 import struct
 import logging
@@ -109,20 +112,46 @@ class INS(IntEnum):  # noqa: N801
     GET_ATTESTATION = 0xFB
     SEND_REMAINING = 0xC0
     SELECT_DATA = 0xA5
+    PSO = 0x2A
+    INTERNAL_AUTHENTICATE = 0x88
 
 
 PinRetries = namedtuple("PinRetries", ["pin", "reset", "admin"])
 
 
 PW1 = 0x81
+PW1_EXTENDED = 0x82  # PW1 for decryption and authentication
 PW3 = 0x83
 INVALID_PIN = b"\0" * 8
 TOUCH_METHOD_BUTTON = 0x20
 
 
+@unique
+class PIN_POLICY(IntEnum):  # noqa: N801
+    # Whether PW1 stays verified after a signature has been made
+    ALWAYS = 0x00
+    ONCE = 0x01
+
+
+@unique
+class KEY_ALGORITHM(IntEnum):  # noqa: N801
+    RSA = 0x01
+    ECDH = 0x12
+    ECDSA = 0x13
+    EDDSA = 0x16
+
+
 @unique
 class DO(IntEnum):
     AID = 0x4F
+    APPLICATION_DATA = 0x6E
+    CARDHOLDER_DATA = 0x65
+    NAME = 0x5B
+    LANGUAGE = 0x5F2D
+    SEX = 0x5F35
+    EXTENDED_CAPABILITIES = 0xC0
+    FINGERPRINTS = 0xC5
+    GENERATION_TIMES = 0xCD
     PW_STATUS = 0xC4
     CARDHOLDER_CERTIFICATE = 0x7F21
     ATT_CERTIFICATE = 0xFC
@@ -174,6 +203,29 @@ def _format_ec_attributes(key_slot, curve_name):
     return algorithm + OID.for_name(curve_name)
 
 
+_HASH_OIDS = {
+    "sha1": b"\x2b\x0e\x03\x02\x1a",
+    "sha224": b"\x60\x86\x48\x01\x65\x03\x04\x02\x04",
+    "sha256": b"\x60\x86\x48\x01\x65\x03\x04\x02\x01",
+    "sha384": b"\x60\x86\x48\x01\x65\x03\x04\x02\x02",
+    "sha512": b"\x60\x86\x48\x01\x65\x03\x04\x02\x03",
+}
+
+
+def _format_digest(algorithm, digest, hash_algorithm):
+    if len(digest) != hash_algorithm.digest_size:
+        raise ValueError("Digest does not match the hash algorithm")
+    if algorithm != KEY_ALGORITHM.RSA:
+        return digest
+    # DigestInfo, as defined in RFC 8017, to be padded by the YubiKey
+    try:
+        oid = _HASH_OIDS[hash_algorithm.name]
+    except KeyError:
+        raise ValueError("Unsupported hash algorithm: " + hash_algorithm.name)
+    algorithm_identifier = Tlv(0x30, Tlv(0x06, oid) + b"\x05\x00")
+    return Tlv(0x30, algorithm_identifier + Tlv(0x04, digest))
+
+
 def _get_key_attributes(key, key_slot):
     if isinstance(key, rsa.RSAPrivateKey):
         if key.private_numbers().public_numbers.e != 65537:
@@ -183,6 +235,102 @@ def _get_key_attributes(key, key_slot):
     return _format_ec_attributes(key_slot, curve_name)
 
 
+def _format_mpi(value):
+    # Multiprecision integer, as defined in RFC 4880
+    value = value.lstrip(b"\0")
+    bits = (len(value) - 1) * 8 + value[0].bit_length() if value else 0
+    return struct.pack(">H", bits) + value
+
+
+# KDF hash and key wrap algorithms for ECDH keys, chosen as GnuPG does
+_ECDH_KDF_PARAMETERS = {
+    256: b"\x08\x07",  # SHA256, AES128
+    384: b"\x09\x09",  # SHA384, AES256
+    521: b"\x0a\x09",  # SHA512, AES256
+}
+
+
+def _format_public_key_material(key_slot, public_key):
+    if isinstance(public_key, rsa.RSAPublicKey):
+        numbers = public_key.public_numbers()
+        return (
+            b"\x01"  # RSA
+            + _format_mpi(int_to_bytes(numbers.n))
+            + _format_mpi(int_to_bytes(numbers.e))
+        )
+
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        curve_name = public_key.curve.name
+        key_size = public_key.curve.key_size
+        point = public_key.public_bytes(Encoding.X962, PublicFormat.UncompressedPoint)
+    else:
+        curve_name = _get_curve_name(public_key)
+        key_size = 256
+        point = b"\x40" + public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+    oid = OID.for_name(curve_name)
+    if curve_name == "ed25519":
+        algorithm = b"\x16"  # EdDSA
+    elif curve_name == "x25519" or key_slot == KEY_SLOT.ENC:
+        algorithm = b"\x12"  # ECDH
+    else:
+        algorithm = b"\x13"  # ECDSA
+    material = algorithm + struct.pack(">B", len(oid)) + oid + _format_mpi(point)
+    if algorithm == b"\x12":
+        bits = min(bits for bits in _ECDH_KDF_PARAMETERS if bits >= key_size)
+        material += b"\x03\x01" + _ECDH_KDF_PARAMETERS[bits]
+    return material
+
+
+def _format_public_key_body(key_slot, public_key, timestamp):
+    # Version 4 public key packet body, as defined in RFC 4880
+    return (
+        b"\x04"
+        + struct.pack(">I", timestamp)
+        + _format_public_key_material(key_slot, public_key)
+    )
+
+
+def calculate_fingerprint(key_slot, public_key, timestamp):
+    """Calculates the OpenPGP v4 fingerprint of a public key."""
+    body = _format_public_key_body(key_slot, public_key, timestamp)
+    digest = hashes.Hash(hashes.SHA1(), default_backend())
+    digest.update(b"\x99" + struct.pack(">H", len(body)) + body)
+    return digest.finalize()
+
+
+def format_public_key_packet(key_slot, public_key, timestamp):
+    """Formats a public key as an OpenPGP public key packet.
+
+    The signature key is formatted as a primary key, the other keys as subkeys.
+    """
+    body = _format_public_key_body(key_slot, public_key, timestamp)
+    tag = b"\x99" if key_slot == KEY_SLOT.SIG else b"\xb9"
+    return tag + struct.pack(">H", len(body)) + body
+
+
+def _parse_ec_public_key(curve_name, encoded):
+    if curve_name == "x25519":
+        # Added in 2.0
+        from cryptography.hazmat.primitives.asymmetric import x25519
+
+        return x25519.X25519PublicKey.from_public_bytes(encoded)
+    if curve_name == "ed25519":
+        # Added in 2.6
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+
+        return ed25519.Ed25519PublicKey.from_public_bytes(encoded)
+
+    curve = getattr(ec, curve_name.upper())
+    try:
+        # Added in cryptography 2.5
+        return ec.EllipticCurvePublicKey.from_encoded_point(curve(), encoded)
+    except AttributeError:
+        return ec.EllipticCurvePublicNumbers.from_encoded_point(
+            curve(), encoded
+        ).public_key(default_backend())
+
+
 def _get_key_template(key, key_slot, crt=False):
     def _pack_tlvs(tlvs):
         header = b""
@@ -239,6 +387,96 @@ class HashAlgorithm(bytes, Enum):
         return hashes.Hash(algorithm(), default_backend())
 
 
+def _is_constructed(tag):
+    while tag > 0xFF:
+        tag >>= 8
+    return bool(tag & 0x20)
+
+
+def _parse_data_objects(data):
+    # Walks constructed TLVs, collecting all primitive data objects
+    objects = OrderedDict()
+    for tlv in Tlv.parse_list(data):
+        if _is_constructed(tlv.tag):
+            objects.update(_parse_data_objects(tlv.value))
+        else:
+            objects[tlv.tag] = tlv.value
+    return objects
+
+
+class ApplicationData(object):
+    """Read-only view of the application related and cardholder related data.
+
+    Read once by OpgpController, and replaced after any change to the card.
+    """
+
+    __slots__ = ("_objects",)
+
+    def __init__(self, application_data, cardholder_data=b""):
+        objects = _parse_data_objects(application_data)
+        objects.update(_parse_data_objects(cardholder_data))
+        self._objects = MappingProxyType(objects)
+
+    def get(self, do, default=None):
+        return self._objects.get(do, default)
+
+    @property
+    def aid(self):
+        return self._objects[DO.AID]
+
+    @property
+    def openpgp_version(self):
+        return self.aid[6], self.aid[7]
+
+    @property
+    def pin_tries(self):
+        return PinRetries(*self._objects[DO.PW_STATUS][4:7])
+
+    @property
+    def name(self):
+        return self.get(DO.NAME)
+
+    @property
+    def language(self):
+        return self.get(DO.LANGUAGE)
+
+    @property
+    def sex(self):
+        return self.get(DO.SEX)
+
+    def get_fingerprint(self, key_slot):
+        if key_slot == KEY_SLOT.ATT:
+            return self.get(key_slot.fingerprint)
+        offset = (key_slot.index - 1) * 20
+        fingerprints = self.get(DO.FINGERPRINTS)
+        return fingerprints[offset : offset + 20] if fingerprints else None
+
+    def get_generation_time(self, key_slot):
+        if key_slot == KEY_SLOT.ATT:
+            data = self.get(key_slot.gen_time)
+        else:
+            offset = (key_slot.index - 1) * 4
+            data = self.get(DO.GENERATION_TIMES, b"")[offset : offset + 4]
+        return struct.unpack(">I", data)[0] if data else None
+
+    def get_touch(self, key_slot):
+        # Only included by newer YubiKeys
+        data = self.get(key_slot.uif)
+        return TOUCH_MODE(data[0]) if data else None
+
+    @property
+    def signature_pin_policy(self):
+        return PIN_POLICY(self._objects[DO.PW_STATUS][0])
+
+    def get_key_algorithm(self, key_slot):
+        # Older YubiKeys don't report algorithm attributes, and only support RSA
+        attributes = self.get(key_slot.key_id)
+        return KEY_ALGORITHM(attributes[0]) if attributes else KEY_ALGORITHM.RSA
+
+
+_S2K_CHUNK_SIZE = 0x10000
+
+
 class Kdf(object):
     _fields = {
         b"\x81": ("kdf_algorithm", KdfAlgorithm),
@@ -262,7 +500,7 @@ class Kdf(object):
     def process(self, pw, pin):
         if self.kdf_algorithm != KdfAlgorithm.KDF_ITERSALTED_S2K:
             raise ValueError("Unsupported KDF algorithm")
-        if pw == PW1:
+        if pw in (PW1, PW1_EXTENDED):
             salt = self.pw1_salt_bytes
         elif pw == PW3:
             salt = self.pw3_salt_bytes
@@ -276,10 +514,12 @@ class Kdf(object):
         # Although the field is called "iteration count", it's actually
         # the number of bytes to be passed to the hash function, which
         # is called only once. Go figure!
-        data_count, trailing_bytes = divmod(self.iteration_count, len(data))
-        for _ in range(data_count):
-            digest.update(data)
-        digest.update(data[:trailing_bytes])
+        # The data is repeated into a larger buffer, to hash it in a few big chunks.
+        chunk = data * max(1, _S2K_CHUNK_SIZE // len(data))
+        chunk_count, trailing_bytes = divmod(self.iteration_count, len(chunk))
+        for _ in range(chunk_count):
+            digest.update(chunk)
+        digest.update(chunk[:trailing_bytes])
         return digest.finalize()
 
 
@@ -295,6 +535,9 @@ class OpgpController(object):
             else:
                 raise
         self._version = self._read_version()
+        self._kdf = None  # KDF data object, read when first needed
+        self._application_data = None  # ApplicationData, read when first needed
+        self._kdf_pins = {}  # (pw, PIN) -> PIN processed by the KDF
 
     @property
     def version(self):
@@ -304,7 +547,30 @@ class OpgpController(object):
         return self._app.send_apdu(0, INS.GET_DATA, do >> 8, do & 0xFF)
 
     def _put_data(self, do, data):
+        self._application_data = None
         self._app.send_apdu(0, INS.PUT_DATA, do >> 8, do & 0xFF, data)
+        if do == DO.KDF:
+            self._clear_kdf()
+
+    def get_application_data(self):
+        """
+        Returns the application related and cardholder related data as an
+        ApplicationData object. The data is only read from the YubiKey the first
+        time, or after the data has been changed.
+        """
+        if self._application_data is None:
+            application_data = self._get_data(DO.APPLICATION_DATA)
+            try:
+                cardholder_data = self._get_data(DO.CARDHOLDER_DATA)
+            except ApduError as e:
+                logger.debug("Failed to read cardholder data", exc_info=e)
+                cardholder_data = b""
+            self._application_data = ApplicationData(application_data, cardholder_data)
+        return self._application_data
+
+    def _clear_kdf(self):
+        self._kdf = None
+        self._kdf_pins.clear()
 
     def _select_certificate(self, key_slot):
         self._app.send_apdu(
@@ -320,15 +586,20 @@ class OpgpController(object):
         return tuple(int(bcd_hex[i : i + 2]) for i in range(0, 6, 2))
 
     def get_openpgp_version(self):
-        data = self._get_data(DO.AID)
-        return data[6], data[7]
+        return self.get_application_data().openpgp_version
 
     def get_remaining_pin_tries(self):
-        data = self._get_data(DO.PW_STATUS)
-        return PinRetries(*data[4:7])
+        return self.get_application_data().pin_tries
+
+    def get_fingerprint(self, key_slot):
+        return self.get_application_data().get_fingerprint(key_slot)
+
+    def get_generation_time(self, key_slot):
+        return self.get_application_data().get_generation_time(key_slot)
 
     def _block_pins(self):
         retries = self.get_remaining_pin_tries()
+        self._application_data = None
 
         for _ in range(retries.pin):
             try:
@@ -347,30 +618,45 @@ class OpgpController(object):
         self._block_pins()
         self._app.send_apdu(0, INS.TERMINATE, 0, 0)
         self._app.send_apdu(0, INS.ACTIVATE, 0, 0)
+        self._clear_kdf()
+        self._application_data = None
 
     def _get_kdf(self):
-        try:
-            data = self._get_data(DO.KDF)
-            if data == b"\x81\x01\x00":
-                return None
-            else:
-                return Kdf(data)
-        except ApduError:
-            return None
+        # The KDF data object is read once, and kept for the rest of the session
+        if self._kdf is None:
+            try:
+                data = self._get_data(DO.KDF)
+                self._kdf = Kdf(data) if data != b"\x81\x01\x00" else False
+            except ApduError:
+                self._kdf = False
+        return self._kdf or None
+
+    def _process_pin(self, pw, pin):
+        pin = pin.encode("utf-8")
+        kdf = self._get_kdf()
+        if kdf:
+            if (pw, pin) not in self._kdf_pins:
+                self._kdf_pins[(pw, pin)] = kdf.process(pw, pin)
+            return self._kdf_pins[(pw, pin)]
+        return pin
 
     def _verify(self, pw, pin):
         try:
-            pin = pin.encode("utf-8")
-            kdf = self._get_kdf()
-            if kdf:
-                pin = kdf.process(pw, pin)
+            pin = self._process_pin(pw, pin)
+            self._application_data = None  # PIN retry counters will change
             self._app.send_apdu(0, INS.VERIFY, 0, pw, pin)
         except ApduError:
-            pw_remaining = self.get_remaining_pin_tries()[pw - PW1]
+            pin_tries = self.get_remaining_pin_tries()
+            pw_remaining = pin_tries.admin if pw == PW3 else pin_tries.pin
             raise ValueError("Invalid PIN, {} tries remaining.".format(pw_remaining))
 
-    def verify_pin(self, pin):
-        self._verify(PW1, pin)
+    def verify_pin(self, pin, extended=False):
+        """Verifies the User PIN.
+
+        By default the PIN is verified for signing. Use extended=True to verify it
+        for decryption and authentication instead.
+        """
+        self._verify(PW1_EXTENDED if extended else PW1, pin)
 
     def verify_admin(self, admin_pin):
         self._verify(PW3, admin_pin)
@@ -399,8 +685,10 @@ class OpgpController(object):
             raise ValueError("Touch policy is available on YubiKey 4 or later.")
         if key_slot == KEY_SLOT.ATT and not self.supports_attestation:
             raise ValueError("Attestation key not available on this device.")
-        data = self._get_data(key_slot.uif)
-        return TOUCH_MODE(data[0])
+        touch = self.get_application_data().get_touch(key_slot)
+        if touch is None:
+            touch = TOUCH_MODE(self._get_data(key_slot.uif)[0])
+        return touch
 
     def set_touch(self, key_slot, mode):
         """Requires Admin PIN verification."""
@@ -420,6 +708,7 @@ class OpgpController(object):
             raise ValueError(
                 "Setting PIN retry counters requires version " "4.3.1 or later."
             )
+        self._application_data = None
         self._app.send_apdu(
             0,
             INS.SET_PIN_RETRIES,
@@ -454,6 +743,7 @@ class OpgpController(object):
             self._put_data(key_slot.key_id, attributes)
 
         template = _get_key_template(key, key_slot, self.version < (4, 0, 0))
+        self._application_data = None
         self._app.send_apdu(0, INS.PUT_DATA_ODD, 0x3F, 0xFF, template)
 
         if fingerprint is not None:
@@ -475,6 +765,7 @@ class OpgpController(object):
             self._put_data(key_slot.key_id, attributes)
         elif key_size != 2048:
             raise ValueError("Unsupported key size!")
+        self._application_data = None
         resp = self._app.send_apdu(0, INS.GENERATE_ASYM, 0x80, 0x00, key_slot.crt)
 
         data = Tlv.parse_dict(Tlv.unwrap(0x7F49, resp))
@@ -482,10 +773,9 @@ class OpgpController(object):
             int_from_bytes(data[0x82], "big"), int_from_bytes(data[0x81], "big")
         )
 
-        self._put_data(key_slot.gen_time, struct.pack(">I", timestamp))
-        # TODO: Calculate and write fingerprint
-
-        return numbers.public_key(default_backend())
+        public_key = numbers.public_key(default_backend())
+        self._write_key_information(key_slot, public_key, timestamp)
+        return public_key
 
     def generate_ec_key(self, key_slot, curve_name, timestamp=None):
         """Requires Admin PIN verification."""
@@ -494,33 +784,51 @@ class OpgpController(object):
 
         attributes = _format_ec_attributes(key_slot, curve_name)
         self._put_data(key_slot.key_id, attributes)
+        self._application_data = None
         resp = self._app.send_apdu(0, INS.GENERATE_ASYM, 0x80, 0x00, key_slot.crt)
 
         data = Tlv.parse_dict(Tlv.unwrap(0x7F49, resp))
-        pubkey_enc = data[0x86]
+        public_key = _parse_ec_public_key(curve_name, data[0x86])
+        self._write_key_information(key_slot, public_key, timestamp)
+        return public_key
 
+    def _write_key_information(self, key_slot, public_key, timestamp):
         self._put_data(key_slot.gen_time, struct.pack(">I", timestamp))
-        # TODO: Calculate and write fingerprint
+        self._put_data(
+            key_slot.fingerprint, calculate_fingerprint(key_slot, public_key, timestamp)
+        )
 
-        if curve_name == "x25519":
-            # Added in 2.0
-            from cryptography.hazmat.primitives.asymmetric import x25519
+    def generate_all(self, sig, enc, aut, admin_pin=None, timestamp=None):
+        """Generates new keys for the signature, encryption and authentication slots.
 
-            return x25519.X25519PublicKey.from_public_bytes(pubkey_enc)
-        if curve_name == "ed25519":
-            # Added in 2.6
-            from cryptography.hazmat.primitives.asymmetric import ed25519
+        Each of sig, enc and aut is either an RSA key size, or a curve name. All keys
+        are given the same creation time. Returns an OrderedDict mapping each key
+        slot to an OpenPGP public key packet, which can be exported.
 
-            return ed25519.Ed25519PublicKey.from_public_bytes(pubkey_enc)
+        Requires Admin PIN verification, unless admin_pin is given.
+        """
+        key_types = OrderedDict(
+            [(KEY_SLOT.SIG, sig), (KEY_SLOT.ENC, enc), (KEY_SLOT.AUT, aut)]
+        )
+        for key_type in key_types.values():  # Fail before generating any key
+            if not isinstance(key_type, int):
+                OID.for_name(key_type)
 
-        curve = getattr(ec, curve_name.upper())
-        try:
-            # Added in cryptography 2.5
-            return ec.EllipticCurvePublicKey.from_encoded_point(curve(), pubkey_enc)
-        except AttributeError:
-            return ec.EllipticCurvePublicNumbers.from_encoded_point(
-                curve(), pubkey_enc
-            ).public_key(default_backend())
+        if timestamp is None:
+            timestamp = int(time.time())
+        if admin_pin is not None:
+            self.verify_admin(admin_pin)
+
+        packets = OrderedDict()
+        for key_slot, key_type in key_types.items():
+            if isinstance(key_type, int):
+                public_key = self.generate_rsa_key(key_slot, key_type, timestamp)
+            else:
+                public_key = self.generate_ec_key(key_slot, key_type, timestamp)
+            packets[key_slot] = format_public_key_packet(
+                key_slot, public_key, timestamp
+            )
+        return packets
 
     def delete_key(self, key_slot):
         """Requires Admin PIN verification."""
@@ -549,3 +857,80 @@ class OpgpController(object):
         """Requires User PIN verification."""
         self._app.send_apdu(0x80, INS.GET_ATTESTATION, key_slot.index, 0)
         return self.read_certificate(key_slot)
+
+    def _use_key(self, algorithm, ins, p1, p2, data):
+        response = self._app.send_apdu(0, ins, p1, p2, data)
+        if algorithm == KEY_ALGORITHM.ECDSA:
+            # The YubiKey returns r || s, convert it to the usual DER encoding
+            ln = len(response) // 2
+            return encode_dss_signature(
+                int_from_bytes(response[:ln], "big"),
+                int_from_bytes(response[ln:], "big"),
+            )
+        return response
+
+    def sign(self, message, hash_algorithm=hashes.SHA256()):
+        """Signs a message using the signature key.
+
+        Requires User PIN verification. Unless the signature PIN policy is ONCE,
+        the PIN has to be verified again before each signature.
+        """
+        h = hashes.Hash(hash_algorithm, default_backend())
+        h.update(message)
+        return next(self.sign_many([h.finalize()], hash_algorithm))
+
+    def sign_many(self, digests, hash_algorithm, pin=None):
+        """Signs a number of digests using the signature key.
+
+        Signatures are yielded as each digest is signed, all over the same
+        connection. If a PIN is given it is verified once, or before each
+        signature if the signature PIN policy requires it.
+        """
+        app_data = self.get_application_data()
+        algorithm = app_data.get_key_algorithm(KEY_SLOT.SIG)
+        verify_each = False
+        if pin is not None:
+            verify_each = app_data.signature_pin_policy == PIN_POLICY.ALWAYS
+            self.verify_pin(pin)
+
+        for i, digest in enumerate(digests):
+            data = _format_digest(algorithm, digest, hash_algorithm)
+            if verify_each and i > 0:
+                self.verify_pin(pin)
+            yield self._use_key(algorithm, INS.PSO, 0x9E, 0x9A, data)
+
+    def authenticate(self, message, hash_algorithm=hashes.SHA256()):
+        """Signs a message using the authentication key.
+
+        Requires User PIN verification, with extended=True.
+        """
+        algorithm = self.get_application_data().get_key_algorithm(KEY_SLOT.AUT)
+        h = hashes.Hash(hash_algorithm, default_backend())
+        h.update(message)
+        data = _format_digest(algorithm, h.finalize(), hash_algorithm)
+        return self._use_key(algorithm, INS.INTERNAL_AUTHENTICATE, 0, 0, data)
+
+    def decrypt(self, cipher_text):
+        """Decrypts a PKCS#1 v1.5 encrypted message using the encryption key.
+
+        Requires User PIN verification, with extended=True.
+        """
+        algorithm = self.get_application_data().get_key_algorithm(KEY_SLOT.ENC)
+        if algorithm != KEY_ALGORITHM.RSA:
+            raise ValueError("The encryption key is not an RSA key.")
+        # Prefixed by the padding indicator byte
+        return self._app.send_apdu(0, INS.PSO, 0x80, 0x86, b"\0" + cipher_text)
+
+    def calculate_secret(self, peer_public_key):
+        """Performs ECDH with a peer public key, using the encryption key.
+
+        Requires User PIN verification, with extended=True.
+        """
+        if isinstance(peer_public_key, ec.EllipticCurvePublicKey):
+            point = peer_public_key.public_bytes(
+                Encoding.X962, PublicFormat.UncompressedPoint
+            )
+        else:  # X25519
+            point = peer_public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+        data = Tlv(0xA6, Tlv(0x7F49, Tlv(0x86, point)))
+        return self._app.send_apdu(0, INS.PSO, 0x80, 0x86, data)
@@ -0,0 +1,408 @@
+# Copyright (c) 2018 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import logging
+from .. import __version__
+from ..util import modhex_encode, modhex_decode
+from yubikit.core import Version
+from yubikit.yubiotp import SlotConfiguration, CONFIG_SIZE
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from http.client import (
+    HTTPConnection,
+    HTTPSConnection,
+    BadStatusLine,
+    RemoteDisconnected,
+)
+from queue import Queue, Empty
+from threading import BoundedSemaphore
+from time import sleep
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+UPLOAD_HOST = "upload.yubico.com"
+UPLOAD_PATH = "/prepare"
+UPLOAD_URL = "https://" + UPLOAD_HOST
+
+
+class PrepareUploadError(Enum):
+    # Defined here
+    CONNECTION_FAILED = "Failed to open HTTPS connection."
+    NOT_FOUND = "Upload request not recognized by server."
+    SERVICE_UNAVAILABLE = (
+        "Service temporarily unavailable, please try again later."  # noqa: E501
+    )
+
+    # Defined in upload project
+    PRIVATE_ID_INVALID_LENGTH = "Private ID must be 12 characters long."
+    PRIVATE_ID_NOT_HEX = (
+        "Private ID must consist only of hex characters (0-9A-F)."  # noqa: E501
+    )
+    PRIVATE_ID_UNDEFINED = "Private ID is required."
+    PUBLIC_ID_INVALID_LENGTH = "Public ID must be 12 characters long."
+    PUBLIC_ID_NOT_MODHEX = "Public ID must consist only of modhex characters (cbdefghijklnrtuv)."  # noqa: E501
+    PUBLIC_ID_NOT_VV = 'Public ID must begin with "vv".'
+    PUBLIC_ID_OCCUPIED = "Public ID is already in use."
+    PUBLIC_ID_UNDEFINED = "Public ID is required."
+    SECRET_KEY_INVALID_LENGTH = "Secret key must be 32 character long."  # nosec
+    SECRET_KEY_NOT_HEX = (
+        "Secret key must consist only of hex characters (0-9A-F)."  # noqa: E501 # nosec
+    )
+    SECRET_KEY_UNDEFINED = "Secret key is required."  # nosec
+    SERIAL_NOT_INT = "Serial number must be an integer."
+    SERIAL_TOO_LONG = "Serial number is too long."
+
+    def message(self):
+        return self.value
+
+
+class PrepareUploadFailed(Exception):
+    def __init__(self, status, content, error_ids):
+        super(PrepareUploadFailed, self).__init__(
+            "Upload to YubiCloud failed with status {}: {}".format(status, content)
+        )
+        self.status = status
+        self.content = content
+        self.errors = [
+            e if isinstance(e, PrepareUploadError) else PrepareUploadError[e]
+            for e in error_ids
+        ]
+
+    def messages(self):
+        return [e.message() for e in self.errors]
+
+
+def format_upload_data(key, public_id, private_id, serial=None):
+    """
+    Formats a Yubico OTP credential as the record uploaded to YubiCloud.
+    """
+    return {
+        "aes_key": key.hex(),
+        "serial": serial or 0,
+        "public_id": modhex_encode(public_id),
+        "private_id": private_id.hex(),
+    }
+
+
+def _parse_upload_response(status, body):
+    if status == 200:
+        return json.loads(body.decode("utf-8"))["finish_url"]
+    logger.debug("Upload failed with status %d: %s", status, body)
+    if status == 404:
+        raise PrepareUploadFailed(status, body, [PrepareUploadError.NOT_FOUND])
+    elif status == 503:
+        raise PrepareUploadFailed(
+            status, body, [PrepareUploadError.SERVICE_UNAVAILABLE]
+        )
+    else:
+        try:
+            errors = json.loads(body.decode("utf-8")).get("errors")
+        except Exception:
+            errors = []
+        raise PrepareUploadFailed(status, body, errors)
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class UploadClient(object):
+    """
+    Uploads Yubico OTP credentials to YubiCloud, keeping HTTPS connections open
+    between uploads.
+
+    Requests which could not be sent, which the server closed the connection on
+    without responding to, or which were answered with "503 Service Unavailable",
+    are retried with exponential backoff. So are requests on a reused connection
+    which the server reset while it was idle. Other failures are final, as the
+    server may already have acted on the request.
+    """
+
+    def __init__(
+        self,
+        base_url=UPLOAD_URL,
+        user_agent="python-yubikey-manager/" + __version__,
+        timeout=5,
+        max_connections=4,
+        retries=3,
+        backoff=0.5,
+    ):
+        url = urlsplit(base_url)
+        if url.scheme == "https":
+            self._connection_type = HTTPSConnection
+        elif url.scheme == "http":
+            self._connection_type = HTTPConnection
+        else:
+            raise ValueError("Unsupported URL: " + base_url)
+        self._host = url.netloc
+        self._path = url.path.rstrip("/") + UPLOAD_PATH
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = Queue()
+        self._slots = BoundedSemaphore(max_connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes all idle connections."""
+        while not self._idle.empty():
+            self._idle.get().close()
+
+    def _connection(self):
+        """Returns a connection, and whether it was reused from an earlier request."""
+        try:
+            return self._idle.get_nowait(), True
+        except Empty:
+            conn = self._connection_type(self._host, timeout=self.timeout)  # nosec
+            return conn, False
+
+    def _post(self, body):
+        with self._slots:
+            conn, reused = self._connection()
+            try:
+                conn.request(
+                    "POST",
+                    self._path,
+                    body=body,
+                    headers={
+                        "Content-Type": "application/json",
+                        "User-Agent": self.user_agent,
+                    },
+                )
+            except Exception as e:
+                conn.close()
+                raise _RetryableError(e)
+            try:
+                resp = conn.getresponse()
+                resp_body = resp.read()
+            except RemoteDisconnected as e:
+                # Closed without a response, as when an idle connection times out
+                conn.close()
+                raise _RetryableError(e)
+            except (ConnectionResetError, BrokenPipeError, BadStatusLine) as e:
+                conn.close()
+                if reused:
+                    # Reset by the server while idle
+                    raise _RetryableError(e)
+                raise
+            except Exception:
+                conn.close()
+                raise
+            # A closed connection is reopened by the next request
+            self._idle.put(conn)
+            return resp.status, resp_body
+
+    def prepare(self, key, public_id, private_id, serial=None):
+        """
+        Prepares the upload of a credential, returning the URL of the form to
+        complete it in.
+        """
+        data = format_upload_data(key, public_id, private_id, serial)
+        body = json.dumps(data, indent=False, sort_keys=True).encode("utf-8")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                status, resp_body = self._post(body)
+            except _RetryableError as e:
+                logger.warning(
+                    "Failed to connect to %s (attempt %d)",
+                    self._host,
+                    attempt + 1,
+                    exc_info=e,
+                )
+                error = PrepareUploadFailed(
+                    None, None, [PrepareUploadError.CONNECTION_FAILED]
+                )
+                continue
+            except Exception as e:
+                logger.error("No response from %s", self._host, exc_info=e)
+                raise PrepareUploadFailed(
+                    None, None, [PrepareUploadError.CONNECTION_FAILED]
+                )
+            try:
+                return _parse_upload_response(status, resp_body)
+            except PrepareUploadFailed as e:
+                if status != 503:
+                    raise
+                error = e
+        raise error
+
+    def prepare_many(self, credentials):
+        """
+        Prepares uploads for several credentials, using up to max_connections
+        connections at a time.
+
+        Takes (key, public_id, private_id, serial) tuples, and returns a list with
+        the URL, or the PrepareUploadFailed error, for each credential, in order.
+        """
+
+        def prepare(credential):
+            try:
+                return self.prepare(*credential)
+            except PrepareUploadFailed as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            return list(executor.map(prepare, credentials))
+
+
+def prepare_upload_key(
+    key,
+    public_id,
+    private_id,
+    serial=None,
+    user_agent="python-yubikey-manager/" + __version__,
+):
+    with UploadClient(user_agent=user_agent) as client:
+        return client.prepare(key, public_id, private_id, serial)
+
+
+COMPILED_FORMAT = "ykman-otp-compiled"
+COMPILED_VERSION = 1
+
+# The types of compiled configurations, with the YubiKey version they require
+COMPILED_MIN_VERSIONS = {
+    "yubiotp": Version(1, 0, 0),
+    "hotp": Version(2, 2, 0),
+    "static": Version(2, 2, 0),
+}
+
+# Binary fields of compiled entries, with how they are encoded in the file
+_COMPILED_FIELDS = {
+    "config": (bytes.hex, bytes.fromhex),
+    "access_code": (bytes.hex, bytes.fromhex),
+    "public_id": (modhex_encode, modhex_decode),
+    "private_id": (bytes.hex, bytes.fromhex),
+    "key": (bytes.hex, bytes.fromhex),
+}
+
+
+class CompiledSlotConfiguration(SlotConfiguration):
+    """
+    A slot configuration which has already been serialized, with its access code.
+
+    The minimum version is that of the type of configuration which was compiled.
+    """
+
+    def __init__(self, config, min_version=Version(1, 0, 0)):
+        super(CompiledSlotConfiguration, self).__init__()
+        if len(config) != CONFIG_SIZE:
+            raise ValueError(
+                "Compiled configuration must be {} bytes".format(CONFIG_SIZE)
+            )
+        self._config = config
+        self._min_version = min_version
+
+    def is_supported_by(self, version):
+        return version >= self._min_version
+
+    def get_config(self, acc_code=None):
+        return self._config
+
+
+def compile_configuration(sequence, configuration, acc_code=None, **details):
+    """
+    Serializes a slot configuration into an entry for write_compiled.
+
+    The details, such as the public ID, private ID and key, are stored alongside the
+    configuration, for registering the credential with a validation server.
+    """
+    entry = dict(details)
+    entry.update(
+        sequence=sequence,
+        config=configuration.get_config(acc_code),
+        access_code=acc_code,
+    )
+    return entry
+
+
+def write_compiled(f, config_type, entries):
+    """
+    Writes compiled slot configurations to a file, as one JSON object per line.
+    The first line is a header, giving the type of the configurations.
+    """
+    header = {"format": COMPILED_FORMAT, "version": COMPILED_VERSION}
+    header["type"] = config_type
+    f.write(json.dumps(header, sort_keys=True) + "\n")
+    for entry in entries:
+        data = {}
+        for k, v in entry.items():
+            if k in _COMPILED_FIELDS and v is not None:
+                v = _COMPILED_FIELDS[k][0](v)
+            data[k] = v
+        f.write(json.dumps(data, sort_keys=True) + "\n")
+
+
+def read_compiled(f):
+    """
+    Reads compiled slot configurations written by write_compiled.
+
+    Returns the type of the configurations, and a list of entries ordered by
+    sequence number.
+    """
+    lines = [line for line in f if line.strip()]
+    try:
+        header = json.loads(lines[0])
+        if (
+            header.get("format") != COMPILED_FORMAT
+            or header.get("version") != COMPILED_VERSION
+        ):
+            raise ValueError("Unsupported file format")
+        if header.get("type") not in COMPILED_MIN_VERSIONS:
+            raise ValueError("Unsupported configuration type")
+        entries = {}
+        for line in lines[1:]:
+            data = json.loads(line)
+            for k, (_, decode) in _COMPILED_FIELDS.items():
+                if data.get(k) is not None:
+                    data[k] = decode(data[k])
+            sequence = data["sequence"]
+            if sequence in entries:
+                raise ValueError("Duplicate sequence number: {}".format(sequence))
+            CompiledSlotConfiguration(data["config"])  # Check the size
+            entries[sequence] = data
+    except (IndexError, KeyError, TypeError) as e:
+        raise ValueError("Invalid compiled configuration file: {!r}".format(e))
+    return header["type"], [entries[k] for k in sorted(entries)]
+
+
+def is_in_fips_mode(session):
+    """
+    Check if the OTP application of a FIPS YubiKey is in FIPS approved mode.
+    """
+    return session.backend.send_and_receive(0x14, b"", 1) == b"\1"
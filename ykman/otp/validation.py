@@ -0,0 +1,245 @@
+# Copyright (c) 2020 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from yubikit.core.otp import calculate_crc, check_crc
+
+from ..util import modhex_decode, modhex_encode
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+from enum import Enum
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import json
+import os
+import struct
+
+
+OTP_LENGTH = 44
+KEY_SIZE = 16
+PRIVATE_ID_SIZE = 6
+
+# Decrypted token: private ID, usage counter, 24 bit timestamp, session usage counter,
+# random data and CRC, all little endian.
+_TOKEN_FORMAT = "<6sHHBBHH"
+
+# The top bit of the usage counter is not part of the counter. It is set when the
+# OTP was triggered through the HID keyboard LEDs (TICKET_ACT_HIDRPT).
+COUNTER_MASK = 0x7FFF
+TICKET_ACT_HIDRPT = 0x8000
+
+
+class ValidationStatus(Enum):
+    OK = "The OTP is valid."
+    BAD_OTP = "The OTP is not formatted as a Yubico OTP."
+    UNKNOWN_KEY = "No key is known for the public ID."
+    CORRUPT_OTP = "The OTP could not be decrypted with the key for the public ID."
+    REPLAYED_OTP = "The OTP, or a later one, has already been used."
+
+    def message(self):
+        return self.value
+
+
+class ValidationResult(NamedTuple):
+    status: ValidationStatus
+    public_id: Optional[bytes] = None
+    counter: Optional[int] = None
+    session_use: Optional[int] = None
+    timestamp: Optional[int] = None
+    hid_triggered: Optional[bool] = None
+
+    @property
+    def is_valid(self) -> bool:
+        return self.status == ValidationStatus.OK
+
+
+def _cipher(key):
+    if len(key) != KEY_SIZE:
+        raise ValueError("Key must be {} bytes".format(KEY_SIZE))
+    return Cipher(algorithms.AES(key), modes.ECB(), default_backend())  # nosec
+
+
+class KeyStore(object):
+    """AES keys of Yubico OTP credentials, indexed by public ID."""
+
+    def __init__(self):
+        self._keys: Dict[bytes, Tuple[bytes, object]] = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, public_id):
+        return public_id in self._keys
+
+    def add(self, public_id: bytes, private_id: bytes, key: bytes) -> None:
+        if len(private_id) != PRIVATE_ID_SIZE:
+            raise ValueError("Private ID must be {} bytes".format(PRIVATE_ID_SIZE))
+        # An ECB decryptor keeps no state between blocks, so one is kept for each key
+        self._keys[public_id] = (private_id, _cipher(key).decryptor())
+
+    def add_record(self, record: dict) -> None:
+        """Adds a credential given as the data uploaded by prepare_upload_key."""
+        self.add(
+            modhex_decode(record["public_id"]),
+            bytes.fromhex(record["private_id"]),
+            bytes.fromhex(record["aes_key"]),
+        )
+
+    def get(self, public_id: bytes):
+        """Returns the private ID and an AES decryptor for a public ID, or None."""
+        return self._keys.get(public_id)
+
+    @classmethod
+    def load(cls, f) -> "KeyStore":
+        """Reads a key store from a file with one upload record per line, as JSON."""
+        store = cls()
+        for line in f:
+            if line.strip():
+                try:
+                    store.add_record(json.loads(line))
+                except (KeyError, IndexError, TypeError) as e:
+                    raise ValueError("Invalid key record: {!r}".format(e))
+        return store
+
+
+class ReplayIndex(object):
+    """The last used counter values for each public ID, to detect replayed OTPs."""
+
+    def __init__(self):
+        self._last_used: Dict[bytes, Tuple[int, int]] = {}
+
+    def get(self, public_id: bytes) -> Optional[Tuple[int, int]]:
+        """Returns the last used (counter, session_use) for a public ID, or None."""
+        return self._last_used.get(public_id)
+
+    def use(self, public_id: bytes, counter: int, session_use: int) -> bool:
+        """Marks counter values as used, if they are later than the last used ones.
+
+        Returns False if the values are not later, meaning the OTP is replayed.
+        """
+        last = self._last_used.get(public_id)
+        if last is not None and (counter, session_use) <= last:
+            return False
+        self._last_used[public_id] = (counter, session_use)
+        return True
+
+    def dump(self, f) -> None:
+        json.dump(
+            {modhex_encode(k): list(v) for k, v in self._last_used.items()},
+            f,
+            sort_keys=True,
+        )
+
+    @classmethod
+    def load(cls, f) -> "ReplayIndex":
+        index = cls()
+        for public_id, (counter, session_use) in json.load(f).items():
+            # Counters were once stored including the TICKET_ACT_HIDRPT flag
+            index._last_used[modhex_decode(public_id)] = (
+                counter & COUNTER_MASK,
+                session_use,
+            )
+        return index
+
+
+class OtpValidator(object):
+    """Validates Yubico OTPs locally, using a KeyStore and a ReplayIndex."""
+
+    def __init__(self, key_store: KeyStore, replay_index: Optional[ReplayIndex] = None):
+        self.key_store = key_store
+        self.replay_index = replay_index if replay_index is not None else ReplayIndex()
+
+    def validate(self, otp: str) -> ValidationResult:
+        """Validates a single OTP, marking it as used if it is valid."""
+        if len(otp) != OTP_LENGTH:
+            return ValidationResult(ValidationStatus.BAD_OTP)
+        try:
+            data = modhex_decode(otp)
+        except ValueError:
+            return ValidationResult(ValidationStatus.BAD_OTP)
+
+        public_id = data[:-16]
+        entry = self.key_store.get(public_id)
+        if entry is None:
+            return ValidationResult(ValidationStatus.UNKNOWN_KEY, public_id)
+        private_id, decryptor = entry
+
+        token = decryptor.update(data[-16:])
+        if not check_crc(token) or token[:PRIVATE_ID_SIZE] != private_id:
+            return ValidationResult(ValidationStatus.CORRUPT_OTP, public_id)
+
+        _, usage, ts_low, ts_high, session_use, _, _ = struct.unpack(
+            _TOKEN_FORMAT, token
+        )
+        counter = usage & COUNTER_MASK
+        if not self.replay_index.use(public_id, counter, session_use):
+            status = ValidationStatus.REPLAYED_OTP
+        else:
+            status = ValidationStatus.OK
+        return ValidationResult(
+            status,
+            public_id,
+            counter,
+            session_use,
+            ts_high << 16 | ts_low,
+            bool(usage & TICKET_ACT_HIDRPT),
+        )
+
+    def validate_many(self, otps: Iterable[str]) -> List[ValidationResult]:
+        """Validates OTPs in order, as if validate was called for each one.
+
+        A replayed OTP is detected even if the original is in the same batch.
+        """
+        validate = self.validate
+        return [validate(otp) for otp in otps]
+
+
+def generate_otp(
+    public_id: bytes,
+    private_id: bytes,
+    key: bytes,
+    counter: int,
+    session_use: int,
+    timestamp: int = 0,
+    random: Optional[bytes] = None,
+) -> str:
+    """Generates an OTP the way a YubiKey programmed with the credential would.
+
+    The counter may include the TICKET_ACT_HIDRPT flag.
+    """
+    token = struct.pack(
+        "<6sHHBB2s",
+        private_id,
+        counter,
+        timestamp & 0xFFFF,
+        timestamp >> 16 & 0xFF,
+        session_use,
+        random or os.urandom(2),
+    )
+    token += struct.pack("<H", ~calculate_crc(token) & 0xFFFF)
+    encryptor = _cipher(key).encryptor()
+    return modhex_encode(public_id + encryptor.update(token))
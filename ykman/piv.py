@@ -26,7 +26,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 
-from yubikit.core import Tlv, BadResponseError
+from yubikit.core import Tlv, Version, BadResponseError, NotSupportedError
 from yubikit.core.smartcard import ApduError, SW
 from yubikit.piv import (
     SLOT,
@@ -36,6 +36,8 @@ from yubikit.piv import (
     PIN_POLICY,
     TOUCH_POLICY,
     TAG_LRC,
+    SlotMetadata,
+    unpack_certificate,
 )
 
 from .device import is_fips_version
@@ -53,9 +55,14 @@ from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
 from cryptography.x509.oid import NameOID
 from collections import OrderedDict
+from contextlib import contextmanager
 from threading import Timer
+import datetime
+import hashlib
 import logging
+import base64
 import struct
+import json
 import os
 
 
@@ -95,16 +102,37 @@ class UnsupportedAlgorithm(Exception):
         self.key = key
 
 
-def _dummy_key(algorithm):
-    if algorithm == KEY_TYPE.RSA1024:
-        return rsa.generate_private_key(65537, 1024, default_backend())  # nosec
-    if algorithm == KEY_TYPE.RSA2048:
-        return rsa.generate_private_key(65537, 2048, default_backend())
-    if algorithm == KEY_TYPE.ECCP256:
-        return ec.generate_private_key(ec.SECP256R1(), default_backend())
-    if algorithm == KEY_TYPE.ECCP384:
-        return ec.generate_private_key(ec.SECP384R1(), default_backend())
-    raise ValueError("Invalid algorithm")
+# AlgorithmIdentifiers for SHA256 signatures, used in certificates and CSRs
+_SIGNATURE_ALGORITHMS = {
+    # sha256WithRSAEncryption (1.2.840.113549.1.1.11), NULL parameters
+    ALGORITHM.RSA: Tlv(
+        0x30, Tlv(0x06, bytes.fromhex("2a864886f70d01010b")) + Tlv(0x05)
+    ),
+    # ecdsa-with-SHA256 (1.2.840.10045.4.3.2)
+    ALGORITHM.EC: Tlv(0x30, Tlv(0x06, bytes.fromhex("2a8648ce3d040302"))),
+}
+
+_dummy_signing_key = None
+
+
+def _get_dummy_signing_key():
+    # The builders in cryptography require a private key to produce the DER
+    # encoding. Signing with a single cached EC key avoids generating a new
+    # (potentially RSA) key each time, the signature is replaced anyway.
+    global _dummy_signing_key
+    if _dummy_signing_key is None:
+        _dummy_signing_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    return _dummy_signing_key
+
+
+def _verify_signature(public_key, signature, data):
+    # Verifies a SHA256 signature, as made by the YubiKey when signing certificates
+    if isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        public_key.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+    else:
+        raise ValueError("Unknown key type: " + type(public_key))
 
 
 def _derive_key(pin, salt):
@@ -171,17 +199,236 @@ class PivmanProtectedData(object):
         return Tlv(0x88, data)
 
 
+# Objects which can be read without verifying the PIN
+_SNAPSHOT_OBJECTS = [
+    OBJECT_ID.CHUID,
+    OBJECT_ID.CAPABILITY,
+    OBJECT_ID.SECURITY,
+    OBJECT_ID.DISCOVERY,
+    OBJECT_ID.KEY_HISTORY,
+    OBJECT_ID_PIVMAN_DATA,
+] + [OBJECT_ID.from_slot(slot) for slot in SLOT if slot != SLOT.CARD_MANAGEMENT]
+
+
+class PivSnapshot(object):
+    """The state of the PIV application, as read by PivController.snapshot().
+
+    Objects are kept as the raw data read from the YubiKey, certificates are only
+    parsed when first requested.
+    """
+
+    def __init__(self, version, pin_tries, objects, metadata=None):
+        self.version = version
+        self.pin_tries = pin_tries
+        self.objects = objects
+        self.metadata = metadata  # None if not supported by the YubiKey
+        self._certificates = {}
+
+    @property
+    def pivman_data(self):
+        if OBJECT_ID_PIVMAN_DATA in self.objects:
+            return PivmanData(self.objects[OBJECT_ID_PIVMAN_DATA])
+        return PivmanData()
+
+    @property
+    def certificate_slots(self):
+        return [
+            slot
+            for slot in SLOT
+            if slot not in (SLOT.CARD_MANAGEMENT, SLOT.ATTESTATION)
+            and OBJECT_ID.from_slot(slot) in self.objects
+        ]
+
+    def get_certificate_der(self, slot):
+        return unpack_certificate(self.objects[OBJECT_ID.from_slot(slot)])
+
+    def get_certificate(self, slot):
+        if slot not in self._certificates:
+            der = self.get_certificate_der(slot)
+            try:
+                self._certificates[slot] = x509.load_der_x509_certificate(
+                    der, default_backend()
+                )
+            except ValueError as e:
+                raise BadResponseError("Invalid certificate", e)
+        return self._certificates[slot]
+
+    def list_certificates(self):
+        certs = OrderedDict()
+        for slot in self.certificate_slots:
+            try:
+                certs[slot] = self.get_certificate(slot)
+            except (BadResponseError, NotSupportedError):
+                certs[slot] = None
+        return certs
+
+    def to_dict(self):
+        """Returns the snapshot as a dict which can be serialized to JSON."""
+        data = {
+            "version": "%d.%d.%d" % self.version,
+            "pin_tries": self.pin_tries,
+            "objects": {
+                "%06x" % object_id: value.hex()
+                for object_id, value in self.objects.items()
+            },
+        }
+        if self.metadata is not None:
+            data["metadata"] = {
+                "%02x"
+                % slot: {
+                    "key_type": m.key_type.name,
+                    "pin_policy": m.pin_policy.name,
+                    "touch_policy": m.touch_policy.name,
+                    "generated": m.generated,
+                    "public_key": m.public_key_encoded.hex(),
+                }
+                for slot, m in self.metadata.items()
+            }
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a snapshot from the output of to_dict()."""
+        objects = OrderedDict(
+            (int(object_id, 16), bytes.fromhex(value))
+            for object_id, value in data["objects"].items()
+        )
+        metadata = None
+        if "metadata" in data:
+            metadata = OrderedDict(
+                (
+                    SLOT(int(slot, 16)),
+                    SlotMetadata(
+                        KEY_TYPE[m["key_type"]],
+                        PIN_POLICY[m["pin_policy"]],
+                        TOUCH_POLICY[m["touch_policy"]],
+                        m["generated"],
+                        bytes.fromhex(m["public_key"]),
+                    ),
+                )
+                for slot, m in data["metadata"].items()
+            )
+        return cls(
+            Version.from_string(data["version"]), data["pin_tries"], objects, metadata
+        )
+
+
+# Objects included in a backup. The discovery object is read-only, and the printed
+# information object is used for the PIN protected management key, which depends
+# on the YubiKey it's stored on. The attestation certificate belongs to the
+# YubiKey, and restoring it to another one would break attestation there.
+BACKUP_OBJECTS = [
+    object_id
+    for object_id in OBJECT_ID
+    if object_id not in (OBJECT_ID.DISCOVERY, OBJECT_ID.PRINTED, OBJECT_ID.ATTESTATION)
+]
+
+BACKUP_FORMAT = "ykman-piv-backup"
+BACKUP_VERSION = 1
+
+
+def _backup_manifest(digests):
+    return hashlib.sha256(
+        "".join("%06x:%s\n" % entry for entry in digests.items()).encode()
+    ).hexdigest()
+
+
+def write_backup(f, objects):
+    """Writes (object_id, data) pairs to a text file, as they are read.
+
+    Each object is written on a line of its own, as JSON, together with its
+    SHA-256 digest. The last line holds a digest over all the object digests.
+    The digests are not keyed, so they detect accidental corruption, such as a
+    truncated file, but not deliberate modification.
+    Returns the number of objects written.
+    """
+    f.write(json.dumps({"format": BACKUP_FORMAT, "version": BACKUP_VERSION}) + "\n")
+    digests = OrderedDict()
+    for object_id, data in objects:
+        digests[object_id] = hashlib.sha256(data).hexdigest()
+        entry = {
+            "object_id": "%06x" % object_id,
+            "sha256": digests[object_id],
+            "data": base64.b64encode(data).decode(),
+        }
+        f.write(json.dumps(entry) + "\n")
+    f.write(json.dumps({"manifest": _backup_manifest(digests)}) + "\n")
+    return len(digests)
+
+
+def read_backup(f):
+    """Reads a backup written by write_backup, verifying all digests.
+
+    Returns an OrderedDict of object_id -> data, or raises ValueError if the file
+    is not a valid backup. Objects which are not in BACKUP_OBJECTS are skipped.
+    """
+    try:
+        lines = [json.loads(line) for line in f if line.strip()]
+    except ValueError:
+        raise ValueError("Not a PIV backup")
+    if (
+        len(lines) < 2
+        or not all(isinstance(line, dict) for line in lines)
+        or lines[0].get("format") != BACKUP_FORMAT
+        or "manifest" not in lines[-1]
+    ):
+        raise ValueError("Not a PIV backup, or incomplete")
+    if lines[0].get("version") != BACKUP_VERSION:
+        raise ValueError("Unsupported backup version: %s" % lines[0].get("version"))
+
+    objects = OrderedDict()
+    digests = OrderedDict()
+    for entry in lines[1:-1]:
+        try:
+            object_id = int(entry["object_id"], 16)
+            data = base64.b64decode(entry["data"])
+            digest = entry["sha256"]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Malformed entry in backup")
+        digests[object_id] = hashlib.sha256(data).hexdigest()
+        if digests[object_id] != digest:
+            raise ValueError("Digest mismatch for object %06x" % object_id)
+        if object_id in BACKUP_OBJECTS:
+            objects[object_id] = data
+        else:
+            logger.warning("Skipping object %06x, not restorable", object_id)
+    if _backup_manifest(digests) != lines[-1]["manifest"]:
+        raise ValueError("Manifest digest mismatch")
+    return objects
+
+
 class PivController(object):
     def __init__(self, app):
         self._app = app
-        self._authenticated = False
-        self._update_pivman_data()
+        # State of the session, used to skip commands known to be unnecessary
+        self._pin = None  # PIN, while known to be verified
+        self._management_key = None  # Management key, once authenticated
+        self._pivman = None  # PivmanData, read when first needed
+        self._pivman_protected_data = None  # PivmanProtectedData, once read
+        self._derived_keys = {}  # Management keys derived from (PIN, salt)
+        self._existing_objects = set()  # IDs of objects known to exist
+        self._deferred_updates = None  # CHUID/CCC to write, when deferring updates
+
+    @property
+    def _authenticated(self):
+        return self._management_key is not None
+
+    @property
+    def _pivman_data(self):
+        if self._pivman is None:
+            self._update_pivman_data()
+        return self._pivman
 
     def _update_pivman_data(self):
         try:
-            self._pivman_data = PivmanData(self.get_data(OBJECT_ID_PIVMAN_DATA))
+            self._pivman = PivmanData(self.get_data(OBJECT_ID_PIVMAN_DATA))
         except ApduError:
-            self._pivman_data = PivmanData()
+            self._pivman = PivmanData()
+
+    def _get_derived_key(self, pin, salt):
+        if (pin, salt) not in self._derived_keys:
+            self._derived_keys[(pin, salt)] = _derive_key(pin, salt)
+        return self._derived_keys[(pin, salt)]
 
     @property
     def version(self):
@@ -204,6 +451,8 @@ class PivController(object):
         return self._pivman_data.puk_blocked
 
     def _init_pivman_protected(self):
+        if self._pivman_protected_data is not None:
+            return  # Already read in this session
         try:
             self._pivman_protected_data = PivmanProtectedData(
                 self.get_data(OBJECT_ID_PIVMAN_PROTECTED_DATA)
@@ -215,54 +464,67 @@ class PivController(object):
             else:
                 raise
 
-    def verify(self, pin, touch_callback=None):
+    def _verify_pin(self, pin):
+        self._pin = None
         self._app.verify_pin(pin)
+        self._pin = pin
 
-        if not self._authenticated:
+    def verify(self, pin, touch_callback=None):
+        self._verify_pin(pin)
+
+        if not self._authenticated and self.has_protected_key:
             if self.has_derived_key:
-                self.authenticate(
-                    _derive_key(pin, self._pivman_data.salt), touch_callback
-                )
-                self.verify(pin, touch_callback)
-            elif self.has_stored_key:
+                key = self._get_derived_key(pin, self._pivman_data.salt)
+            else:
                 self._init_pivman_protected()
-                self.authenticate(self._pivman_protected_data.key, touch_callback)
-                self.verify(pin, touch_callback)
+                key = self._pivman_protected_data.key
+            self.authenticate(key, touch_callback)
+            # Authentication may clear the PIN verification, verify again
+            self._verify_pin(pin)
 
     def change_pin(self, old_pin, new_pin):
+        self._pin = None
         self._app.change_pin(old_pin, new_pin)
 
         if self.has_derived_key:
             if not self._authenticated:
-                self.authenticate(_derive_key(old_pin, self._pivman_data.salt))
+                self.authenticate(
+                    self._get_derived_key(old_pin, self._pivman_data.salt)
+                )
             self._use_derived_key(new_pin)
 
     def change_puk(self, old_puk, new_puk):
         self._app.change_puk(old_puk, new_puk)
 
     def unblock_pin(self, puk, new_pin):
+        self._pin = None
         self._app.unblock_pin(puk, new_pin)
 
     def set_pin_retries(self, pin_retries, puk_retries):
+        # Resets the PIN and PUK to their default values
+        self._pin = None
         self._app.set_pin_attempts(pin_retries, puk_retries)
 
     def _use_derived_key(self, pin, touch=False):
-        self.verify(pin)
+        if self._pin != pin:
+            self.verify(pin)
         new_salt = os.urandom(16)
-        new_key = _derive_key(pin, new_salt)
+        new_key = self._get_derived_key(pin, new_salt)
         self._app.set_management_key(new_key)
+        self._management_key = new_key
         self._pivman_data.salt = new_salt
-        self._app.put_data(OBJECT_ID_PIVMAN_DATA, self._pivman_data.get_bytes())
+        self.put_data(OBJECT_ID_PIVMAN_DATA, self._pivman_data.get_bytes())
 
     def set_pin_timestamp(self, timestamp):
         self._pivman_data.pin_timestamp = timestamp
-        self._app.put_data(OBJECT_ID_PIVMAN_DATA, self._pivman_data.get_bytes())
+        self.put_data(OBJECT_ID_PIVMAN_DATA, self._pivman_data.get_bytes())
 
     def authenticate(self, key, touch_callback=None):
         if touch_callback is not None:
             touch_timer = Timer(0.500, touch_callback)
             touch_timer.start()
 
+        self._management_key = None
         try:
             self._app.authenticate(key)
         except Exception as e:
@@ -272,7 +534,8 @@ class PivController(object):
             if touch_callback is not None:
                 touch_timer.cancel()
 
-        self._authenticated = True
+        self._management_key = key
+        self._pin = None
 
     def set_mgm_key(self, new_key, touch=False, store_on_device=False):
         # If the key should be protected by PIN and no key is given,
@@ -304,6 +567,7 @@ class PivController(object):
 
         # Set the new management key
         self._app.set_management_key(new_key)
+        self._management_key = new_key
 
         if self.has_derived_key:
             # Clear salt for old derived keys.
@@ -330,20 +594,23 @@ class PivController(object):
             except ApduError as e:
                 logger.debug("No PIN provided, can't clear key..", exc_info=e)
         # Update CHUID and CCC if not set
-        try:
-            self.get_data(OBJECT_ID.CAPABILITY)
-        except ApduError as e:
-            if e.sw == SW.FILE_NOT_FOUND:
-                self.update_ccc()
-            else:
-                logger.debug("Failed to read CCC...", exc_info=e)
-        try:
-            self.get_data(OBJECT_ID.CHUID)
-        except ApduError as e:
-            if e.sw == SW.FILE_NOT_FOUND:
-                self.update_chuid()
-            else:
-                logger.debug("Failed to read CHUID...", exc_info=e)
+        known = self._existing_objects | (self._deferred_updates or set())
+        if OBJECT_ID.CAPABILITY not in known:
+            try:
+                self.get_data(OBJECT_ID.CAPABILITY)
+            except ApduError as e:
+                if e.sw == SW.FILE_NOT_FOUND:
+                    self.update_ccc()
+                else:
+                    logger.debug("Failed to read CCC...", exc_info=e)
+        if OBJECT_ID.CHUID not in known:
+            try:
+                self.get_data(OBJECT_ID.CHUID)
+            except ApduError as e:
+                if e.sw == SW.FILE_NOT_FOUND:
+                    self.update_chuid()
+                else:
+                    logger.debug("Failed to read CHUID...", exc_info=e)
 
     def get_pin_tries(self):
         """
@@ -355,13 +622,89 @@ class PivController(object):
 
     def reset(self):
         self._app.reset()
-        self._update_pivman_data()
+        self._pin = None
+        self._management_key = None
+        self._pivman = None
+        self._pivman_protected_data = None
+        self._existing_objects.clear()
 
     def get_data(self, object_id):
-        return self._app.get_object(object_id)
+        data = self._app.get_object(object_id)
+        self._existing_objects.add(object_id)
+        return data
 
     def put_data(self, object_id, data):
         self._app.put_object(object_id, data)
+        if data:
+            self._existing_objects.add(object_id)
+        else:
+            self._existing_objects.discard(object_id)
+
+    def snapshot(self, metadata=False):
+        """
+        Reads all objects which don't require the PIN and the number of PIN retries.
+        With metadata, the metadata of all keys is read as well, on YubiKey 5.3 and
+        later, which takes one command per slot. Everything is read in a single
+        transaction, and returned as a PivSnapshot.
+        """
+        objects = OrderedDict()
+        slot_metadata = None
+        with self._app.protocol.connection.transaction():
+            pin_tries = self.get_pin_tries()
+            for object_id in _SNAPSHOT_OBJECTS:
+                try:
+                    objects[object_id] = self.get_data(object_id)
+                except (ApduError, BadResponseError) as e:
+                    logger.debug("Skipping object %x", object_id, exc_info=e)
+            if metadata and self.version >= (5, 3, 0):
+                slot_metadata = OrderedDict()
+                for slot in SLOT:
+                    if slot == SLOT.CARD_MANAGEMENT:
+                        continue
+                    try:
+                        slot_metadata[slot] = self._app.get_slot_metadata(slot)
+                    except ApduError as e:
+                        if e.sw != SW.FILE_NOT_FOUND:  # No key in slot
+                            raise
+
+        snapshot = PivSnapshot(self.version, pin_tries, objects, slot_metadata)
+        self._pivman = snapshot.pivman_data
+        return snapshot
+
+    def read_objects(self, object_ids):
+        """
+        Yields (object_id, data) for each of the given objects which exist.
+        Objects which can't be read, for example because they require the PIN to be
+        verified, are skipped.
+        """
+        for object_id in object_ids:
+            try:
+                yield object_id, self.get_data(object_id)
+            except ApduError as e:
+                if e.sw != SW.FILE_NOT_FOUND:
+                    logger.debug("Unable to read object %x", object_id, exc_info=e)
+
+    def write_objects(self, objects):
+        """
+        Writes the given (object_id, data) pairs, in a single transaction. Objects
+        which already hold the same data are not written. Requires authentication
+        with the management key. Returns the IDs of the objects written.
+        """
+        written = []
+        with self._app.protocol.connection.transaction():
+            for object_id, data in objects:
+                try:
+                    if self.get_data(object_id) == data:
+                        continue
+                except ApduError as e:
+                    if e.sw not in (
+                        SW.FILE_NOT_FOUND,
+                        SW.SECURITY_CONDITION_NOT_SATISFIED,
+                    ):
+                        raise
+                self.put_data(object_id, data)
+                written.append(object_id)
+        return written
 
     def generate_key(
         self,
@@ -378,7 +721,14 @@ class PivController(object):
     def generate_self_signed_certificate(
         self, slot, public_key, common_name, valid_from, valid_to, touch_callback=None
     ):
+        cert = self._sign_self_signed_certificate(
+            slot, public_key, common_name, valid_from, valid_to, touch_callback
+        )
+        self.import_certificate(slot, cert, verify=False)
 
+    def _sign_self_signed_certificate(
+        self, slot, public_key, common_name, valid_from, valid_to, touch_callback
+    ):
         key_type = KEY_TYPE.from_public_key(public_key)
 
         builder = x509.CertificateBuilder()
@@ -400,12 +750,57 @@ class PivController(object):
         builder = builder.not_valid_after(valid_to)
 
         try:
-            cert = self.sign_cert_builder(slot, key_type, builder, touch_callback)
+            return self.sign_cert_builder(slot, key_type, builder, touch_callback)
         except ApduError as e:
             logger.error("Failed to generate certificate for slot %s", slot, exc_info=e)
             raise
 
-        self.import_certificate(slot, cert, verify=False)
+    def provision_slot(
+        self,
+        slot,
+        key_type,
+        common_name,
+        valid_from=None,
+        valid_to=None,
+        pin_policy=PIN_POLICY.DEFAULT,
+        touch_policy=TOUCH_POLICY.DEFAULT,
+        csr=False,
+        verify=False,
+        touch_callback=None,
+    ):
+        """
+        Generates a key in a slot, and signs a self-signed certificate for it
+        which is stored in the slot, or a CSR if csr is True. When verify is True,
+        the signature is checked against the public key returned when generating
+        the key. The certificate is valid for a year from now, unless given.
+        Requires authentication, and the PIN to be verified.
+
+        Returns the public key, and the certificate or CSR.
+        """
+        with self.deferred_updates():
+            public_key = self.generate_key(slot, key_type, pin_policy, touch_policy)
+            if csr:
+                result = self.generate_certificate_signing_request(
+                    slot, public_key, common_name, touch_callback
+                )
+                signature, data = result.signature, result.tbs_certrequest_bytes
+            else:
+                valid_from = valid_from or datetime.datetime.utcnow()
+                valid_to = valid_to or valid_from + datetime.timedelta(days=365)
+                result = self._sign_self_signed_certificate(
+                    slot, public_key, common_name, valid_from, valid_to, touch_callback
+                )
+                signature, data = result.signature, result.tbs_certificate_bytes
+
+            if verify:
+                try:
+                    _verify_signature(public_key, signature, data)
+                except InvalidSignature:
+                    raise KeypairMismatch(slot, result)
+
+            if not csr:
+                self.import_certificate(slot, result, verify=False)
+        return public_key, result
 
     def generate_certificate_signing_request(
         self, slot, public_key, subject, touch_callback=None
@@ -436,7 +831,9 @@ class PivController(object):
     ):
         return self._app.put_key(slot, key, pin_policy, touch_policy)
 
-    def import_certificate(self, slot, certificate, verify=False, touch_callback=None):
+    def import_certificate(
+        self, slot, certificate, verify=False, touch_callback=None, compress=None
+    ):
         if verify:
             # Verify that the public key used in the certificate
             # is from the same keypair as the private key.
@@ -458,17 +855,11 @@ class PivController(object):
                         padding.PKCS1v15(),  # Only used for RSA
                     )
                 finally:
+                    self._pin = None  # Cleared if the PIN policy is ALWAYS
                     if touch_callback is not None:
                         touch_timer.cancel()
 
-                if isinstance(public_key, rsa.RSAPublicKey):
-                    public_key.verify(
-                        test_sig, test_data, padding.PKCS1v15(), hashes.SHA256(),
-                    )
-                elif isinstance(public_key, ec.EllipticCurvePublicKey):
-                    public_key.verify(test_sig, test_data, ec.ECDSA(hashes.SHA256()))
-                else:
-                    raise ValueError("Unknown key type: " + type(public_key))
+                _verify_signature(public_key, test_sig, test_data)
 
             except ApduError as e:
                 if e.sw == SW.INCORRECT_PARAMETERS:
@@ -478,7 +869,7 @@ class PivController(object):
             except InvalidSignature:
                 raise KeypairMismatch(slot, certificate)
 
-        self._app.put_certificate(slot, certificate)
+        self._app.put_certificate(slot, certificate, compress)
         self.update_chuid()
 
     def read_certificate(self, slot):
@@ -490,6 +881,19 @@ class PivController(object):
     def attest(self, slot):
         return self._app.attest_key(slot)
 
+    def get_key_type(self, slot):
+        if self.version >= (5, 3, 0):
+            return self._app.get_slot_metadata(slot).key_type
+        # No metadata, use the public key of the certificate in the slot
+        return KEY_TYPE.from_public_key(self.read_certificate(slot).public_key())
+
+    def sign_many(
+        self, slot, key_type, digests, hash_algorithm, padding=None, pin=None
+    ):
+        return self._app.sign_many(
+            slot, key_type, digests, hash_algorithm, padding, pin
+        )
+
     def list_certificates(self):
         certs = OrderedDict()
         for slot in set(SLOT) - {SLOT.CARD_MANAGEMENT, SLOT.ATTESTATION}:
@@ -502,7 +906,40 @@ class PivController(object):
 
         return certs
 
+    @contextmanager
+    def deferred_updates(self):
+        """Defers updates of the CHUID and CCC until the end of the block.
+
+        Each object is then written at most once, no matter how many times it has
+        been updated within the block.
+        """
+        if self._deferred_updates is not None:  # Nested, handled by outer block
+            yield
+            return
+
+        self._deferred_updates = set()
+        try:
+            yield
+        except BaseException:
+            try:
+                self._write_deferred_updates()
+            except Exception as e:
+                logger.error("Failed to write deferred updates", exc_info=e)
+            raise
+        self._write_deferred_updates()
+
+    def _write_deferred_updates(self):
+        pending, self._deferred_updates = self._deferred_updates, None
+        if OBJECT_ID.CAPABILITY in pending:
+            self.update_ccc()
+        if OBJECT_ID.CHUID in pending:
+            self.update_chuid()
+
     def update_chuid(self):
+        if self._deferred_updates is not None:
+            self._deferred_updates.add(OBJECT_ID.CHUID)
+            return
+
         # Non-Federal Issuer FASC-N
         # [9999-9999-999999-0-1-0000000000300001]
         FASC_N = (
@@ -522,6 +959,10 @@ class PivController(object):
         )
 
     def update_ccc(self):
+        if self._deferred_updates is not None:
+            self._deferred_updates.add(OBJECT_ID.CAPABILITY)
+            return
+
         self.put_data(
             OBJECT_ID.CAPABILITY,
             Tlv(0xF0, b"\xa0\x00\x00\x01\x16\xff\x02" + os.urandom(14))
@@ -539,69 +980,48 @@ class PivController(object):
             + Tlv(TAG_LRC),
         )
 
-    def sign_cert_builder(self, slot, key_type, builder, touch_callback=None):
-        dummy_key = _dummy_key(key_type)
-        cert = builder.sign(dummy_key, hashes.SHA256(), default_backend())
+    def _sign_builder(self, slot, key_type, builder, public_key, touch_callback):
+        # Let cryptography encode the structure using a dummy key, then replace the
+        # parts which depend on the key and sign the result once, on the YubiKey.
+        dummy = builder.sign(
+            _get_dummy_signing_key(), hashes.SHA256(), default_backend()
+        )
+        seq = Tlv.parse_list(Tlv.unwrap(0x30, dummy.public_bytes(Encoding.DER)))
+        fields = Tlv.parse_list(seq[0].value)
+        algorithm = _SIGNATURE_ALGORITHMS[key_type.algorithm]
+        if public_key is None:
+            # TBSCertificate, signature algorithm follows the (optional) version
+            fields[2 if fields[0].tag == 0xA0 else 1] = algorithm
+        else:
+            # CertificationRequestInfo, replace the SubjectPublicKeyInfo
+            fields[2] = public_key.public_bytes(
+                Encoding.DER, PublicFormat.SubjectPublicKeyInfo
+            )
+        tbs = Tlv(0x30, b"".join(fields))
 
         if touch_callback is not None:
             touch_timer = Timer(0.500, touch_callback)
             touch_timer.start()
 
-        sig = self._app.sign(
-            slot,
-            key_type,
-            cert.tbs_certificate_bytes,
-            hashes.SHA256(),
-            padding.PKCS1v15(),  # Only used for RSA
-        )
-
-        if touch_callback is not None:
-            touch_timer.cancel()
+        try:
+            sig = self._app.sign(
+                slot, key_type, tbs, hashes.SHA256(), padding.PKCS1v15()  # For RSA
+            )
+        finally:
+            self._pin = None  # Cleared if the PIN policy is ALWAYS
+            if touch_callback is not None:
+                touch_timer.cancel()
 
-        seq = Tlv.parse_list(Tlv.unwrap(0x30, cert.public_bytes(Encoding.DER)))
-        # Replace signature, add unused bits = 0
-        seq[2] = Tlv(seq[2].tag, b"\0" + sig)
-        # Re-assemble sequence
-        der = Tlv(0x30, b"".join(seq))
+        # Assemble the signed structure, add unused bits = 0 to the signature
+        return Tlv(0x30, tbs + algorithm + Tlv(0x03, b"\0" + sig))
 
+    def sign_cert_builder(self, slot, key_type, builder, touch_callback=None):
+        der = self._sign_builder(slot, key_type, builder, None, touch_callback)
         return x509.load_der_x509_certificate(der, default_backend())
 
     def sign_csr_builder(self, slot, public_key, builder, touch_callback=None):
         key_type = KEY_TYPE.from_public_key(public_key)
-        dummy_key = _dummy_key(key_type)
-        csr = builder.sign(dummy_key, hashes.SHA256(), default_backend())
-        seq = Tlv.parse_list(Tlv.unwrap(0x30, csr.public_bytes(Encoding.DER)))
-
-        # Replace public key
-        pub_format = (
-            PublicFormat.PKCS1
-            if key_type.algorithm == ALGORITHM.RSA
-            else PublicFormat.SubjectPublicKeyInfo
-        )
-        dummy_bytes = dummy_key.public_key().public_bytes(Encoding.DER, pub_format)
-        pub_bytes = public_key.public_bytes(Encoding.DER, pub_format)
-        seq[0] = seq[0].replace(dummy_bytes, pub_bytes)
-
-        if touch_callback is not None:
-            touch_timer = Timer(0.500, touch_callback)
-            touch_timer.start()
-
-        sig = self._app.sign(
-            slot,
-            key_type,
-            seq[0],
-            hashes.SHA256(),
-            padding.PKCS1v15(),  # Only used for RSA
-        )
-
-        if touch_callback is not None:
-            touch_timer.cancel()
-
-        # Replace signature, add unused bits = 0
-        seq[2] = Tlv(seq[2].tag, b"\0" + sig)
-        # Re-assemble sequence
-        der = Tlv(0x30, b"".join(seq))
-
+        der = self._sign_builder(slot, key_type, builder, public_key, touch_callback)
         return x509.load_der_x509_csr(der, default_backend())
 
     @property
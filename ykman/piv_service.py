@@ -0,0 +1,343 @@
+# Copyright (c) 2020 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from yubikit.core import CommandError, BadResponseError
+from yubikit.core.smartcard import SmartCardConnection, ApduError, SW
+from yubikit.piv import PivSession, InvalidPinError, SLOT, KEY_TYPE
+
+from .device import list_ccid_devices
+from .util import HASH_ALGORITHMS
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    PublicFormat,
+    load_der_public_key,
+)
+from cryptography.hazmat.backends import default_backend
+from threading import Lock
+from time import time
+import socketserver
+import logging
+import json
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+KEY_SLOTS = [s for s in SLOT if s not in (SLOT.CARD_MANAGEMENT, SLOT.ATTESTATION)]
+
+
+def get_public_key_fingerprint(public_key):
+    """Gets the SHA-256 fingerprint of the DER encoded SubjectPublicKeyInfo."""
+    h = hashes.Hash(hashes.SHA256(), default_backend())
+    h.update(public_key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo))
+    return h.finalize()
+
+
+def list_keys(session):
+    """Lists the (slot, key_type, public_key) of keys in the PIV slots.
+
+    Slot metadata is used when supported, otherwise the certificates are used.
+    """
+    keys = []
+    for slot in KEY_SLOTS:
+        try:
+            if session.version >= (5, 3, 0):
+                metadata = session.get_slot_metadata(slot)
+                keys.append((slot, metadata.key_type, metadata.public_key))
+            else:
+                public_key = session.get_certificate(slot).public_key()
+                keys.append((slot, KEY_TYPE.from_public_key(public_key), public_key))
+        except (ApduError, BadResponseError, ValueError):
+            pass  # No key in slot
+    return keys
+
+
+class KeyWorker(object):
+    """A single key in a YubiKey, using one session for all operations."""
+
+    def __init__(self, device, connection, slot, key_type, pin=None):
+        self.device = device
+        self.slot = slot
+        self.key_type = key_type
+        self.pending = 0
+        self._pin = pin
+        self._lock = Lock()
+        self._connection = connection
+        self._session = PivSession(connection)
+        if pin is not None:
+            self._session.verify_pin(pin)
+
+    def _call(self, f):
+        with self._lock:
+            try:
+                return f(self._session)
+            except ApduError as e:
+                if self._pin is None or e.sw != SW.SECURITY_CONDITION_NOT_SATISFIED:
+                    raise
+                # PIN needed again, as with PIN policy ALWAYS
+                self._session.verify_pin(self._pin)
+                return f(self._session)
+
+    def sign(self, digest, hash_algorithm, padding):
+        return self._call(
+            lambda s: next(
+                s.sign_many(self.slot, self.key_type, [digest], hash_algorithm, padding)
+            )
+        )
+
+    def decrypt(self, cipher_text, padding):
+        return self._call(lambda s: s.decrypt(self.slot, cipher_text, padding))
+
+    def calculate_secret(self, peer_public_key):
+        return self._call(lambda s: s.calculate_secret(self.slot, peer_public_key))
+
+    def close(self):
+        try:
+            self._connection.close()
+        except Exception as e:
+            logger.debug("Error closing connection", exc_info=e)
+
+
+def find_keys(fingerprint, pin=None, devices=None):
+    """Opens a KeyWorker for each key matching a public key fingerprint.
+
+    Devices to search can be given, otherwise all smart card devices are used.
+    """
+    workers = []
+    for device in list_ccid_devices() if devices is None else devices:
+        try:
+            connection = device.open_connection(SmartCardConnection)
+        except Exception as e:
+            logger.debug("Failed to connect to %s", device.fingerprint, exc_info=e)
+            continue
+        try:
+            for slot, key_type, public_key in list_keys(PivSession(connection)):
+                if get_public_key_fingerprint(public_key) == fingerprint:
+                    logger.info("Found key in %s, slot %s", device.fingerprint, slot)
+                    workers.append(KeyWorker(device, connection, slot, key_type, pin))
+                    break
+            else:
+                connection.close()
+        except InvalidPinError:
+            connection.close()
+            for worker in workers:
+                worker.close()
+            raise
+        except Exception as e:
+            logger.debug("Failed to read keys from %s", device.fingerprint, exc_info=e)
+            connection.close()
+    return workers
+
+
+class KeyPool(object):
+    """Performs private key operations using all YubiKeys holding the same key.
+
+    Each operation is sent to the least loaded key. If a YubiKey fails, such as
+    when removed, it is dropped from the pool and the operation is retried on
+    another. Attached YubiKeys are searched again when keys are missing.
+    """
+
+    def __init__(self, fingerprint, pin=None, list_devices=list_ccid_devices):
+        self.fingerprint = fingerprint
+        self._pin = pin
+        self._list_devices = list_devices
+        self._workers = []
+        self._lock = Lock()
+        self._last_scan = 0.0
+        self._missing = False
+        self.rescan_interval = 5.0
+        self.retries = 3
+
+    @property
+    def workers(self):
+        return list(self._workers)
+
+    def scan(self):
+        with self._lock:
+            self._scan()
+
+    def _scan(self):
+        in_use = {w.device.fingerprint for w in self._workers}
+        devices = [d for d in self._list_devices() if d.fingerprint not in in_use]
+        self._workers.extend(find_keys(self.fingerprint, self._pin, devices))
+        self._last_scan = time()
+        self._missing = False
+
+    def _acquire(self):
+        with self._lock:
+            if not self._workers or (
+                self._missing and time() - self._last_scan > self.rescan_interval
+            ):
+                self._scan()
+            if not self._workers:
+                raise ValueError("No YubiKey with the key found")
+            worker = min(self._workers, key=lambda w: w.pending)
+            worker.pending += 1
+            return worker
+
+    def _release(self, worker, failed):
+        with self._lock:
+            worker.pending -= 1
+            if failed and worker in self._workers:
+                self._workers.remove(worker)
+                self._missing = True
+                worker.close()
+
+    def _call(self, name, *args):
+        for attempt in range(self.retries + 1):
+            worker = self._acquire()
+            failed = False
+            try:
+                return getattr(worker, name)(*args)
+            except (CommandError, ValueError):
+                raise
+            except Exception as e:
+                logger.warning(
+                    "YubiKey on %s failed, removing it", worker.device.fingerprint
+                )
+                logger.debug("Failure", exc_info=e)
+                failed = True
+            finally:
+                self._release(worker, failed)
+        raise ValueError("Operation failed after {} attempts".format(attempt + 1))
+
+    def sign(self, digest, hash_algorithm, padding=None):
+        return self._call("sign", digest, hash_algorithm, padding)
+
+    def decrypt(self, cipher_text, padding):
+        return self._call("decrypt", cipher_text, padding)
+
+    def calculate_secret(self, peer_public_key):
+        return self._call("calculate_secret", peer_public_key)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers = []
+
+
+def _get_padding(request, hash_algorithm):
+    name = request.get("padding", "PKCS1V15").upper()
+    if name == "PKCS1V15":
+        return padding.PKCS1v15()
+    elif name == "PSS":
+        return padding.PSS(padding.MGF1(hash_algorithm), hash_algorithm.digest_size)
+    elif name == "OAEP":
+        return padding.OAEP(padding.MGF1(hash_algorithm), hash_algorithm, None)
+    raise ValueError("Unsupported padding: " + name)
+
+
+def handle_request(pool, request):
+    """Performs the operation described by a request, returning the response.
+
+    Requests and responses are dicts which can be serialized as JSON. Binary
+    values are hex encoded. Supported operations:
+
+    {"op": "sign", "data": ..., "hash": "SHA256", "padding": "PKCS1V15"}
+        Signs data, or with "digest" given instead of "data", an already hashed
+        message. Padding, which can also be "PSS", is only used for RSA keys.
+
+    {"op": "decrypt", "data": ..., "padding": "PKCS1V15"}
+        Decrypts data using an RSA key. Padding can also be "OAEP", using "hash".
+
+    {"op": "ecdh", "public_key": ...}
+        Calculates a shared secret using a DER encoded EC public key.
+
+    The response is either {"result": ...} or {"error": message}.
+    """
+    try:
+        op = request.get("op")
+        hash_algorithm = HASH_ALGORITHMS[request.get("hash", "SHA256").upper()]()
+        if op == "sign":
+            if "digest" in request:
+                digest = bytes.fromhex(request["digest"])
+            else:
+                h = hashes.Hash(hash_algorithm, default_backend())
+                h.update(bytes.fromhex(request["data"]))
+                digest = h.finalize()
+            result = pool.sign(
+                digest, hash_algorithm, _get_padding(request, hash_algorithm)
+            )
+        elif op == "decrypt":
+            result = pool.decrypt(
+                bytes.fromhex(request["data"]), _get_padding(request, hash_algorithm)
+            )
+        elif op == "ecdh":
+            peer_public_key = load_der_public_key(
+                bytes.fromhex(request["public_key"]), default_backend()
+            )
+            result = pool.calculate_secret(peer_public_key)
+        else:
+            raise ValueError("Unsupported operation: {}".format(op))
+        return {"result": result.hex()}
+    except KeyError as e:
+        return {"error": "Missing or invalid value: {}".format(e)}
+    except Exception as e:
+        logger.debug("Request failed", exc_info=e)
+        return {"error": str(e) or type(e).__name__}
+
+
+class _StreamRequestHandler(socketserver.StreamRequestHandler):
+    # Handles requests as JSON objects, one per line, until the client disconnects
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = handle_request(self.server.pool, json.loads(line))
+            except ValueError:
+                response = {"error": "Invalid request"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+
+    class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """Serves requests from a KeyPool over a Unix socket, as JSON lines.
+
+        The socket is only accessible to the current user.
+        """
+
+        daemon_threads = True
+
+        def __init__(self, pool, path):
+            umask = os.umask(0o177)
+            try:
+                super(UnixServer, self).__init__(path, _StreamRequestHandler)
+            finally:
+                os.umask(umask)
+            self.pool = pool
+
+        def server_close(self):
+            super(UnixServer, self).server_close()
+            os.unlink(self.server_address)
@@ -25,15 +25,29 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from yubikit.core import TRANSPORT, USB_INTERFACE, YUBIKEY, YubiKeyDevice
+from yubikit.core import (
+    TRANSPORT,
+    USB_INTERFACE,
+    YUBIKEY,
+    YubiKeyDevice,
+    ConnectionLostError,
+)
 from yubikit.core.smartcard import SmartCardConnection
 
 from smartcard import System
 from smartcard.Exceptions import CardConnectionException
 from smartcard.pcsc.PCSCExceptions import ListReadersException
 from smartcard.pcsc.PCSCContext import PCSCContext
+from smartcard.scard import (
+    SCardBeginTransaction,
+    SCardEndTransaction,
+    SCardGetErrorMessage,
+    SCARD_LEAVE_CARD,
+    SCARD_S_SUCCESS,
+)
 
 from fido2.pcsc import CtapPcscDevice
+from contextlib import contextmanager
 from time import sleep
 import subprocess  # nosec
 import logging
@@ -91,7 +105,7 @@ class ScardDevice(YubiKeyDevice):
     def _open_smartcard_connection(self) -> SmartCardConnection:
         try:
             return ScardSmartCardConnection(self.reader.createConnection())
-        except CardConnectionException as e:
+        except ConnectionLostError as e:
             if kill_scdaemon():
                 return ScardSmartCardConnection(self.reader.createConnection())
             raise e
@@ -100,24 +114,63 @@ class ScardDevice(YubiKeyDevice):
 class ScardSmartCardConnection(SmartCardConnection):
     def __init__(self, connection):
         self.connection = connection
-        connection.connect()
+        try:
+            connection.connect()
+        except CardConnectionException as e:
+            raise ConnectionLostError(e)
         atr = connection.getATR()
         self._transport = TRANSPORT.USB if atr[1] & 0xF0 == 0xF0 else TRANSPORT.NFC
+        self._transaction_depth = 0
 
     @property
     def transport(self):
         return self._transport
 
     def close(self):
-        self.connection.disconnect()
+        try:
+            self.connection.disconnect()
+        except CardConnectionException as e:
+            raise ConnectionLostError(e)
 
     def send_and_receive(self, apdu):
         """Sends a command APDU and returns the response data and sw"""
         logger.debug("SEND: %s", apdu.hex())
-        data, sw1, sw2 = self.connection.transmit(list(apdu))
+        try:
+            data, sw1, sw2 = self.connection.transmit(list(apdu))
+        except CardConnectionException as e:
+            raise ConnectionLostError(e)
         logger.debug("RECV: %s SW=%02x%02x", bytes(data).hex(), sw1, sw2)
         return bytes(data), sw1 << 8 | sw2
 
+    @contextmanager
+    def transaction(self):
+        """Hold exclusive access to the card for the duration of the block"""
+        if self._transaction_depth:  # Nested, the outer block holds the card
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        # createConnection() returns a decorated PCSCCardConnection
+        hcard = getattr(self.connection, "component", self.connection).hcard
+        hresult = SCardBeginTransaction(hcard)
+        if hresult != SCARD_S_SUCCESS:
+            raise ConnectionLostError(
+                "Failed to begin transaction: " + SCardGetErrorMessage(hresult)
+            )
+        self._transaction_depth = 1
+        try:
+            yield
+        finally:
+            self._transaction_depth = 0
+            hresult = SCardEndTransaction(hcard, SCARD_LEAVE_CARD)
+            if hresult != SCARD_S_SUCCESS:
+                logger.debug(
+                    "Failed to end transaction: %s", SCardGetErrorMessage(hresult)
+                )
+
 
 def kill_scdaemon():
     killed = False
@@ -43,6 +43,14 @@ logger = logging.getLogger(__name__)
 
 PEM_IDENTIFIER = b"-----BEGIN"
 
+# Hash algorithms available for signing, by name
+HASH_ALGORITHMS = {
+    "SHA1": hashes.SHA1,
+    "SHA256": hashes.SHA256,
+    "SHA384": hashes.SHA384,
+    "SHA512": hashes.SHA512,
+}
+
 
 class Cve201715361VulnerableError(Exception):
     """Thrown if on-chip RSA key generation is attempted on a YubiKey vulnerable
@@ -256,6 +256,10 @@ class ApplicationNotAvailableError(CommandError):
     """The application is either disabled or not supported on this YubiKey"""
 
 
+class ConnectionLostError(Exception):
+    """Communication with the YubiKey failed, as when it has been removed"""
+
+
 class NotSupportedError(ValueError):
     """Attempting an action that is not supported on this YubiKey"""
 
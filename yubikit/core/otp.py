@@ -27,9 +27,9 @@
 
 from . import Connection, CommandError, TimeoutError
 
-from time import sleep
+from time import sleep, monotonic
 from threading import Event
-from typing import Optional, Callable
+from typing import Optional, Callable, Iterator, Tuple
 import abc
 import struct
 import logging
@@ -90,6 +90,19 @@ CONFIG_STATUS_MASK = 0x1F
 STATUS_PROCESSING = 1
 STATUS_UPNEEDED = 2
 
+# Delays (in seconds) between polls while waiting for the YubiKey. Polling starts
+# with the shorter delay, which is doubled after each poll up to the longer one.
+POLL_INTERVAL = (0.001, 0.02)
+POLL_INTERVAL_TOUCH = 0.1  # Waiting for the user, no need to poll as often
+WRITE_READY_TIMEOUT = 1.0
+
+
+def _poll_intervals(interval: Tuple[float, float]) -> Iterator[float]:
+    delay, max_delay = interval
+    while True:
+        yield delay
+        delay = min(delay * 2, max_delay)
+
 
 def _should_send(packet, seq):
     """All-zero packets are skipped, except for the very first and last packets"""
@@ -101,8 +114,13 @@ def _format_frame(slot, payload):
 
 
 class OtpProtocol:
-    def __init__(self, otp_connection: OtpConnection):
+    def __init__(
+        self,
+        otp_connection: OtpConnection,
+        poll_interval: Tuple[float, float] = POLL_INTERVAL,
+    ):
         self.connection = otp_connection
+        self.poll_interval = poll_interval
 
     def close(self) -> None:
         self.connection.close()
@@ -113,6 +131,7 @@ class OtpProtocol:
         data: Optional[bytes] = None,
         event: Optional[Event] = None,
         on_keepalive: Optional[Callable[[int], None]] = None,
+        poll_interval: Optional[Tuple[float, float]] = None,
     ) -> bytes:
         """Sends a command to the YubiKey, and reads the response.
 
@@ -123,6 +142,8 @@ class OtpProtocol:
         @param data  the data payload to send
         @param state optional CommandState for listening for user presence requirement
             and for cancelling a command.
+        @param poll_interval optional (initial, max) delay between polls for the
+            response, overriding the default of the protocol.
         @return response data (including CRC) in the case of data, or an updated status
             struct
         """
@@ -134,7 +155,10 @@ class OtpProtocol:
         frame = _format_frame(slot, payload)
         logger.debug("SEND: %s", frame.hex())
         response = self._read_frame(
-            self._send_frame(frame), event or Event(), on_keepalive
+            self._send_frame(frame),
+            event or Event(),
+            on_keepalive,
+            poll_interval or self.poll_interval,
         )
         logger.debug("RECV: %s", response.hex())
         return response
@@ -149,12 +173,15 @@ class OtpProtocol:
 
     def _await_ready_to_write(self):
         """Sleep for up to ~1s waiting for the WRITE flag to be unset"""
-        for _ in range(20):
+        deadline = monotonic() + WRITE_READY_TIMEOUT
+        for delay in _poll_intervals(self.poll_interval):
             if (
                 self.connection.receive()[FEATURE_RPT_DATA_SIZE] & SLOT_WRITE_FLAG
             ) == 0:
                 return
-            sleep(0.05)
+            if monotonic() > deadline:
+                break
+            sleep(delay)
         raise Exception("Timeout waiting for YubiKey to become ready to receive")
 
     def _send_frame(self, buf):
@@ -171,11 +198,12 @@ class OtpProtocol:
 
         return prog_seq
 
-    def _read_frame(self, prog_seq, event, on_keepalive):
+    def _read_frame(self, prog_seq, event, on_keepalive, poll_interval):
         """Reads one frame"""
         response = b""
         seq = 0
         needs_touch = False
+        delays = _poll_intervals(poll_interval)
 
         while True:
             report = self.connection.receive()
@@ -208,11 +236,10 @@ class OtpProtocol:
                 if (statusByte & RESP_TIMEOUT_WAIT_FLAG) != 0:
                     on_keepalive(STATUS_UPNEEDED)
                     needs_touch = True
-                    timeout = 0.1
+                    timeout = POLL_INTERVAL_TOUCH
                 else:
                     on_keepalive(STATUS_PROCESSING)
-                    timeout = 0.02
-                sleep(timeout)
+                    timeout = next(delays)
                 if event.wait(timeout):
                     self._reset_state()
                     raise TimeoutError("Command cancelled by Event")
@@ -28,7 +28,8 @@
 from . import Version, TRANSPORT, Connection, CommandError, ApplicationNotAvailableError
 from time import time
 from enum import IntEnum, unique
-from typing import Tuple
+from contextlib import contextmanager
+from typing import Tuple, Iterator
 import abc
 import struct
 
@@ -43,6 +44,15 @@ class SmartCardConnection(Connection, metaclass=abc.ABCMeta):
     def send_and_receive(self, apdu: bytes) -> Tuple[bytes, int]:
         """Sends a command APDU and returns the response"""
 
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Hold exclusive access to the card for the duration of the block
+
+        The default implementation does nothing, for connections which are not
+        shared with other processes.
+        """
+        yield
+
 
 class ApduError(CommandError):
     """Thrown when an APDU response has the wrong SW code"""
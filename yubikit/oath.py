@@ -19,7 +19,7 @@ from enum import IntEnum, unique
 from dataclasses import dataclass
 from base64 import b64encode, b32decode
 from time import time
-from typing import Optional, List, Mapping
+from typing import Optional, List, Dict, Tuple, Mapping, Iterable, Iterator
 
 import struct
 import os
@@ -253,7 +253,7 @@ def _format_code(credential, timestamp, truncated):
     digits = truncated[0]
 
     return Code(
-        str(bytes2int(truncated[1:]) & 0x7FFFFFFF).rjust(digits, "0"),
+        str((bytes2int(truncated[1:]) & 0x7FFFFFFF) % 10 ** digits).rjust(digits, "0"),
         valid_from,
         valid_to,
     )
@@ -343,6 +343,32 @@ class OathSession:
             touch_required,
         )
 
+    def put_credentials(
+        self,
+        credentials: Iterable[CredentialData],
+        touch_required: bool = False,
+        overwrite: bool = False,
+        existing_ids: Optional[Iterable[bytes]] = None,
+    ) -> Iterator[Tuple[CredentialData, Optional[Credential]]]:
+        """Store multiple credentials, listing existing credentials only once.
+
+        Yields each CredentialData together with the stored Credential, or None if a
+        credential with the same ID already exists and overwrite is False. The IDs of
+        existing credentials can be given, if already known, to avoid listing them.
+        Storing stops at the first credential which fails, by raising ApduError.
+        """
+        if existing_ids is None:
+            existing_ids = [cred.id for cred in self.list_credentials()]
+        existing = set(existing_ids)
+        for credential_data in credentials:
+            cred_id = credential_data.get_id()
+            if cred_id in existing and not overwrite:
+                yield credential_data, None
+                continue
+            credential = self.put_credential(credential_data, touch_required)
+            existing.add(cred_id)
+            yield credential_data, credential
+
     def rename_credential(
         self, credential_id: bytes, name: str, issuer: Optional[str] = None
     ) -> bytes:
@@ -385,41 +411,79 @@ class OathSession:
     def delete_credential(self, credential_id: bytes) -> None:
         self.protocol.send_apdu(0, INS_DELETE, 0, 0, Tlv(TAG_NAME, credential_id))
 
-    def calculate_all(
-        self, timestamp: Optional[int] = None
-    ) -> Mapping[Credential, Optional[Code]]:
-        timestamp = int(timestamp or time())
-        challenge = _get_challenge(timestamp, DEFAULT_PERIOD)
-
-        entries = {}
+    def _calculate_all_raw(
+        self, challenge: bytes, truncate: bool
+    ) -> List[Tuple[bytes, Tlv]]:
         data = Tlv.parse_list(
             self.protocol.send_apdu(
-                0, INS_CALCULATE_ALL, 0, 1, Tlv(TAG_CHALLENGE, challenge)
+                0,
+                INS_CALCULATE_ALL,
+                0,
+                0x01 if truncate else 0x00,
+                Tlv(TAG_CHALLENGE, challenge),
             )
         )
-        while data:
-            cred_id = Tlv.unwrap(TAG_NAME, data.pop(0))
-            tlv = data.pop(0)
-            resp_tag = tlv.tag
-            oath_type = OATH_TYPE.HOTP if resp_tag == TAG_HOTP else OATH_TYPE.TOTP
-            touch = resp_tag == TAG_TOUCH
+        return [
+            (Tlv.unwrap(TAG_NAME, name_tlv), resp_tlv)
+            for name_tlv, resp_tlv in zip(data[::2], data[1::2])
+        ]
+
+    def calculate_all_responses(
+        self, timestamp: Optional[int] = None, truncate: bool = True
+    ) -> Mapping[Credential, Optional[bytes]]:
+        """Calculate responses for all credentials using CALCULATE ALL.
+
+        Each response is the number of digits followed by the truncated HMAC, or the
+        full HMAC if truncate is False. The response is None for HOTP credentials and
+        credentials requiring touch. One command is sent per distinct TOTP period.
+        """
+        timestamp = int(timestamp or time())
+        challenge = _get_challenge(timestamp, DEFAULT_PERIOD)
+        resp_tag = TAG_TRUNCATED if truncate else TAG_RESPONSE
+
+        entries: Dict[Credential, Optional[bytes]] = {}
+        by_period: Dict[int, List[Credential]] = {}
+        for cred_id, tlv in self._calculate_all_raw(challenge, truncate):
+            oath_type = OATH_TYPE.HOTP if tlv.tag == TAG_HOTP else OATH_TYPE.TOTP
+            touch = tlv.tag == TAG_TOUCH
             issuer, name, period = _parse_cred_id(cred_id, oath_type)
 
             credential = Credential(
                 self.info.device_id, cred_id, issuer, name, oath_type, period, touch
             )
 
-            code = None  # Will be None for HOTP and touch
-            if oath_type == OATH_TYPE.TOTP:
+            response = None  # Will be None for HOTP and touch
+            if tlv.tag == resp_tag:
                 if period != DEFAULT_PERIOD:
-                    # Non-standard period, recalculate
-                    code = self.calculate_code(credential, timestamp)
-                elif resp_tag == TAG_TRUNCATED:
-                    code = _format_code(credential, timestamp, tlv.value)
-            entries[credential] = code
+                    # Non-standard period, recalculate below
+                    by_period.setdefault(period, []).append(credential)
+                else:
+                    response = tlv.value
+            entries[credential] = response
+
+        # One CALCULATE ALL per non-standard period, using that period's challenge
+        for period, credentials in by_period.items():
+            responses = dict(
+                self._calculate_all_raw(_get_challenge(timestamp, period), truncate)
+            )
+            for credential in credentials:
+                tlv = responses.get(credential.id)
+                if tlv is not None and tlv.tag == resp_tag:
+                    entries[credential] = tlv.value
 
         return entries
 
+    def calculate_all(
+        self, timestamp: Optional[int] = None
+    ) -> Mapping[Credential, Optional[Code]]:
+        timestamp = int(timestamp or time())
+        return {
+            credential: _format_code(credential, timestamp, response)
+            if response
+            else None
+            for credential, response in self.calculate_all_responses(timestamp).items()
+        }
+
     def calculate_code(
         self, credential: Credential, timestamp: Optional[int] = None
     ) -> Code:
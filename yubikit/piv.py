@@ -41,15 +41,22 @@ from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.constant_time import bytes_eq
 from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from cryptography.hazmat.primitives.asymmetric import rsa, ec
-from cryptography.hazmat.primitives.asymmetric.padding import AsymmetricPadding
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.asymmetric.padding import (
+    AsymmetricPadding,
+    PKCS1v15,
+)
 from cryptography.hazmat.backends import default_backend
 from cryptography.utils import int_to_bytes, int_from_bytes
 
 from dataclasses import dataclass
 from enum import Enum, IntEnum, unique, auto
-from typing import Optional, Union, cast
+from functools import lru_cache
+from typing import Optional, Union, Iterable, Iterator, cast
 
 import logging
+import gzip
+import zlib
 import os
 import re
 
@@ -247,6 +254,12 @@ PUK_P2 = 0x81
 
 TDES = 0x03
 
+CERT_INFO_UNCOMPRESSED = 0x00
+CERT_INFO_GZIP = 0x01
+
+# Certificates larger than this (in bytes) are compressed by default when stored
+CERT_COMPRESSION_THRESHOLD = 2048
+
 
 class InvalidPinError(CommandError):
     def __init__(self, attempts_remaining):
@@ -301,33 +314,83 @@ class SlotMetadata:
         return _parse_device_public_key(self.key_type, self.public_key_encoded)
 
 
-def _pad_message(key_type, message, hash_algorithm, padding):
+# Gets the DER encoded certificate from the data of a certificate object
+def unpack_certificate(object_data: bytes) -> bytes:
+    try:
+        data = Tlv.parse_dict(object_data)
+    except ValueError:
+        raise BadResponseError("Malformed certificate data object")
+
+    cert_info = data.get(TAG_CERT_INFO)
+    cert_data = data.get(TAG_CERTIFICATE, b"")
+    if cert_info and cert_info[0] == CERT_INFO_GZIP:
+        try:
+            return gzip.decompress(cert_data)
+        except (OSError, EOFError, zlib.error) as e:
+            raise BadResponseError("Failed to decompress certificate", e)
+    elif cert_info and cert_info[0] != CERT_INFO_UNCOMPRESSED:
+        raise NotSupportedError("Unsupported certificate encoding")
+    return cert_data
+
+
+# DER encoded DigestInfo prefixes used in PKCS#1 v1.5 signatures
+_PKCS1_DIGEST_INFO = {
+    "sha1": bytes.fromhex("3021300906052b0e03021a05000414"),
+    "sha224": bytes.fromhex("302d300d06096086480165030402040500041c"),
+    "sha256": bytes.fromhex("3031300d060960864801650304020105000420"),
+    "sha384": bytes.fromhex("3041300d060960864801650304020205000430"),
+    "sha512": bytes.fromhex("3051300d060960864801650304020305000440"),
+}
+
+
+@lru_cache()
+def _get_dummy_key(bit_len):
+    # Only used to add or remove padding, so the same key can be used each time
+    return rsa.generate_private_key(65537, bit_len, default_backend())
+
+
+def _pad_digest(key_type, digest, hash_algorithm, padding):
     if key_type.algorithm == ALGORITHM.EC:
-        h = hashes.Hash(hash_algorithm, default_backend())
-        h.update(message)
-        hashed = h.finalize()
         byte_len = key_type.bit_len // 8
-        if len(hashed) < byte_len:
-            return hashed.rjust(byte_len // 8, b"\0")
-        return hashed[:byte_len]
+        if len(digest) < byte_len:
+            return digest.rjust(byte_len, b"\0")
+        return digest[:byte_len]
     elif key_type.algorithm == ALGORITHM.RSA:
+        prefix = _PKCS1_DIGEST_INFO.get(getattr(hash_algorithm, "name", None))
+        if isinstance(padding, PKCS1v15) and prefix:
+            # EMSA-PKCS1-v1_5 encoding, as defined in RFC 8017
+            t = prefix + digest
+            return b"\0\1" + b"\xff" * (key_type.bit_len // 8 - len(t) - 3) + b"\0" + t
         # Sign with a dummy key, then encrypt the signature to get the padded message
-        e = 65537
-        dummy = rsa.generate_private_key(e, key_type.bit_len, default_backend())
-        signature = dummy.sign(message, padding, hash_algorithm)
+        dummy = _get_dummy_key(key_type.bit_len)
+        if not isinstance(hash_algorithm, Prehashed):
+            hash_algorithm = Prehashed(hash_algorithm)
+        signature = dummy.sign(digest, padding, hash_algorithm)
         # Raw (textbook) RSA encrypt
-        n = dummy.public_key().public_numbers().n
+        numbers = dummy.public_key().public_numbers()
         return int_to_bytes(
-            pow(int_from_bytes(signature, "big"), e, n), key_type.bit_len // 8
+            pow(int_from_bytes(signature, "big"), numbers.e, numbers.n),
+            key_type.bit_len // 8,
         )
 
 
+def _pad_message(key_type, message, hash_algorithm, padding):
+    if isinstance(hash_algorithm, Prehashed):
+        digest = message
+    else:
+        h = hashes.Hash(hash_algorithm, default_backend())
+        h.update(message)
+        digest = h.finalize()
+    return _pad_digest(key_type, digest, hash_algorithm, padding)
+
+
 def _unpad_message(padded, padding):
-    e = 65537
-    dummy = rsa.generate_private_key(e, len(padded) * 8, default_backend())
+    dummy = _get_dummy_key(len(padded) * 8)
     # Raw (textbook) RSA encrypt
-    n = dummy.public_key().public_numbers().n
-    encrypted = int_to_bytes(pow(int_from_bytes(padded, "big"), e, n), len(padded))
+    numbers = dummy.public_key().public_numbers()
+    encrypted = int_to_bytes(
+        pow(int_from_bytes(padded, "big"), numbers.e, numbers.n), len(padded)
+    )
     return dummy.decrypt(encrypted, padding)
 
 
@@ -534,6 +597,44 @@ class PivSession:
         padded = _pad_message(key_type, message, hash_algorithm, padding)
         return self._use_private_key(slot, key_type, padded, False)
 
+    def sign_many(
+        self,
+        slot: SLOT,
+        key_type: KEY_TYPE,
+        digests: Iterable[bytes],
+        hash_algorithm: hashes.HashAlgorithm,
+        padding: Optional[AsymmetricPadding] = None,
+        pin: Optional[str] = None,
+    ) -> Iterator[bytes]:
+        key_type = KEY_TYPE(key_type)
+        verify_each = False
+        if pin is not None:
+            if self.version >= (5, 3, 0):
+                pin_policy = self.get_slot_metadata(slot).pin_policy
+                verify_each = pin_policy == PIN_POLICY.ALWAYS
+            self.verify_pin(pin)
+
+        for i, digest in enumerate(digests):
+            padded = _pad_digest(key_type, digest, hash_algorithm, padding)
+            if verify_each and i > 0:
+                self.verify_pin(pin)
+            try:
+                signature = self._use_private_key(slot, key_type, padded, False)
+            except ApduError as e:
+                if (
+                    pin is not None
+                    and not verify_each
+                    and e.sw == SW.SECURITY_CONDITION_NOT_SATISFIED
+                ):
+                    # PIN policy ALWAYS, on a YubiKey without slot metadata
+                    logger.debug("PIN needed for each signature, verifying again")
+                    verify_each = True
+                    self.verify_pin(pin)
+                    signature = self._use_private_key(slot, key_type, padded, False)
+                else:
+                    raise
+            yield signature
+
     def decrypt(
         self, slot: SLOT, cipher_text: bytes, padding: AsymmetricPadding
     ) -> bytes:
@@ -587,26 +688,34 @@ class PivSession:
         )
 
     def get_certificate(self, slot: SLOT) -> x509.Certificate:
+        cert_data = unpack_certificate(self.get_object(OBJECT_ID.from_slot(slot)))
         try:
-            data = Tlv.parse_dict(self.get_object(OBJECT_ID.from_slot(slot)))
-        except ValueError:
-            raise BadResponseError("Malformed certificate data object")
-
-        cert_info = data.get(TAG_CERT_INFO)
-        if cert_info and cert_info[0] != 0:
-            raise NotSupportedError("Compressed certificates are not supported")
-
-        try:
-            return x509.load_der_x509_certificate(
-                data[TAG_CERTIFICATE], default_backend()
-            )
+            return x509.load_der_x509_certificate(cert_data, default_backend())
         except Exception as e:
             raise BadResponseError("Invalid certificate", e)
 
-    def put_certificate(self, slot: SLOT, certificate: x509.Certificate) -> None:
+    def put_certificate(
+        self,
+        slot: SLOT,
+        certificate: x509.Certificate,
+        compress: Optional[bool] = None,
+    ) -> None:
         cert_data = certificate.public_bytes(Encoding.DER)
+        cert_info = CERT_INFO_UNCOMPRESSED
+        # By default, compress large certificates if it makes them smaller
+        if compress or (
+            compress is None and len(cert_data) > CERT_COMPRESSION_THRESHOLD
+        ):
+            # Use zlib directly for deterministic output (no timestamp in header)
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed = compressor.compress(cert_data) + compressor.flush()
+            if compress or len(compressed) < len(cert_data):
+                cert_data = compressed
+                cert_info = CERT_INFO_GZIP
         data = (
-            Tlv(TAG_CERTIFICATE, cert_data) + Tlv(TAG_CERT_INFO, b"\0") + Tlv(TAG_LRC)
+            Tlv(TAG_CERTIFICATE, cert_data)
+            + Tlv(TAG_CERT_INFO, bytes([cert_info]))
+            + Tlv(TAG_LRC)
         )
         self.put_object(OBJECT_ID.from_slot(slot), data)
 
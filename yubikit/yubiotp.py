@@ -43,7 +43,7 @@ import abc
 import struct
 from threading import Event
 from enum import unique, IntEnum, IntFlag
-from typing import TypeVar, Optional, Union, Callable
+from typing import TypeVar, Optional, Union, Callable, Iterable, Iterator
 
 
 T = TypeVar("T")
@@ -622,6 +622,10 @@ class _Backend(abc.ABC):
         ...
 
 
+# Writing a configuration takes longer than most other commands
+WRITE_POLL_INTERVAL = (0.01, 0.05)
+
+
 class _YubiOtpOtpBackend(_Backend):
     def __init__(self, protocol):
         self.protocol = protocol
@@ -630,7 +634,9 @@ class _YubiOtpOtpBackend(_Backend):
         self.protocol.close()
 
     def write_update(self, slot, data):
-        return self.protocol.send_and_receive(slot, data)
+        return self.protocol.send_and_receive(
+            slot, data, poll_interval=WRITE_POLL_INTERVAL
+        )
 
     def send_and_receive(self, slot, data, expected_len, event=None, on_keepalive=None):
         response = self.protocol.send_and_receive(slot, data, event, on_keepalive)
@@ -778,17 +784,27 @@ class YubiOtpSession:
         event: Optional[Event] = None,
         on_keepalive: Optional[Callable[[int], None]] = None,
     ) -> bytes:
+        return next(
+            self.calculate_hmac_sha1_many(slot, [challenge], event, on_keepalive)
+        )
+
+    def calculate_hmac_sha1_many(
+        self,
+        slot: SLOT,
+        challenges: Iterable[bytes],
+        event: Optional[Event] = None,
+        on_keepalive: Optional[Callable[[int], None]] = None,
+    ) -> Iterator[bytes]:
+        # Responses are yielded as they are read, all over the open connection
         if self.version < (2, 2, 0):
             raise NotSupportedError("This operation requires YubiKey 2.2 or later")
 
-        # Pad challenge with byte different from last
-        challenge = challenge.ljust(
-            HMAC_CHALLENGE_SIZE, b"\1" if challenge.endswith(b"\0") else b"\0"
-        )
-        return self.backend.send_and_receive(
-            SLOT.map(slot, CONFIG_SLOT.CHAL_HMAC_1, CONFIG_SLOT.CHAL_HMAC_2),
-            challenge,
-            HMAC_RESPONSE_SIZE,
-            event,
-            on_keepalive,
-        )
+        config_slot = SLOT.map(slot, CONFIG_SLOT.CHAL_HMAC_1, CONFIG_SLOT.CHAL_HMAC_2)
+        for challenge in challenges:
+            # Pad challenge with byte different from last
+            challenge = challenge.ljust(
+                HMAC_CHALLENGE_SIZE, b"\1" if challenge.endswith(b"\0") else b"\0"
+            )
+            yield self.backend.send_and_receive(
+                config_slot, challenge, HMAC_RESPONSE_SIZE, event, on_keepalive,
+            )